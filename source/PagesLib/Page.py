@@ -1,6 +1,6 @@
-import pandas as pd
 from pydantic import BaseModel, Field, StringConstraints
 from typing import List, Dict, Optional, Union, Literal, Any, Annotated
+import profiling
 
 
 class Entry(BaseModel):
@@ -88,139 +88,70 @@ class PageGovExtended(Page):
         description="The list of entries on the page")
 
 
-# Function to convert Directory to a DataFrame
-def page_to_dataframe(page: Page):
-    if isinstance(page, PageGovCore):
-        return page_to_df_gov_core(page)
-    elif isinstance(page, PagePrivateCore):
-        return page_to_df_private_core(page)
-    elif isinstance(page, PageGovExtended):
-        return page_to_df_gov_extended(page)
-    elif isinstance(page, PagePrivateExtended):
-        return page_to_df_private_extended(page)
-    else:
-        raise ValueError("Unsupported page model type")
+# Output columns of page_to_dataframe for each page schema, in order.
+# Each column is a field of the page ("yr", "pgnum") or of its entries, and is
+# named after the field description.
+CORE_FIELDS = ["company", "construction_complete", "new_construction",
+               "length_total", "fuel_original", "fuel_corrected",
+               "origin_state", "terminus_state", "inter_or_intra"]
 
+EXTENDED_FIELDS = ["company", "construction_complete", "new_construction",
+                   "length_total", "length_by_diameter", "diameter",
+                   "fuel_original", "fuel_corrected", "origin_city",
+                   "origin_county", "origin_state", "other_origin_description",
+                   "terminus_city", "terminus_county", "terminus_state",
+                   "other_terminus_description", "inter_or_intra", "fpc",
+                   "parallel_or_loop", "function", "connection"]
 
-def page_to_df_gov_core(page: Page):
-    data = []
-
-    for entry in page.entries:
-        # TODO: retrieve the column name from the entry field description
-        # col_names = [Entry.model_fields[vars].description for vars in Entry.model_fields.keys()]
-        data.append({
-            "Data Year": page.yr,
-            "Project Number": entry.project_num,
-            "Pipeline Company": entry.company,
-            "Construction Complete": entry.construction_complete,
-            "New Construction": entry.new_construction,
-            "Total Pipeline Length": entry.length_total,
-            "Fuel Type Raw": entry.fuel_original,
-            "Fuel Type Inferred": entry.fuel_corrected,
-            "Origin State": entry.origin_state,
-            "Terminus State": entry.terminus_state,
-            "Interstate or Intrastate": entry.inter_or_intra,
-            "Page Number": page.pgnum,
-        })
-
-    df = pd.DataFrame(data)
-    return df
+PAGE_FIELDS = {
+    PagePrivateCore: ["yr", "state_heading"] + CORE_FIELDS + ["pgnum"],
+    PagePrivateExtended: ["yr", "state_heading"] + EXTENDED_FIELDS + ["pgnum"],
+    PageGovCore: ["yr", "project_num"] + CORE_FIELDS + ["pgnum"],
+    PageGovExtended: ["yr", "project_num"] + EXTENDED_FIELDS + ["pgnum"],
+}
 
 
-def page_to_df_private_core(page: Page):
-    data = []
-
-    for entry in page.entries:
-        # TODO: retrieve the column name from the entry field description
-        # col_names = [Entry.model_fields[vars].description for vars in Entry.model_fields.keys()]
-        data.append({
-            "Data Year": page.yr,
-            "State Heading": entry.state_heading,
-            "Pipeline Company": entry.company,
-            "Construction Complete": entry.construction_complete,
-            "New Construction": entry.new_construction,
-            "Total Pipeline Length": entry.length_total,
-            "Fuel Type Raw": entry.fuel_original,
-            "Fuel Type Inferred": entry.fuel_corrected,
-            "Origin State": entry.origin_state,
-            "Terminus State": entry.terminus_state,
-            "Interstate or Intrastate": entry.inter_or_intra,
-            "Page Number": page.pgnum,
-        })
-
-    df = pd.DataFrame(data)
-    return df
+def entry_model(page_schema):
+    """ Entry model of a page schema (the type of its entries)."""
+    return page_schema.model_fields["entries"].annotation.__args__[0]
 
 
-def page_to_df_gov_extended(page: Page):
-    data = []
-
-    for entry in page.entries:
-        # TODO: retrieve the column name from the entry field description
-        # col_names = [Entry.model_fields[vars].description for vars in Entry.model_fields.keys()]
-        data.append({
-            "Data Year": page.yr,
-            "Project Number": entry.project_num,
-            "Pipeline Company": entry.company,
-            "Construction Complete": entry.construction_complete,
-            "New Construction": entry.new_construction,
-            "Total Pipeline Length": entry.length_total,
-            "Pipeline Length by Diameter": entry.length_by_diameter,
-            "Pipeline Diameter": entry.diameter,
-            "Fuel Type Raw": entry.fuel_original,
-            "Fuel Type Inferred": entry.fuel_corrected,
-            "Origin City": entry.origin_city,
-            "Origin County": entry.origin_county,
-            "Origin State": entry.origin_state,
-            "Other Origin Description": entry.other_origin_description,
-            "Terminus City": entry.terminus_city,
-            "Terminus County": entry.terminus_county,
-            "Terminus State": entry.terminus_state,
-            "Other Terminus Description": entry.other_terminus_description,
-            "Interstate or Intrastate": entry.inter_or_intra,
-            "FPC": entry.fpc,
-            "Parallel or Loop": entry.parallel_or_loop,
-            "Function": entry.function,
-            "Connection": entry.connection,
-            "Page Number": page.pgnum,
-        })
-
-    df = pd.DataFrame(data)
-    return df
+def page_columns(page_schema):
+    """ Output columns of page_to_dataframe for page_schema, in order.
+
+    Returns:
+        list of (column name, field name, is page field) tuples
+    """
+    if page_schema not in PAGE_FIELDS:
+        raise ValueError("Unsupported page model type")
+    entry_fields = entry_model(page_schema).model_fields
+    columns = []
+    for field in PAGE_FIELDS[page_schema]:
+        if field in Page.model_fields:
+            columns.append((Page.model_fields[field].description, field, True))
+        else:
+            columns.append(
+                (entry_fields[field].description, field, False))
+    return columns
+
+
+# Function to convert Directory to a DataFrame
+def page_to_dataframe(page: Page):
+    import pandas as pd  # imported here so that loading the schemas stays fast
+
+    for page_schema in PAGE_FIELDS:
+        if isinstance(page, page_schema):
+            break
+    else:
+        raise ValueError("Unsupported page model type")
 
+    with profiling.stage("page_to_dataframe"):
+        data = {}
+        for col_name, field, is_page_field in page_columns(page_schema):
+            if is_page_field:
+                data[col_name] = [getattr(page, field)] * len(page.entries)
+            else:
+                data[col_name] = [getattr(entry, field) for entry in page.entries]
 
-def page_to_df_private_extended(page: Page):
-    data = []
-
-    for entry in page.entries:
-        # TODO: retrieve the column name from the entry field description
-        # col_names = [Entry.model_fields[vars].description for vars in Entry.model_fields.keys()]
-        data.append({
-            "Data Year": page.yr,
-            "State Heading": entry.state_heading,
-            "Pipeline Company": entry.company,
-            "Construction Complete": entry.construction_complete,
-            "New Construction": entry.new_construction,
-            "Total Pipeline Length": entry.length_total,
-            "Pipeline Length by Diameter": entry.length_by_diameter,
-            "Pipeline Diameter": entry.diameter,
-            "Fuel Type Raw": entry.fuel_original,
-            "Fuel Type Inferred": entry.fuel_corrected,
-            "Origin City": entry.origin_city,
-            "Origin County": entry.origin_county,
-            "Origin State": entry.origin_state,
-            "Other Origin Description": entry.other_origin_description,
-            "Terminus City": entry.terminus_city,
-            "Terminus County": entry.terminus_county,
-            "Terminus State": entry.terminus_state,
-            "Other Terminus Description": entry.other_terminus_description,
-            "Interstate or Intrastate": entry.inter_or_intra,
-            "FPC": entry.fpc,
-            "Parallel or Loop": entry.parallel_or_loop,
-            "Function": entry.function,
-            "Connection": entry.connection,
-            "Page Number": page.pgnum,
-        })
-
-    df = pd.DataFrame(data)
+        df = pd.DataFrame(data)
     return df
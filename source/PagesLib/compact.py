@@ -0,0 +1,160 @@
+import re
+import typing
+from typing import Literal
+from pydantic import Field, ValidationError, create_model
+from PagesLib.Page import entry_model
+
+# ------------------------------------------------------------------------------
+# -- Define functions ----------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Compact wire schema: the model writes every key of every entry, so long field
+# names (other_terminus_description, length_by_diameter, ...) and long Literal
+# values take a large part of the output tokens on dense pages. The compact
+# schema of a page schema has the same entry fields with short keys (initials
+# of the field name) and Literal values replaced by short codes (initials of
+# the value, the same in every field), explained in the field descriptions.
+# Page fields (written once per page) keep their names, so streaming.py can
+# parse compact responses. Responses are expanded back to the page schema
+# before page_to_dataframe.
+
+
+def short_names(names, lowercase=True):
+    """
+    Short unique name for each name: the initials of its words, extended with
+    the letters of the last word (then a number) if already taken.
+
+    Parameters:
+        names (list): Names, in order (earlier names get the shorter codes).
+        lowercase (bool): If True, short names are lower case, else upper case.
+
+    Returns:
+        dict: Name -> short name.
+    """
+    shorts = {}
+    taken = set()
+    for name in names:
+        words = re.findall(r"[A-Za-z0-9]+", name) or [str(len(shorts))]
+        short = "".join(word[0] for word in words)
+        extra = words[-1][1:]
+        n = 1
+        while (short.lower() if lowercase else short.upper()) in taken:
+            if extra:
+                short, extra = short + extra[0], extra[1:]
+            else:
+                short = "".join(word[0] for word in words) + str(n)
+                n += 1
+        short = short.lower() if lowercase else short.upper()
+        taken.add(short)
+        shorts[name] = short
+    return shorts
+
+
+# ------------------------------------------------------------------------------
+# -- Define classes ------------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+
+class CompactSchema:
+    """
+    Compact wire schema of a page schema, and the conversions between the two.
+
+    Parameters:
+        page_schema (type): Page schema (a PagesLib.Page model).
+
+    Attributes:
+        page_model (type): Compact page model (use as the response schema).
+        entry_model (type): Compact entry model.
+        entry_keys (dict): Entry field name -> short key.
+        codes (dict): Literal field name -> {value: code}.
+    """
+
+    def __init__(self, page_schema):
+        self.page_schema = page_schema
+        self.entry_schema = entry_model(page_schema)
+        entry_fields = self.entry_schema.model_fields
+        self.entry_keys = short_names(list(entry_fields))
+        literals = {name: typing.get_args(field.annotation)
+                    for name, field in entry_fields.items()
+                    if typing.get_origin(field.annotation) is Literal}
+        # one code per value across fields (GAS is G wherever it appears)
+        all_codes = short_names(list(dict.fromkeys(
+            value for values in literals.values() for value in values)),
+            lowercase=False)
+        self.codes = {name: {value: all_codes[value] for value in values}
+                      for name, values in literals.items()}
+        compact_fields = {}
+        for name, field in entry_fields.items():
+            annotation = field.annotation
+            description = field.description
+            if name in self.codes:
+                annotation = Literal[tuple(self.codes[name].values())]
+                description = f"{description} (codes: " + ", ".join(
+                    f"{code} = {value}"
+                    for value, code in self.codes[name].items()) + ")"
+            compact_fields[self.entry_keys[name]] = (
+                annotation, Field(description=description))
+        self.entry_model = create_model(
+            f"Compact{self.entry_schema.__name__}", **compact_fields)
+
+        compact_fields = {}
+        for name, field in page_schema.model_fields.items():
+            annotation = (list[self.entry_model] if name == "entries"
+                          else field.annotation)
+            compact_fields[name] = (annotation,
+                                    Field(description=field.description))
+        self.page_model = create_model(f"Compact{page_schema.__name__}",
+                                       **compact_fields)
+        self._values = {name: {code: value for value, code in codes.items()}
+                        for name, codes in self.codes.items()}
+
+    def expand_entry(self, entry):
+        """ Entry of the page schema from a compact entry."""
+        data = {}
+        for name, key in self.entry_keys.items():
+            value = getattr(entry, key, None)
+            if name in self._values:
+                value = self._values[name].get(value, value)
+            data[name] = value
+        return self.entry_schema.model_validate(data)
+
+    def expand_page(self, page):
+        """
+        Page of the page schema from a compact page.
+
+        Returns:
+            Page model: Validated page (or, for a partial streamed page with
+            missing fields, an unvalidated one, like streaming.py).
+        """
+        data = {name: getattr(page, name, None)
+                for name in self.page_schema.model_fields}
+        data["entries"] = [self.expand_entry(entry)
+                           for entry in (data["entries"] or [])]
+        try:
+            return self.page_schema.model_validate(data)
+        except ValidationError:
+            return self.page_schema.model_construct(**data)
+
+    def compact_page(self, page):
+        """ Compact page from a page of the page schema (the reverse of
+            expand_page)."""
+        entries = []
+        for entry in page.entries:
+            data = {}
+            for name, key in self.entry_keys.items():
+                value = getattr(entry, name)
+                data[key] = self.codes[name][value] if name in self.codes else value
+            entries.append(data)
+        data = {name: getattr(page, name) for name in self.page_schema.model_fields}
+        data["entries"] = entries
+        return self.page_model.model_validate(data)
+
+
+# Compact schemas by page schema
+_SCHEMAS = {}
+
+
+def compact_schema(page_schema):
+    """ The CompactSchema of a page schema (built once)."""
+    if page_schema not in _SCHEMAS:
+        _SCHEMAS[page_schema] = CompactSchema(page_schema)
+    return _SCHEMAS[page_schema]
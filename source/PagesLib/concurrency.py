@@ -0,0 +1,174 @@
+import time
+import random
+import threading
+import run_log
+
+# ------------------------------------------------------------------------------
+# -- Define functions ----------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+# Errors that mean the model endpoint is overloaded (worth retrying later)
+OVERLOAD_MARKERS = ("503", "429", "UNAVAILABLE", "RESOURCE_EXHAUSTED",
+                    "DEADLINE_EXCEEDED", "timed out", "timeout")
+
+
+def backoff_delay(attempt, base=1.0, cap=300.0):
+    """
+    Retry wait with "full jitter": uniform between 0 and base * 2**attempt
+    (capped), so retries from many requests do not arrive together.
+
+    Parameters:
+        attempt (int): Number of the failed attempt (from 0).
+        base (float): Seconds of the first backoff.
+        cap (float): Maximum seconds.
+
+    Returns:
+        float: Seconds to wait.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def is_overload(error):
+    """ True if an API error means the endpoint is overloaded (503, 429,
+        timeouts), as opposed to a bad request."""
+    if isinstance(error, TimeoutError):
+        return True
+    message = f"{type(error).__name__} {error}".lower()
+    return any(marker.lower() in message for marker in OVERLOAD_MARKERS)
+
+
+# ------------------------------------------------------------------------------
+# -- Define classes ------------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+
+class EndpointUnavailable(Exception):
+    """ The endpoint's circuit opened while a request could go to another API
+        key instead (see shards.py)."""
+
+
+class AIMDController:
+    """
+    Adaptive limit on the requests in flight to a model endpoint, with a
+    circuit breaker.
+
+    The limit grows additively (by increase per limit successful requests,
+    i.e. about one more request per round) while requests succeed, and is cut
+    multiplicatively (by decrease) on 503/429/timeouts, at most once per
+    cooldown so a burst of errors counts once. After failure_threshold
+    overload errors in a row, over at least sustain seconds without a
+    success, the circuit opens: no request is sent for pause
+    seconds (doubling each time it opens again, up to max_pause), then the
+    endpoint is probed again from min_limit.
+
+    Parameters:
+        initial (int): Starting limit.
+        min_limit (int): Lowest limit.
+        max_limit (int): Highest limit.
+        increase (float): Limit added per round of successful requests.
+        decrease (float): Factor of the limit on an overload error.
+        cooldown (float): Seconds between two decreases.
+        failure_threshold (int): Overload errors in a row that open the circuit.
+        sustain (float): Seconds the errors must last to open the circuit.
+        pause (float): Seconds the circuit stays open the first time.
+        max_pause (float): Longest pause.
+    """
+
+    def __init__(self, initial=2, min_limit=1, max_limit=16, increase=1.0,
+                 decrease=0.5, cooldown=2.0, failure_threshold=5, sustain=10.0,
+                 pause=30.0, max_pause=600.0):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.failure_threshold = failure_threshold
+        self.sustain = sustain
+        self.pause = pause
+        self.max_pause = max_pause
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        self._failures_since = None  # time of the first error in a row
+        self.open_until = 0.0
+        self.trips = 0
+        self.counts = {"ok": 0, "overload": 0, "error": 0}
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self, give_up=None):
+        """
+        Wait for a free slot (and for the circuit to be closed).
+
+        Parameters:
+            give_up (callable): If given, called when the circuit is open; if
+                it returns True, stop waiting.
+
+        Returns:
+            bool: True if a slot was taken (False if given up).
+        """
+        with self._cond:
+            while True:
+                wait = self.open_until - time.time()
+                if wait > 0:
+                    if give_up is not None and give_up():
+                        return False
+                    self._cond.wait(wait)
+                elif self.in_flight < max(self.min_limit, int(self.limit)):
+                    break
+                else:
+                    self._cond.wait()
+            self.in_flight += 1
+            return True
+
+    def release(self, outcome):
+        """
+        Free a slot and adapt the limit.
+
+        Parameters:
+            outcome (str): "ok", "overload" (503/429/timeout) or "error" (other
+                errors, which do not change the limit).
+        """
+        now = time.time()
+        with self._cond:
+            self.in_flight -= 1
+            self.counts[outcome] += 1
+            if outcome == "ok":
+                self.consecutive_failures = 0
+                self._failures_since = None
+                self.trips = 0
+                self.limit = min(self.max_limit,
+                                 self.limit + self.increase / self.limit)
+            elif outcome == "overload":
+                self.consecutive_failures += 1
+                if self._failures_since is None:
+                    self._failures_since = now
+                if now - self._last_decrease > self.cooldown:
+                    self.limit = max(self.min_limit, self.limit * self.decrease)
+                    self._last_decrease = now
+                if self.consecutive_failures >= self.failure_threshold and \
+                        now - self._failures_since >= self.sustain:
+                    pause = min(self.max_pause, self.pause * 2 ** self.trips)
+                    self.open_until = now + pause
+                    self.trips += 1
+                    self.consecutive_failures = 0
+                    self._failures_since = None
+                    self.limit = float(self.min_limit)
+                    run_log.current().warning(
+                        f"Endpoint overloaded, pausing requests for {pause:.0f}s",
+                        stage="concurrency")
+            self._cond.notify_all()
+
+
+# Controllers by model id, shared by all the runs in the process
+_CONTROLLERS = {}
+_CONTROLLERS_LOCK = threading.Lock()
+
+
+def controller_for(model_id, **kwargs):
+    """ The AIMDController of a model endpoint (kwargs are used when it is
+        first created)."""
+    with _CONTROLLERS_LOCK:
+        if model_id not in _CONTROLLERS:
+            _CONTROLLERS[model_id] = AIMDController(**kwargs)
+        return _CONTROLLERS[model_id]
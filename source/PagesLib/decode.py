@@ -0,0 +1,144 @@
+from typing_extensions import TypedDict
+from pydantic import ConfigDict, TypeAdapter, ValidationError
+from PagesLib.Page import entry_model, page_columns, page_to_dataframe
+from PagesLib.compact import compact_schema
+import profiling
+
+# ------------------------------------------------------------------------------
+# -- Define classes ------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Fast decoding of responses: with a pydantic class as response schema, the SDK
+# builds response.parsed with the class's model_validate_json (a model for the
+# page and for every entry), which page_to_dataframe then reads back attribute
+# by attribute. Instead, the request gets a subclass of the page schema (same
+# JSON schema, so the model sees the same request) whose model_validate_json
+# checks the response with a validator compiled once per page schema: TypedDicts
+# with the same fields and types, validated by pydantic-core while it parses the
+# JSON, without building models. response.parsed is then a plain dict, read
+# straight into columns. Models are only built for the error message when a
+# response does not validate.
+
+
+class PageDecoder:
+    """
+    Response schema and decoder of a page schema.
+
+    Parameters:
+        page_schema (type): Page schema (a PagesLib.Page model).
+        compact (bool): If True, responses use the compact schema of
+            page_schema (see compact.py) and are expanded while decoding.
+    """
+
+    def __init__(self, page_schema, compact=False):
+        self.page_schema = page_schema
+        self.wire = compact_schema(page_schema) if compact else None
+        wire_page = self.wire.page_model if compact else page_schema
+        wire_entry = self.wire.entry_model if compact else entry_model(page_schema)
+        entry_dict = TypedDict(f"{wire_entry.__name__}Dict", {
+            name: field.annotation
+            for name, field in wire_entry.model_fields.items()})
+        page_dict = TypedDict(f"{wire_page.__name__}Dict", {
+            name: list[entry_dict] if name == "entries" else field.annotation
+            for name, field in wire_page.model_fields.items()})
+        self.validator = TypeAdapter(page_dict)
+        self.wire_page = wire_page
+        self.response_schema = self._response_model()
+        # output column -> (key in the response, is page field, code -> value)
+        self.columns = {}
+        for column, field, is_page_field in page_columns(page_schema):
+            key, values = field, None
+            if compact and not is_page_field:
+                key = self.wire.entry_keys[field]
+                if field in self.wire.codes:
+                    values = {code: value for value, code
+                              in self.wire.codes[field].items()}
+            self.columns[column] = (key, is_page_field, values)
+
+    def _response_model(self):
+        """ Response schema for the request: the wire page model, whose
+            model_validate_json (called by the SDK to fill response.parsed)
+            returns the validated page as a dict."""
+        validate = self.validate
+
+        class DecodedPage(self.wire_page):
+            model_config = ConfigDict(title=self.wire_page.__name__)
+
+            @classmethod
+            def model_validate_json(cls, json_data, **kwargs):
+                with profiling.stage("validate_response"):
+                    return validate(json_data)
+
+        DecodedPage.__name__ = self.wire_page.__name__
+        return DecodedPage
+
+    def validate(self, data):
+        """
+        Validated page of a response.
+
+        Parameters:
+            data: Response text (JSON), or the response already loaded.
+
+        Returns:
+            dict: The page, with its entries as dicts (wire field names).
+
+        Raises:
+            pydantic.ValidationError: If the response does not match the schema.
+        """
+        if isinstance(data, (str, bytes)):
+            return self.validator.validate_json(data)
+        return self.validator.validate_python(data)
+
+    def to_dataframe(self, page):
+        """ page_to_dataframe of a validated page (see validate)."""
+        import pandas as pd  # imported here so that loading the schemas stays fast
+
+        with profiling.stage("page_to_dataframe"):
+            entries = page["entries"]
+            data = {}
+            for column, (key, is_page_field, values) in self.columns.items():
+                if is_page_field:
+                    data[column] = [page[key]] * len(entries)
+                elif values is not None:
+                    data[column] = [values.get(entry[key], entry[key])
+                                    for entry in entries]
+                else:
+                    data[column] = [entry[key] for entry in entries]
+            return pd.DataFrame(data)
+
+    def decode(self, data):
+        """
+        Page data of a response.
+
+        Parameters:
+            data: Response text (JSON), or the response already loaded.
+
+        Returns:
+            pd.DataFrame: Same as page_to_dataframe of the parsed page.
+
+        Raises:
+            pydantic.ValidationError: From the page model, if the response
+                does not match the schema.
+        """
+        try:
+            return self.to_dataframe(self.validate(data))
+        except ValidationError:
+            # the models give the detailed error (or, if they accept the
+            # response after all, the data)
+            parsed = (self.wire_page.model_validate_json(data)
+                      if isinstance(data, (str, bytes))
+                      else self.wire_page.model_validate(data))
+            if self.wire is not None:
+                parsed = self.wire.expand_page(parsed)
+            return page_to_dataframe(parsed)
+
+
+# Decoders by (page schema, compact)
+_DECODERS = {}
+
+
+def page_decoder(page_schema, compact=False):
+    """ The PageDecoder of a page schema (built once)."""
+    key = (page_schema, compact)
+    if key not in _DECODERS:
+        _DECODERS[key] = PageDecoder(page_schema, compact)
+    return _DECODERS[key]
@@ -1,109 +1,36 @@
 from pydantic import BaseModel
-from PyPDF2 import PdfReader, PdfWriter
 import tempfile
 import time
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed, Future
 import requests
 import os
 import pandas as pd
 from pdf2image import convert_from_path
 from PagesLib.Page import page_to_dataframe
+from PagesLib.document import check_pages, check_document, open_source
+from PagesLib.streaming import stream_generate
+from PagesLib.compact import compact_schema
+from PagesLib.decode import page_decoder
+from PagesLib import concurrency
+from PagesLib.shards import Shard, ShardPool
+from dedup import dedup_entries, dedup_csv
+import run_log
+import profiling
 # ------------------------------------------------------------------------------
 # -- Define functions ----------------------------------------------------------
 # ------------------------------------------------------------------------------
 
 
-def check_pages(file_path, page_N, page_window, placement="middle"):
-    """
-    Determine the appropriate start and end page for a given page window.
-
-    Parameters:
-        file_path (str): Path to the PDF file.
-        page_N (int): The target page number.
-        page_window (int): Number of pages to include in the window.
-        placement (str): Position of the target page within the window ('top', 'middle', 'bottom').
-
-    Returns:
-        tuple: (start_page, end_page) representing the range of selected pages.
-    """
-
-    with open(file_path, "rb") as file:
-        reader = PdfReader(file)
-        total_page_count = len(reader.pages)
-
-    # If the requested window is larger than the document, return the full document
-    if page_window >= total_page_count:
-        return 1, total_page_count  # Return the entire document
-
-    # Ensure page_N is within valid range
-    if page_N < 1 or page_N > total_page_count:
-        raise ValueError(
-            f"Page N ({page_N}) is out of document range (1-{total_page_count})"
-        )
-
-    # Determine the start page based on placement
-    if placement == "top":
-        start_page = page_N
-    elif placement == "middle":
-        start_page = page_N - (page_window // 2)
-    elif placement == "bottom":
-        start_page = page_N - (page_window - 1)
-    else:
-        raise ValueError(
-            "Invalid placement. Choose from 'top', 'middle', or 'bottom'.")
-    # Debugging
-
-    # Ensure the start_page and n_pages fit within the document range
-    if start_page < 1:
-        start_page = 1
-    if start_page + page_window - 1 > total_page_count:
-        start_page = max(1, total_page_count - page_window +
-                         1)  # Shift window left
-    # Final page count
-    n_pages = min(page_window, total_page_count - start_page + 1)
-
-    # get end page
-    end_page = start_page + n_pages - 1
-
-    return start_page, end_page
-
-
-def check_document(file_path, all_pages=False, start_page=1, n_pages=1):
-    """
-    Validate the requested page range against the document length.
-
-    Parameters:
-        file_path (str): Path to the PDF file.
-        all_pages (bool): If True, selects all pages.
-        start_page (int): First page number to extract.
-        n_pages (int): Number of pages to extract.
-
-    Returns:
-        tuple: (start_page, n_pages) after validation.
-    """
-
-    with open(file_path, "rb") as file:
-        reader = PdfReader(file)
-        total_page_count = len(reader.pages)
-
-    if all_pages:
-        start_page = 1
-        n_pages = total_page_count
-
-    else:
-        if total_page_count < (start_page + (n_pages - 1)):
-            raise Exception((
-                "Total pages requested exceeds document length!",
-                f"   Requested pages {start_page} to {start_page + (n_pages - 1)}",
-                f"but document only has {total_page_count} pages"))
-
-    return start_page, n_pages
-
-
 def upload_pages_to_API(genai_client,
                         file_path: str,
                         start_page: int,
                         end_page: int,
-                        png=False):
+                        png=False,
+                        existing_files=None,
+                        reserve=None,
+                        run_tag=None):
     """
 Uploads selected pages of a PDF (or PNG if requested) to the Gemini API.
 
@@ -113,111 +40,234 @@ Parameters:
     start_page (int): Starting page number.
     end_page (int): Ending page number.
     png (bool): If True, converts the page to PNG format.
+    existing_files (dict): Display name -> file already in the File API (if
+        not given, the File API is listed).
+    reserve (callable): Called with the size in bytes before uploading (may
+        wait for storage, see uploads.UploadManager).
+    run_tag (str): Tag of the run, added to the display name so that runs
+        sharing a project only reuse their own uploads.
 
 Returns:
     object: Uploaded file object from the Gemini API.
 """
-    file_name = f"{start_page}-{end_page}__{file_path.split('/')[-1].split('.')[0]}"
+    file_name = upload_display_name(file_path, start_page, end_page, png,
+                                    run_tag)
 
-    if png and start_page == end_page:
-        file_name = file_name + "_png"
     # Check if file already exists in the File API
-    existing_files = genai_client.files.list()  # Get list of uploaded files
-    uploaded_file = None
-    for f in existing_files:
-        if f.display_name == file_name:
-            uploaded_file = f
-            print(
-                f"    File '{file_name}' already exists in the File API. Skipping upload."
-            )
-            break
+    if existing_files is not None:
+        uploaded_file = existing_files.get(file_name)
+    else:
+        uploaded_file = None
+        for f in genai_client.files.list():  # Get list of uploaded files
+            if f.display_name == file_name:
+                uploaded_file = f
+                break
+    if uploaded_file:
+        run_log.current().debug(
+            f"File '{file_name}' already exists in the File API. Skipping upload.",
+            stage="upload", page=start_page)
+        return uploaded_file
 
     # Upload file  (only if it has not already been uploaded) ---------------
 
     # Create a temporary file ----
-    temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
-    temp_path = temp_file.name
-    temp_file.close()  # Close the file so PyPDF2 can write to it
-
     if png and start_page == end_page:
-        images = convert_from_path(file_path,
-                                   first_page=start_page,
-                                   last_page=end_page)
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".png")
-        temp_path = temp_file.name
-        temp_file.close()
-        images[0].save(temp_path, 'PNG')
+        with profiling.stage("rasterize", page=start_page):
+            images = convert_from_path(file_path,
+                                       first_page=start_page,
+                                       last_page=end_page)
+            temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".png")
+            temp_path = temp_file.name
+            temp_file.close()
+            images[0].save(temp_path, 'PNG')
     else:
-        reader = PdfReader(file_path)
-        writer = PdfWriter()
-        for i in range(start_page - 1,
-                       end_page):  # Convert 1-based to 0-based index
-            writer.add_page(reader.pages[i])
-        with open(temp_path, "wb") as output:
-            writer.write(output)
+        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
+        temp_path = temp_file.name
+        temp_file.close()  # Close the file so PyPDF2 can write to it
+        # pages are read from the open document file (see document.py)
+        with profiling.stage("split_pdf", page=start_page):
+            open_source(file_path).write_pages(start_page, end_page, temp_path)
 
     # Upload the file to the File API ---
-    if not uploaded_file:
-        print(f"    Uploading file: {file_name}")
-        uploaded_file = genai_client.files.upload(
-            file=temp_path, config={'display_name': file_name})
-
-    # delete tmp file after it's uploaded
-    os.remove(temp_path)
+    try:
+        if reserve is not None:
+            reserve(os.path.getsize(temp_path))
+        run_log.current().debug(f"Uploading file: {file_name}",
+                                stage="upload", page=start_page)
+        with profiling.stage("upload", page=start_page):
+            uploaded_file = genai_client.files.upload(
+                file=temp_path, config={'display_name': file_name})
+    finally:
+        # delete tmp file after it's uploaded
+        os.remove(temp_path)
 
     return uploaded_file
 
 
+def upload_display_name(file_path, start_page, end_page, png=False,
+                        run_tag=None):
+    """ Display name of the uploaded pages in the File API (ending with
+        "__{run_tag}" if given)."""
+    file_name = f"{start_page}-{end_page}__{file_path.split('/')[-1].split('.')[0]}"
+    if png and start_page == end_page:
+        file_name = file_name + "_png"
+    if run_tag:
+        file_name = f"{file_name}__{run_tag}"
+    return file_name
+
+
+def add_usage(usage, response):
+    """
+    Add the token counts of a Gemini API response to a usage dict.
+
+    Parameters:
+        usage (dict): Running totals with "input_tokens", "output_tokens" and "requests".
+        response: Gemini API response.
+    """
+    metadata = getattr(response, "usage_metadata", None)
+    usage["requests"] = usage.get("requests", 0) + 1
+    if metadata is None:
+        return
+    usage["input_tokens"] = usage.get(
+        "input_tokens", 0) + (metadata.prompt_token_count or 0)
+    usage["output_tokens"] = usage.get(
+        "output_tokens", 0) + (metadata.candidates_token_count or 0)
+
+
 def extract_page_data(genai_client,
                       input_file,
                       model: BaseModel,
                       prompt_text: str,
                       model_id="gemini-2.5-pro",
-                      debug=False):
+                      debug=False,
+                      usage=None,
+                      page=None,
+                      hedge=None,
+                      stream=False,
+                      on_entry=None,
+                      compact=False,
+                      on_response=None,
+                      controller=None,
+                      can_fail_over=None,
+                      fast_decode=False):
     """
 Extracts structured data from a page using the Gemini API.
 
 Parameters:
     genai_client: Gemini API client.
-    input_file: File object uploaded to the Gemini API.
+    input_file: File object uploaded to the Gemini API, or a list of them
+        (one per page, in page order).
     model (BaseModel): Data model for structuring extracted content.
     prompt_text (str): Prompt text for the API.
     model_id (str): Gemini model ID.
     debug (bool): Enables debug logging.
+    usage (dict): If given, input/output token counts are added to it.
+    page (int): Target page number, for logging.
+    hedge (HedgePolicy): If given, slow requests are hedged (see hedging.py).
+    stream (bool): If True, uses the streaming API and parses the entries as
+        they arrive (see streaming.py); a truncated response keeps its
+        complete entries. Requests are not hedged when streaming.
+    on_entry (callable): With stream, called with (index, entry) for each
+        entry as soon as it is complete.
+    compact (bool): If True, the response uses the compact schema of model
+        (short keys and codes, see compact.py) and is expanded back to model.
+    on_response (callable): Called with the text of the response (before it
+        is parsed), e.g. to keep the raw response.
+    controller (AIMDController): Limits the requests in flight (defaults to
+        the model's shared controller, see concurrency.py).
+    can_fail_over (callable): Called when an overload error opens the
+        controller's circuit; if it returns True, EndpointUnavailable is
+        raised instead of waiting, so the page can move to another API key.
+    fast_decode (bool): If True (and not stream), the response is validated
+        and decoded straight to the page's DataFrame (see decode.py) instead
+        of building a model for the page and every entry.
 
 Returns:
-    dict or None: Parsed structured data if successful, otherwise None.
+    Parsed structured data if successful (with fast_decode, the DataFrame of
+    page_to_dataframe), otherwise None.
 """
     # limit output size
     max_token_output = 80000
     max_retries = 7
     base_wait = 10  # this is in seconds!
+    max_wait = 300  # longest single wait (waits are jittered, see backoff_delay)
+
+    log = run_log.current()
+    # limits the requests in flight to the model (shared by all pages and runs)
+    if controller is None:
+        controller = concurrency.controller_for(model_id)
+    input_files = input_file if isinstance(input_file,
+                                           (list, tuple)) else [input_file]
+    # schema of the response (the compact one is expanded back to model)
+    wire = compact_schema(model) if compact else None
+    response_schema = wire.page_model if compact else model
+    decoder = None
+    if fast_decode and not stream:
+        decoder = page_decoder(model, compact)
+    if compact and on_entry is not None:
+        entry_callback = on_entry
+
+        def on_entry(index, entry):
+            entry_callback(index, wire.expand_entry(entry))
 
     for attempt in range(max_retries):
-        print(f"      Attempt {attempt + 1} to extract data...")
+        log.debug(f"Attempt {attempt + 1} to extract data...",
+                  stage="extract", page=page)
         try:
             # Generate a structured response using the Gemini API ---
-            response = genai_client.models.generate_content(
-                model=model_id,
-                contents=[prompt_text, input_file],
-                config={
-                    'response_mime_type': 'application/json',
-                    'response_schema': model,
-                    'max_output_tokens': max_token_output
-                })
+            contents = [prompt_text, *input_files]
+            generation_config = {
+                'response_mime_type': 'application/json',
+                'response_schema': decoder.response_schema
+                if decoder is not None else response_schema,
+                'max_output_tokens': max_token_output
+            }
+
+            def request():
+                return genai_client.models.generate_content(
+                    model=model_id,
+                    contents=contents,
+                    config=generation_config)
+
+            if not controller.acquire(give_up=can_fail_over):
+                raise concurrency.EndpointUnavailable(
+                    f"requests to {model_id} are paused")
+            outcome = "error"
+            try:
+                # (the SDK parses the response within the request)
+                with profiling.stage("api_request", page=page):
+                    if stream:
+                        response = stream_generate(
+                            genai_client, model_id, contents, generation_config,
+                            response_schema, on_entry=on_entry, page=page)
+                    elif hedge is not None:
+                        response = hedge.call(
+                            request, model_id, page=page,
+                            on_extra=(lambda extra: add_usage(usage, extra))
+                            if usage is not None else None)
+                    else:
+                        response = request()
+                outcome = "ok"
+            except Exception as e:
+                if concurrency.is_overload(e):
+                    outcome = "overload"
+                raise
+            finally:
+                controller.release(outcome)
 
             # print("API Response:", response)  # Debugging step
             # print(" Response Usage Metadata:", response.usage_metadata)
+            if usage is not None:
+                add_usage(usage, response)
+            if on_response is not None and response:
+                on_response(getattr(response, "text", None))
 
             # Added: Check for token limit issues
             if hasattr(response, 'candidates') and response.candidates:
                 if response.candidates[0].finish_reason.name == 'MAX_TOKENS':
-                    print(
-                        f"WARNING: Response truncated due to token limit. Consider increasing max_output_tokens or splitting the page."
-                    )
-                    print(
-                        f"Token count: {response.usage_metadata.candidates_token_count}"
-                    )
+                    log.warning(
+                        f"Response truncated due to token limit. Consider increasing max_output_tokens or splitting the page. Token count: {response.usage_metadata.candidates_token_count}",
+                        stage="extract", page=page)
 
             if debug:
                 file_path = "output.txt"
@@ -229,29 +279,168 @@ Returns:
                             f"Line {i + 1}: This is some text being written.\n"
                         )
 
+            if decoder is not None and response and \
+                    response.parsed is None and response.text:
+                # the SDK drops validation errors: decoding the text again
+                # raises the page model's detailed error
+                return decoder.decode(response.text)
             if not response or not response.parsed:
-                print("ERROR: The API did not return a valid parsed response.")
+                log.error("The API did not return a valid parsed response.",
+                          stage="extract", page=page)
                 return None
 
+            if decoder is not None:
+                return decoder.to_dataframe(response.parsed)
+            if compact:
+                with profiling.stage("expand_compact", page=page):
+                    return wire.expand_page(response.parsed)
             return response.parsed
 
-        # Add in a wait time response if the model is temporarily unavailable (error 503)
-        # TODO: add wait time to handle rate limit errors
+        # Wait and retry if the model is temporarily unavailable or rate
+        # limited (503/429/timeouts); the wait is jittered
+        except concurrency.EndpointUnavailable:
+            raise
         except Exception as e:
-            if '503' in str(e):
-                wait_time = base_wait * (2**attempt)
-                print(
-                    f"Error 503 on attempt {attempt + 1}. Retrying in {wait_time:.1f}s..."
-                )
+            if concurrency.is_overload(e):
+                if can_fail_over is not None and \
+                        controller.open_until > time.time() and can_fail_over():
+                    raise concurrency.EndpointUnavailable(str(e)) from e
+                wait_time = concurrency.backoff_delay(attempt, base=base_wait,
+                                                      cap=max_wait)
+                log.warning(
+                    f"Endpoint overloaded on attempt {attempt + 1} ({e}). Retrying in {wait_time:.1f}s...",
+                    stage="extract", page=page)
                 time.sleep(wait_time)
             else:
-                print(f"EXCEPTION occurred (non-retryable): {e}")
+                log.error(f"EXCEPTION occurred (non-retryable): {e}",
+                          stage="extract", page=page)
                 return None
 
-    print("Max 503 error retries reached. Giving up on this page.")
+    log.error("Max overload retries reached. Giving up on this page.",
+              stage="extract", page=page)
     return None
 
 
+def write_partial_entry(partial_path, index, entry):
+    """
+    Append a streamed entry to a page's .jsonl of partial results.
+
+    Parameters:
+        partial_path (str): Path to the .jsonl file.
+        index (int): Index of the entry in the response (0 starts a new file,
+            since it is a new attempt).
+        entry (BaseModel): Validated entry.
+    """
+    with open(partial_path, "w" if index == 0 else "a",
+              encoding="utf-8") as file:
+        file.write(entry.model_dump_json() + "\n")
+
+
+def upload_window(genai_client, file_path, first_pg, last_pg, uploaded_pages,
+                  png=False, upload_cache=None, uploads=None, lock=None):
+    """
+    Uploads each page of a window as its own file, unless it is already uploaded.
+
+    Threads sharing uploaded_pages only hold the lock to claim the pages to
+    upload (a Future per page); the uploads themselves run outside of it, so
+    the windows of different pages upload concurrently, and a page being
+    uploaded by another thread is waited for instead of uploaded twice.
+
+    Parameters:
+        genai_client: Gemini API client.
+        file_path (str): Path to the input PDF file.
+        first_pg (int): First page of the window.
+        last_pg (int): Last page of the window.
+        uploaded_pages (dict): Page number -> Future of the uploaded file,
+            updated in place.
+        png (bool): If True, converts the pages to PNG format.
+        upload_cache (UploadCache): If given, pages are taken from this cache.
+        uploads (UploadManager): If given, pages are uploaded through it.
+        lock (threading.Lock): Lock of uploaded_pages, if shared by threads.
+
+    Returns:
+        list: Uploaded file objects of the window, in page order.
+    """
+    lock = lock or threading.Lock()
+    claimed = []
+    with lock:
+        for pg in range(first_pg, last_pg + 1):
+            if pg not in uploaded_pages:
+                uploaded_pages[pg] = Future()
+                claimed.append(pg)
+        futures = [uploaded_pages[pg] for pg in range(first_pg, last_pg + 1)]
+
+    for pg in claimed:
+        future = futures[pg - first_pg]
+        try:
+            if upload_cache is not None:
+                uploaded_file = upload_cache.get(genai_client, file_path,
+                                                 pg, pg, png=png)
+            elif uploads is not None:
+                uploaded_file = uploads.upload(file_path, pg, pg, png=png)
+            else:
+                uploaded_file = upload_pages_to_API(genai_client, file_path,
+                                                    pg, pg, png=png)
+        except BaseException as e:
+            # (the next attempt uploads the page again)
+            with lock:
+                if uploaded_pages.get(pg) is future:
+                    del uploaded_pages[pg]
+            future.set_exception(e)
+            raise
+        future.set_result(uploaded_file)
+    return [future.result() for future in futures]
+
+
+def release_file(genai_client, uploaded_file, uploads=None, page=None):
+    """
+    Deletes an uploaded file (or hands it to the upload manager to delete).
+
+    Parameters:
+        genai_client: Gemini API client.
+        uploaded_file: File object uploaded to the Gemini API.
+        uploads (UploadManager): If given, the file is released to it.
+        page (int): Page number, for logging.
+    """
+    if uploads is not None:
+        uploads.release(uploaded_file)
+        return
+    try:
+        genai_client.files.delete(name=uploaded_file.name)
+        run_log.current().debug(f"Deleted uploaded file: {uploaded_file.name}",
+                                stage="release", page=page)
+    except Exception as e:
+        run_log.current().warning(
+            f"Failed to delete uploaded file {uploaded_file.name}: {e}",
+            stage="release", page=page)
+
+
+def release_pages(genai_client, uploaded_pages, keep_from, uploads=None,
+                  lock=None):
+    """
+    Deletes the uploaded pages that no pending window needs.
+
+    Parameters:
+        genai_client: Gemini API client.
+        uploaded_pages (dict): Page number -> Future of the uploaded file (see
+            upload_window), updated in place.
+        keep_from (int): First page still needed (pages before it are deleted).
+        uploads (UploadManager): If given, the pages are released to it.
+        lock (threading.Lock): Lock of uploaded_pages, if shared by threads
+            (only held to remove the pages, not during the deletions).
+    """
+    def release(future, pg):
+        if future.exception() is None:  # (a failed upload left no file)
+            release_file(genai_client, future.result(), uploads, page=pg)
+
+    with lock or threading.Lock():
+        released = {pg: uploaded_pages.pop(pg) for pg in sorted(uploaded_pages)
+                    if pg < keep_from}
+    for pg, future in released.items():
+        # (once uploaded, if the upload is still in progress)
+        future.add_done_callback(lambda future, pg=pg: release(future, pg))
+
+
 def process_pages(genai_client,
                   file_path: str,
                   model: BaseModel,
@@ -264,7 +453,22 @@ def process_pages(genai_client,
                   page_window=1,
                   page_placement="middle",
                   png=False,
-                  debug=False):
+                  debug=False,
+                  usage=None,
+                  page_status=None,
+                  shared_uploads=True,
+                  upload_cache=None,
+                  hedge=None,
+                  stream=False,
+                  uploads=None,
+                  max_concurrency=1,
+                  low_memory=False,
+                  dedup=True,
+                  compact=False,
+                  store=None,
+                  shards=None,
+                  fast_decode=False,
+                  quality=None):
     """
     Extracts structured data from each page in the document and saves results.
 
@@ -282,20 +486,117 @@ def process_pages(genai_client,
         page_placement (str): Placement of the target page within the window.
         png (bool): If True, converts pages to PNG before upload.
         debug (bool): Enables debug logging.
+        usage (dict): If given, input/output token counts are added to it.
+        page_status (dict): Prescan results (see prescan.prescan_pages). Blank
+            pages are skipped and duplicate pages reuse the earlier page's data.
+        shared_uploads (bool): If True and page_window > 1, each page is uploaded
+            once as its own file and shared by all the windows that contain it.
+        upload_cache (UploadCache): If given, uploads are taken from this cache
+            (shared with other runs) and left for the cache to delete.
+        hedge (HedgePolicy): If given, slow requests are hedged (see hedging.py).
+        stream (bool): If True, responses are streamed: entries are appended to
+            pg{N}.partial.jsonl in intermediate_dir as they arrive (removed
+            once the page is written), and truncated responses keep their
+            complete entries.
+        uploads (UploadManager): If given, uploads go through it (storage
+            quota, manifest and background deletion, see uploads.py).
+        max_concurrency (int): Maximum number of pages processed at the same
+            time. The requests actually in flight adapt to 503/429 errors
+            (see concurrency.py); results are still written in page order.
+        low_memory (bool): If True, memory does not grow with the document:
+            each page's data is appended to outfile_path as soon as it is
+            written (instead of keeping every page to write at the end),
+            duplicate pages are read back from their pg{N}.csv (or from the
+            store), and fewer pages are processed ahead.
+        dedup (bool): If True, entries extracted more than once (overlapping
+            windows, duplicate pages, reruns) are merged in the final output,
+            with the provenance columns n_extractions and source_pages (see
+            dedup.py). With low_memory, only entries extracted within
+            page_window pages of each other are merged.
+        compact (bool): If True, responses use the compact schema of model
+            (short keys and codes, see compact.py), to save output tokens.
+        store (ResultsStore): If given, each page's data, status and raw
+            response are written to the results database (see results_db.py)
+            instead of pg{N}.csv files in intermediate_dir.
+        shards (ShardPool): If given, pages are spread across several API
+            keys (see shards.py) and genai_client, upload_cache and uploads
+            are not used; the rows get the name of their key in a "shard"
+            column.
+        fast_decode (bool): If True, responses are decoded straight to
+            columns (see decode.py) rather than through response.parsed.
+        quality (QualityGate): If given, its probe pages (pages with ground
+            truth and a sample across the document, see quality.py) are
+            processed first and scored as they finish. If the run fails the
+            quality check, its other pages are skipped (action "abort") or
+            processed one at a time ("deprioritize").
 
     Returns:
-        pd.DataFrame: Aggregated structured data extracted from the document.
+        pd.DataFrame: Aggregated structured data extracted from the document
+        (None with low_memory, the data is only saved to outfile_path).
     """
     # TODO: add handling if there are errors for one page but not other pages
     # include a print and a log of failed pages
 
+    log = run_log.current()
     all_dataframes = []
+    page_dataframes = {}  # page number -> extracted data, for duplicate pages
+    shared_uploads = shared_uploads and page_window > 1
+    if shards is None:
+        shards = ShardPool([Shard(None, genai_client, uploads, upload_cache)])
+    # shard name -> {page number -> Future of the uploaded file}, when
+    # shared_uploads
+    uploaded_pages = {shard.name: {} for shard in shards}
+    # uploaded_pages is shared by the page threads (held to claim or release
+    # pages, not during uploads)
+    upload_lock = threading.Lock()
+    end_page = start_page + total_pages - 1
+    # pages processed ahead of the page being written
+    max_ahead = max_concurrency if low_memory else 2 * max_concurrency
+    n_rows = 0
+    # with low_memory, the output is built in a temporary file and renamed at
+    # the end (like the final write below, a failed run leaves no output)
+    partial_outfile = outfile_path + ".part"
+    if low_memory and os.path.exists(partial_outfile):
+        os.remove(partial_outfile)
     max_retries = 5  # Set max retries to prevent infinite loops
-    # check if all
-    for N in range(start_page, (start_page + total_pages)):
-        # recall, last number excluded in python range
+
+    def page_state(N):
+        """ "blank", "duplicate" or None (page to send to the API)."""
+        status = page_status.get(N) if page_status else None
+        if status and status["status"] in ("blank", "duplicate"):
+            return status["status"]
+        return None
+
+    def extract_page(N):
+        """ Upload page N (with its window) and extract its data, on the
+            shard with the most free requests (on another one if its key
+            becomes unavailable).
+
+        Returns:
+            (pd.DataFrame or None, str or None): Data of the page (None if no
+            data found) and the raw response text.
+        """
+        tried = []
+        while True:
+            shard = shards.pick(model_id, exclude=tried)
+            try:
+                with profiling.stage("extract_page", page=N):
+                    return extract_page_on(N, shard, lambda: shards.can_fail_over(
+                        model_id, shard, tried))
+            except concurrency.EndpointUnavailable as e:
+                log.warning(f"API key {shard.name} unavailable ({e}), "
+                            "moving the page to another key",
+                            stage="process", page=N)
+                tried.append(shard.name)
+            finally:
+                shards.done(shard)
+
+    def extract_page_on(N, shard, can_fail_over):
+        """ extract_page on one shard (uploads and requests with its key)."""
         retries = 0
         success = False  # Track if the page was successfully processed
+        df = None
+        response = {}  # raw response text, kept for the results store
 
         # get subset of document pages to upload, based on page_window
         first_pg, last_pg = check_pages(file_path, N, page_window,
@@ -310,70 +611,271 @@ def process_pages(genai_client,
         # prompt = prompt.replace("PAGE_PLACEMENT", str(page_N_placement))
         # # print(prompt)  # DEBUGGING
 
-        while retries < max_retries and not success:
-            try:
-                print(f"Processing page {N} (Attempt {retries + 1})...")
-
-                # get uploaded pages
-                uploaded_file = upload_pages_to_API(genai_client,
-                                                    file_path,
-                                                    first_pg,
-                                                    last_pg,
-                                                    png=png)
-                # submit Gemini task prompt
-                result = extract_page_data(genai_client, uploaded_file, model,
-                                           prompt, model_id, debug)
-                success = True
-                if result:
-                    df = page_to_dataframe(result)
-                    # add model ID
-                    df["model_id"] = model_id
-                    # Add absolute page number
-                    df["absolute_page_n"] = N
-
-                    # Immediately delete the uploaded file so I don't reach the storage limit
-                    try:
-                        genai_client.files.delete(name=uploaded_file.name)
-                        print(f"Deleted uploaded file: {uploaded_file.name}")
-                    except Exception as e:
-                        print(
-                            f"Warning: failed to delete uploaded file {uploaded_file.name}: {e}"
-                        )
-
-                else:
-                    print(f"FAILURE - No data found for for page {N}.")
-
-            except requests.exceptions.ConnectionError as e:
-                print(f"Connection error on page {N}: {e}")
-                retries += 1
-                if retries < max_retries:
-                    print(f"Retrying page {N} in 5 seconds...")
-                    time.sleep(5)  # Wait before retrying
-                else:
-                    raise ValueError(
-                        f"Max retries reached for page {N}. Check your connection and try again"
-                    )
-            # TODO: add error handling for other errors
-            # (EXCEPTION occurred (non-retryable): 429 RESOURCE_EXHAUSTED. {'error': {'code': 429, 'message': 'Resource exhausted. Please try again later. Please refer to https://cloud.google.com/vertex-ai/generative-ai/docs/error-code-429 for more details.', 'status': 'RESOURCE_EXHAUSTED'}}
-
-        # Combine all output into one dataset
-            all_dataframes.append(df)
-
-            # write output to .csv file
-            intermed_path = os.path.join(
-                intermediate_dir, f"pg{N}.csv")
-            df.to_csv(intermed_path,
-                      mode="a",
-                      header=True,
-                      index=False)
-            print(f"  Saved intermediate results to {intermed_path}\n")
+        page_upload = None  # this page's own upload, deleted after the page
+        partial_path = os.path.join(intermediate_dir, f"pg{N}.partial.jsonl")
 
+        try:
+            while retries < max_retries and not success:
+                try:
+                    log.info(f"Processing page (Attempt {retries + 1})...",
+                             stage="process", page=N)
+
+                    # get uploaded pages
+                    if shared_uploads:
+                        uploaded_file = upload_window(
+                            shard.client, file_path, first_pg, last_pg,
+                            uploaded_pages[shard.name], png=png,
+                            upload_cache=shard.upload_cache,
+                            uploads=shard.uploads, lock=upload_lock)
+                    elif shard.upload_cache is not None:
+                        uploaded_file = shard.upload_cache.get(
+                            shard.client, file_path, first_pg, last_pg, png=png)
+                    elif shard.uploads is not None:
+                        uploaded_file = page_upload = shard.uploads.upload(
+                            file_path, first_pg, last_pg, png=png)
+                    else:
+                        uploaded_file = page_upload = upload_pages_to_API(
+                            shard.client, file_path, first_pg, last_pg, png=png)
+                    # submit Gemini task prompt
+                    result = extract_page_data(
+                        shard.client, uploaded_file, model, prompt, model_id,
+                        debug, usage, page=N, hedge=hedge, stream=stream,
+                        on_entry=lambda i, entry: write_partial_entry(
+                            partial_path, i, entry), compact=compact,
+                        on_response=lambda text: response.update(text=text),
+                        controller=shard.controller(model_id),
+                        can_fail_over=can_fail_over if len(shards) > 1 else None,
+                        fast_decode=fast_decode)
+                    success = True
+                    if result is not None:
+                        df = result if isinstance(result, pd.DataFrame) \
+                            else page_to_dataframe(result)
+                        # add model ID
+                        df["model_id"] = model_id
+                        # Add absolute page number
+                        df["absolute_page_n"] = N
+                        # tag the rows with the API key that produced them
+                        if shard.name is not None:
+                            df["shard"] = shard.name
+
+                    else:
+                        log.warning("FAILURE - No data found for page.",
+                                    stage="process", page=N)
+
+                except requests.exceptions.ConnectionError as e:
+                    log.warning(f"Connection error: {e}", stage="process", page=N)
+                    retries += 1
+                    if retries < max_retries:
+                        wait_time = concurrency.backoff_delay(retries, base=5,
+                                                              cap=60)
+                        log.info(f"Retrying page in {wait_time:.1f} seconds...",
+                                 stage="process", page=N)
+                        time.sleep(wait_time)  # Wait before retrying
+                    else:
+                        raise ValueError(
+                            f"Max retries reached for page {N}. Check your connection and try again"
+                        )
+        finally:
+            # Immediately delete the page's upload so I don't reach the storage
+            # limit, whether or not data was found (shared page uploads are
+            # released once the next window does not need them)
+            if page_upload is not None:
+                release_file(shard.client, page_upload, shard.uploads, page=N)
+        return df, response.get("text")
+
+    # pages sent to the API are processed ahead by a thread pool (in page
+    # order); results are collected in page order below
+    pool = (ThreadPoolExecutor(max_workers=max_concurrency,
+                               thread_name_prefix="page")
+            if max_concurrency > 1 else None)
+    pending = {}  # page number -> future of extract_page
+    probed = {}  # page number -> extract_page result, for the probe pages
+    probes = []
+    if quality is not None:
+        probes = [N for N in quality.probe_pages(range(start_page, end_page + 1))
+                  if page_state(N) is None]
+
+    def probe_results():
+        """ (page number, extract_page result) of the probe pages, as they
+            finish."""
+        if pool is None:
+            for N in probes:
+                yield N, extract_page(N)
+            return
+        futures = {pool.submit(contextvars.copy_context().run, extract_page,
+                               N): N for N in probes}
+        try:
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        finally:
+            for future in futures:
+                future.cancel()  # pages not started when the run is aborted
+
+    try:
+        # process the probe pages first, scoring the run as they finish
+        if probes:
+            log.info(f"Processing {len(probes)} probe pages first: {probes}",
+                     stage="quality")
+            results = probe_results()
+            for N, result in results:
+                probed[N] = result
+                quality.add_page(result[0], N)
+                log.info(quality.summary(), stage="quality", page=N)
+                if quality.failed and quality.action == "abort":
+                    results.close()
+                    break
+            if quality.failed:
+                log.warning(
+                    f"Run failed the quality check ({quality.summary()}); "
+                    + ("skipping the other pages" if quality.action == "abort"
+                       else "processing the other pages one at a time"),
+                    stage="quality")
+                max_ahead = 1
+            elif quality.verdict is None:
+                log.warning("Too few hand-coded entries on the probe pages to "
+                            f"check the run's quality ({quality.summary()})",
+                            stage="quality")
+        aborted = quality is not None and quality.failed and \
+            quality.action == "abort"
+        api_pages = iter([N for N in range(start_page, end_page + 1)
+                          if page_state(N) is None and N not in probed and
+                          not aborted])
+
+        for N in range(start_page, end_page + 1):
+            # keep the pool busy with the next pages
+            while pool is not None and len(pending) < max_ahead:
+                next_N = next(api_pages, None)
+                if next_N is None:
+                    break
+                # (in this run's context, so the page logs to the run's logger)
+                pending[next_N] = pool.submit(
+                    contextvars.copy_context().run, extract_page, next_N)
+
+            # skip blank pages and reuse the data of duplicate pages
+            state = page_state(N)
+            if state == "blank":
+                log.info("Skipping blank page.", stage="prescan", page=N)
+                if store is not None:
+                    store.write_page(N, status="blank")
+                log.progress(N - start_page + 1, total_pages)
+                continue
+            duplicate_of = page_status[N]["duplicate_of"] \
+                if state == "duplicate" else None
+            duplicate_path = os.path.join(intermediate_dir,
+                                          f"pg{duplicate_of}.csv")
+            response = None
+            if low_memory and store is not None and state == "duplicate":
+                df = store.page_data(duplicate_of)
+            elif duplicate_of in page_dataframes:
+                df = page_dataframes[duplicate_of].copy()
+            elif low_memory and os.path.exists(duplicate_path):
+                df = pd.read_csv(duplicate_path)
+            else:
+                df = None
+            if df is not None:
+                log.warning(f"Duplicates page {duplicate_of}, reusing its data.",
+                            stage="prescan", page=N)
+                df["absolute_page_n"] = N
+            elif N in probed:
+                df, response = probed.pop(N)
+            elif aborted:
+                log.info("Skipping page (the run failed the quality check).",
+                         stage="quality", page=N)
+                if store is not None:
+                    store.write_page(N, status="skipped")
+                log.progress(N - start_page + 1, total_pages)
+                continue
+            elif N in pending:
+                df, response = pending.pop(N).result()
+            else:
+                df, response = extract_page(N)
+
+            # release shared page uploads that the next window does not need
+            if shared_uploads:
+                next_first_pg = (check_pages(file_path, N + 1, page_window,
+                                             page_placement)[0]
+                                 if N < end_page else end_page + page_window)
+                for shard in shards:
+                    if shard.upload_cache is None:
+                        release_pages(shard.client, uploaded_pages[shard.name],
+                                      next_first_pg, shard.uploads,
+                                      lock=upload_lock)
+
+            log.progress(N - start_page + 1, total_pages)
+
+            if store is not None:
+                with profiling.stage("store_page", page=N):
+                    store.write_page(N, df, status=(
+                        "no_data" if df is None else
+                        "duplicate" if response is None and state == "duplicate"
+                        else "ok"), response=response,
+                        duplicate_of=duplicate_of)
+            if df is None:
+                continue
+
+            # Combine all output into one dataset
+            n_rows += df.shape[0]
+            if low_memory:
+                with profiling.stage("write_csv", page=N):
+                    df.to_csv(partial_outfile, mode="a", index=False,
+                              header=not os.path.exists(partial_outfile))
+            else:
+                all_dataframes.append(df)
+                page_dataframes[N] = df
+
+            # write output to .csv file (unless the results store has it)
+            if store is None:
+                intermed_path = os.path.join(
+                    intermediate_dir, f"pg{N}.csv")
+                with profiling.stage("write_csv", page=N):
+                    df.to_csv(intermed_path,
+                              mode="a",
+                              header=True,
+                              index=False)
+                log.debug(f"Saved intermediate results to {intermed_path}",
+                          stage="write", page=N)
+            partial_path = os.path.join(intermediate_dir, f"pg{N}.partial.jsonl")
+            if stream and os.path.exists(partial_path):
+                os.remove(partial_path)
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    if shared_uploads:
+        for shard in shards:
+            if shard.upload_cache is None:
+                release_pages(shard.client, uploaded_pages[shard.name],
+                              end_page + 1, shard.uploads)
+
+    if low_memory:
+        if not n_rows:
+            return None
+        if dedup:
+            # (keys are dropped once their pages leave the page window, and
+            # the rows are read back in small chunks)
+            with profiling.stage("dedup"):
+                n_rows = dedup_csv(partial_outfile, outfile_path,
+                                   chunksize=5_000, window=page_window)
+            os.remove(partial_outfile)
+        else:
+            os.replace(partial_outfile, outfile_path)
+        log.info(f"Saved final output ({n_rows} rows) to {outfile_path}",
+                 stage="write")
+        return None
     if all_dataframes:
         final_dataframe = pd.concat(all_dataframes, ignore_index=True)
-        print(f"\n Generated dataframe with {final_dataframe.shape[0]} rows")
-        final_dataframe.to_csv(outfile_path,
-                               index=False)  # overwrite with full data
-        print(f"  Saved final output to {outfile_path}\n")
+        if dedup:
+            n_extracted = final_dataframe.shape[0]
+            with profiling.stage("dedup"):
+                final_dataframe = dedup_entries(final_dataframe)
+            log.info(f"Merged {n_extracted - final_dataframe.shape[0]} entries "
+                     "extracted more than once", stage="write")
+        log.info(f"Generated dataframe with {final_dataframe.shape[0]} rows",
+                 stage="write")
+        with profiling.stage("write_output"):
+            final_dataframe.to_csv(outfile_path,
+                                   index=False)  # overwrite with full data
+        log.info(f"Saved final output to {outfile_path}", stage="write")
         return final_dataframe
     else:
         return None
@@ -0,0 +1,168 @@
+import os
+import threading
+from PyPDF2 import PdfReader, PdfWriter
+
+# ------------------------------------------------------------------------------
+# -- Define classes ------------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+
+class PdfSource:
+    """
+    Lazy page access to a PDF.
+
+    PdfReader(file_path) reads the whole file into memory, which for a
+    multi-gigabyte scan is the whole scan, once per call. Here the reader
+    reads from the open file only the objects it needs, the cross-reference
+    table is parsed once, and the objects of the pages that were written are
+    released afterwards, so memory does not grow with the number of pages
+    processed. (A memory-mapped file was tried, but the OS maps the file
+    around each object read, so memory grew with the scan.)
+
+    Parameters:
+        file_path (str): Path to the PDF file.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self._file = open(file_path, "rb")
+        self._reader = PdfReader(self._file)
+        self.page_count = len(self._reader.pages)
+        self._lock = threading.Lock()  # the reader is not thread safe
+
+    def write_pages(self, start_page, end_page, out_path):
+        """
+        Write pages start_page to end_page (1-based, inclusive) to a new PDF.
+
+        Parameters:
+            start_page (int): First page.
+            end_page (int): Last page.
+            out_path (str): Path of the PDF to write.
+        """
+        with self._lock:
+            writer = PdfWriter()
+            for i in range(start_page - 1, end_page):  # 1-based to 0-based
+                writer.add_page(self._reader.pages[i])
+            with open(out_path, "wb") as output:
+                writer.write(output)
+            # release the page objects (contents, images) read for this window
+            self._reader.resolved_objects.clear()
+
+    def close(self):
+        with self._lock:
+            self._reader = None
+            self._file.close()
+
+
+# Open sources by file (path, size and modification time)
+_SOURCES = {}
+_SOURCES_LOCK = threading.Lock()
+
+# ------------------------------------------------------------------------------
+# -- Define functions ----------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+
+def open_source(file_path):
+    """ The PdfSource of a file, shared by all the callers in the process
+        (reopened if the file changed)."""
+    stat = os.stat(file_path)
+    key = (os.path.realpath(file_path), stat.st_size, stat.st_mtime_ns)
+    with _SOURCES_LOCK:
+        if key not in _SOURCES:
+            for old_key in [k for k in _SOURCES if k[0] == key[0]]:
+                _SOURCES.pop(old_key).close()
+            _SOURCES[key] = PdfSource(file_path)
+        return _SOURCES[key]
+
+
+def page_count(file_path):
+    """ Number of pages of a PDF file."""
+    return open_source(file_path).page_count
+
+
+# Page range checks (only need PyPDF2, so commands that do not call the API,
+# like cli.py plan, can use them without loading the digitizer)
+
+
+def check_pages(file_path, page_N, page_window, placement="middle"):
+    """
+    Determine the appropriate start and end page for a given page window.
+
+    Parameters:
+        file_path (str): Path to the PDF file.
+        page_N (int): The target page number.
+        page_window (int): Number of pages to include in the window.
+        placement (str): Position of the target page within the window ('top', 'middle', 'bottom').
+
+    Returns:
+        tuple: (start_page, end_page) representing the range of selected pages.
+    """
+
+    total_page_count = page_count(file_path)
+
+    # If the requested window is larger than the document, return the full document
+    if page_window >= total_page_count:
+        return 1, total_page_count  # Return the entire document
+
+    # Ensure page_N is within valid range
+    if page_N < 1 or page_N > total_page_count:
+        raise ValueError(
+            f"Page N ({page_N}) is out of document range (1-{total_page_count})"
+        )
+
+    # Determine the start page based on placement
+    if placement == "top":
+        start_page = page_N
+    elif placement == "middle":
+        start_page = page_N - (page_window // 2)
+    elif placement == "bottom":
+        start_page = page_N - (page_window - 1)
+    else:
+        raise ValueError(
+            "Invalid placement. Choose from 'top', 'middle', or 'bottom'.")
+    # Debugging
+
+    # Ensure the start_page and n_pages fit within the document range
+    if start_page < 1:
+        start_page = 1
+    if start_page + page_window - 1 > total_page_count:
+        start_page = max(1, total_page_count - page_window +
+                         1)  # Shift window left
+    # Final page count
+    n_pages = min(page_window, total_page_count - start_page + 1)
+
+    # get end page
+    end_page = start_page + n_pages - 1
+
+    return start_page, end_page
+
+
+def check_document(file_path, all_pages=False, start_page=1, n_pages=1):
+    """
+    Validate the requested page range against the document length.
+
+    Parameters:
+        file_path (str): Path to the PDF file.
+        all_pages (bool): If True, selects all pages.
+        start_page (int): First page number to extract.
+        n_pages (int): Number of pages to extract.
+
+    Returns:
+        tuple: (start_page, n_pages) after validation.
+    """
+
+    total_page_count = page_count(file_path)
+
+    if all_pages:
+        start_page = 1
+        n_pages = total_page_count
+
+    else:
+        if total_page_count < (start_page + (n_pages - 1)):
+            raise Exception((
+                "Total pages requested exceeds document length!",
+                f"   Requested pages {start_page} to {start_page + (n_pages - 1)}",
+                f"but document only has {total_page_count} pages"))
+
+    return start_page, n_pages
@@ -0,0 +1,163 @@
+import time
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+import run_log
+
+# ------------------------------------------------------------------------------
+# -- Define classes ------------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+
+class LatencyTracker:
+    """
+    Recent request latencies, per model.
+
+    Parameters:
+        window (int): Number of latencies kept per model.
+    """
+
+    def __init__(self, window=200):
+        self.window = window
+        self._latencies = {}  # model id -> deque of seconds
+        self._lock = threading.Lock()
+
+    def record(self, model_id, seconds):
+        with self._lock:
+            self._latencies.setdefault(
+                model_id, deque(maxlen=self.window)).append(seconds)
+
+    def count(self, model_id):
+        with self._lock:
+            return len(self._latencies.get(model_id, ()))
+
+    def percentile(self, model_id, q):
+        """ q-th percentile (0-100) of the model's latencies (None if none)."""
+        with self._lock:
+            latencies = list(self._latencies.get(model_id, ()))
+        return float(np.percentile(latencies, q)) if latencies else None
+
+
+# Latencies shared by all the runs in the process
+LATENCIES = LatencyTracker()
+
+
+class HedgePolicy:
+    """
+    Send a duplicate request when a request is slower than usual.
+
+    If a request has not finished after the given percentile of the model's
+    observed latency, the same request is sent again; the first complete and
+    valid response wins. The slower request cannot be interrupted (the API
+    client is synchronous), so it is left to finish in the background, and
+    is only counted in the token usage. At most max_fraction of the requests
+    are hedged, to bound the extra cost.
+
+    Parameters:
+        percentile (float): Latency percentile (0-100) after which to hedge.
+        max_fraction (float): Maximum fraction of requests that are hedged.
+        min_samples (int): Latencies needed for a model before hedging.
+        min_delay (float): Never hedge before this many seconds.
+        tracker (LatencyTracker): Latency history (defaults to LATENCIES).
+    """
+
+    def __init__(self, percentile=95, max_fraction=0.1, min_samples=10,
+                 min_delay=5.0, tracker=None):
+        self.percentile = percentile
+        self.max_fraction = max_fraction
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.tracker = tracker or LATENCIES
+        self.requests = 0
+        self.hedged = 0
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=8,
+                                        thread_name_prefix="hedge")
+
+    def hedge_delay(self, model_id):
+        """ Seconds to wait before hedging a request (None: do not hedge)."""
+        if self.tracker.count(model_id) < self.min_samples:
+            return None
+        return max(self.min_delay,
+                   self.tracker.percentile(model_id, self.percentile))
+
+    def _timed(self, request, model_id):
+        start = time.time()
+        response = request()
+        self.tracker.record(model_id, time.time() - start)
+        return response
+
+    def call(self, request, model_id, is_valid=None, on_extra=None, page=None):
+        """
+        Run a request, hedging it if it is slow.
+
+        Parameters:
+            request (callable): Sends the request and returns the response.
+            model_id (str): Gemini model ID (latencies are tracked per model).
+            is_valid (callable): True for a usable response (defaults to
+                a response with parsed data).
+            on_extra (callable): Called with the response of the request
+                that did not win, when it finishes (e.g. to count its tokens).
+            page (int): Page number, for logging.
+
+        Returns:
+            The first valid response (or the last response if none is valid).
+            Raises the first exception if all the requests fail.
+        """
+        if is_valid is None:
+            def is_valid(response):
+                return bool(response) and response.parsed is not None
+
+        with self._lock:
+            self.requests += 1
+
+        first = self._pool.submit(contextvars.copy_context().run,
+                                  self._timed, request, model_id)
+        delay = self.hedge_delay(model_id)
+        if delay is None:
+            return first.result()
+        done, _ = wait([first], timeout=delay)
+        if done:
+            return first.result()
+
+        with self._lock:
+            if self.hedged + 1 > self.max_fraction * self.requests:
+                allowed = False
+            else:
+                self.hedged += 1
+                allowed = True
+        if not allowed:
+            return first.result()
+
+        run_log.current().info(
+            f"No response after {delay:.1f}s, sending a hedged request "
+            f"({self.hedged}/{self.requests} hedged)", stage="extract", page=page)
+        pending = {first, self._pool.submit(contextvars.copy_context().run,
+                                            self._timed, request, model_id)}
+        finished = []
+        winner = None
+        error = None
+        while pending and winner is None:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = error or future.exception()
+                    continue
+                finished.append(future)
+                if winner is None and is_valid(future.result()):
+                    winner = future
+
+        if winner is None and not finished:
+            raise error
+        result = winner or finished[-1]
+        if on_extra is not None:
+            for future in finished:
+                if future is not result:
+                    on_extra(future.result())
+            # the request that lost finishes in the background
+            for future in pending:
+                future.add_done_callback(
+                    lambda f: f.exception() is None and on_extra(f.result()))
+        return result.result()
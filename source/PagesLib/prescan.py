@@ -0,0 +1,161 @@
+import csv
+import numpy as np
+from pdf2image import convert_from_path
+import run_log
+
+# ------------------------------------------------------------------------------
+# -- Define functions ----------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+THUMBNAIL_WIDTH = 256  # pixels; enough to see ink, cheap to render
+BATCH_SIZE = 20  # pages rendered at a time, to bound memory
+
+# Candidate duplicates (within max_hash_distance bits of the 64-bit hash) are
+# confirmed with a 256-bit hash: distinct directory pages of the repo's scans
+# can be as close as 8 bits with 64 bits, but are more than 60 bits apart with
+# 256 bits, while rescans of a page stay within about 25.
+VERIFY_HASH_SIZE = 16
+MAX_VERIFY_DISTANCE = 32
+
+
+def ink_density(image, threshold=128):
+    """
+    Fraction of dark pixels in a grayscale page image.
+
+    Parameters:
+        image (PIL.Image): Grayscale page thumbnail.
+        threshold (int): Pixels darker than this count as ink.
+
+    Returns:
+        float: Fraction of pixels that are ink.
+    """
+    pixels = np.asarray(image.convert("L"))
+    return float((pixels < threshold).mean())
+
+
+def dhash(image, hash_size=8):
+    """
+    Difference hash of a page image (robust to rescans, scaling and contrast).
+
+    Parameters:
+        image (PIL.Image): Page thumbnail.
+        hash_size (int): The hash has hash_size**2 bits.
+
+    Returns:
+        int: Perceptual hash.
+    """
+    small = image.convert("L").resize((hash_size + 1, hash_size))
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int("".join("1" if b else "0" for b in bits), 2)
+
+
+def prescan_pages(file_path, start_page, n_pages, blank_threshold=0.002,
+                  max_hash_distance=3, max_verify_distance=MAX_VERIFY_DISTANCE):
+    """
+    Find blank and near-duplicate pages before sending anything to the API.
+
+    Pages are rendered as small grayscale thumbnails. A page is blank if its
+    ink density is below blank_threshold, and a duplicate if its perceptual
+    hash is within max_hash_distance bits of an earlier page and its larger
+    hash (VERIFY_HASH_SIZE) within max_verify_distance bits. Near-duplicates
+    are found by splitting the 64-bit hash into max_hash_distance + 1 bands:
+    two hashes that close share at least one band exactly, so each page is
+    only compared with the earlier pages in its bands. Every duplicate found
+    is logged as a warning, since its data will be the earlier page's.
+
+    Parameters:
+        file_path (str): Path to the PDF file.
+        start_page (int): Starting page number.
+        n_pages (int): Number of pages to scan.
+        blank_threshold (float): Ink density below which a page is blank.
+        max_hash_distance (int): Hamming distance up to which pages are
+            candidate duplicates.
+        max_verify_distance (int): Hamming distance of the larger hashes up to
+            which candidates are duplicates.
+
+    Returns:
+        dict: Page number to {"page", "status" ("ok", "blank" or "duplicate"),
+              "duplicate_of", "ink_density", "hash", "hash_distance",
+              "verify_distance"} (distances to duplicate_of).
+    """
+    n_bands = max_hash_distance + 1
+    band_bits = 64 // n_bands
+    band_mask = (1 << band_bits) - 1
+    # band value -> list of (page, hash, larger hash)
+    bands = [{} for _ in range(n_bands)]
+    log = run_log.current()
+
+    results = {}
+    last_page = start_page + n_pages - 1
+    for first in range(start_page, last_page + 1, BATCH_SIZE):
+        last = min(first + BATCH_SIZE - 1, last_page)
+        images = convert_from_path(file_path, first_page=first, last_page=last,
+                                   grayscale=True, size=(THUMBNAIL_WIDTH, None))
+        for N, image in zip(range(first, last + 1), images):
+            ink = ink_density(image)
+            page_hash = dhash(image)
+            verify_hash = dhash(image, VERIFY_HASH_SIZE)
+            result = {"page": N, "status": "ok", "duplicate_of": None,
+                      "ink_density": ink, "hash": f"{page_hash:016x}",
+                      "hash_distance": None, "verify_distance": None}
+            results[N] = result
+
+            if ink < blank_threshold:
+                result["status"] = "blank"
+                continue
+
+            keys = [(page_hash >> (b * band_bits)) & band_mask
+                    for b in range(n_bands)]
+            for b, key in enumerate(keys):
+                for other_page, other_hash, other_verify in bands[b].get(key, []):
+                    distance = bin(page_hash ^ other_hash).count("1")
+                    if distance > max_hash_distance:
+                        continue
+                    verify_distance = bin(verify_hash ^ other_verify).count("1")
+                    if verify_distance <= max_verify_distance:
+                        result.update(status="duplicate",
+                                      duplicate_of=other_page,
+                                      hash_distance=distance,
+                                      verify_distance=verify_distance)
+                        break
+                if result["duplicate_of"] is not None:
+                    break
+
+            # only original pages are indexed, so duplicates point to them
+            if result["status"] == "ok":
+                for b, key in enumerate(keys):
+                    bands[b].setdefault(key, []).append(
+                        (N, page_hash, verify_hash))
+            else:
+                log.warning(
+                    f"Duplicate of page {result['duplicate_of']} (hash "
+                    f"distances {distance}/64 and {verify_distance}/"
+                    f"{VERIFY_HASH_SIZE ** 2}), its data will be reused",
+                    stage="prescan", page=N)
+        del images
+
+    n_blank = sum(r["status"] == "blank" for r in results.values())
+    n_dup = sum(r["status"] == "duplicate" for r in results.values())
+    log.info(f"{n_blank} blank and {n_dup} duplicate pages out of {n_pages}",
+             stage="prescan")
+    return results
+
+
+def write_prescan_report(results, report_path):
+    """
+    Save the prescan results as a .csv report.
+
+    Parameters:
+        results (dict): Output of prescan_pages.
+        report_path (str): Path to the .csv report.
+    """
+    fields = ["page", "status", "duplicate_of", "ink_density", "hash",
+              "hash_distance", "verify_distance"]
+    with open(report_path, "w", newline="", encoding="utf-8") as file:
+        writer = csv.DictWriter(file, fieldnames=fields)
+        writer.writeheader()
+        for N in sorted(results):
+            writer.writerow(results[N])
+    run_log.current().debug(f"Saved prescan report to {report_path}",
+                            stage="prescan")
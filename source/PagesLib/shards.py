@@ -0,0 +1,118 @@
+import time
+import threading
+from PagesLib import concurrency
+
+# ------------------------------------------------------------------------------
+# -- Define classes ------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Pool of API keys ("shards"): each key is its own project, with its own client,
+# rate limits (an AIMDController per key and model, see concurrency.py), File
+# API storage and uploads. A page is processed on one shard from upload to
+# extraction, since uploaded files belong to the key that uploaded them; pages
+# go to the shard with the most free requests, and a page whose key becomes
+# unavailable (the key's circuit opens, e.g. its quota is exhausted) moves to
+# another key and is uploaded again there.
+
+
+class Shard:
+    """
+    One API key of a pool.
+
+    Parameters:
+        name (str): Name of the key (tags the rows it produces); None for the
+            only key of an unsharded run.
+        client: Gemini API client of the key.
+        uploads (UploadManager): Upload manager of the key, if any.
+        upload_cache (UploadCache): Uploads of the key shared by several runs.
+    """
+
+    def __init__(self, name, client, uploads=None, upload_cache=None):
+        self.name = name
+        self.client = client
+        self.uploads = uploads
+        self.upload_cache = upload_cache
+        self.active = 0  # pages being processed on the shard
+        self.pages = 0  # pages processed on the shard
+
+    def controller(self, model_id):
+        """ AIMDController of the model on this key (the model's shared one
+            for an unsharded run)."""
+        if self.name is None:
+            return concurrency.controller_for(model_id)
+        return concurrency.controller_for(f"{model_id}@{self.name}")
+
+    def available(self, model_id):
+        """ True if requests can be sent (the key's circuit is closed)."""
+        return self.controller(model_id).open_until <= time.time()
+
+    def free(self, model_id):
+        """ Requests the key can take now (its limit minus its pages)."""
+        return self.controller(model_id).limit - self.active
+
+
+class ShardPool:
+    """
+    Schedules pages across the shards of a pool.
+
+    Parameters:
+        shards (list): Shards of the pool.
+    """
+
+    def __init__(self, shards):
+        if not shards:
+            raise ValueError("A shard pool needs at least one API key")
+        self.shards = list(shards)
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        return iter(self.shards)
+
+    def __len__(self):
+        return len(self.shards)
+
+    def pick(self, model_id, exclude=()):
+        """
+        Shard for the next page: the available shard with the most free
+        requests, among the shards not in exclude (or among all of them, if
+        every shard was excluded). If none is available, the one with the most
+        free requests (its requests wait for the circuit to close).
+
+        Parameters:
+            model_id (str): Gemini model ID.
+            exclude (list): Names of the shards the page already failed on.
+
+        Returns:
+            Shard: The shard, counted as active until done() is called.
+        """
+        with self._lock:
+            candidates = [s for s in self.shards if s.name not in exclude] \
+                or self.shards
+            available = [s for s in candidates if s.available(model_id)] \
+                or candidates
+            shard = max(available, key=lambda s: (s.free(model_id), -s.pages))
+            shard.active += 1
+            shard.pages += 1
+            return shard
+
+    def can_fail_over(self, model_id, shard, exclude=()):
+        """ True if another available shard (not in exclude) can take a page
+            of shard."""
+        return any(s is not shard and s.name not in exclude and
+                   s.available(model_id) for s in self.shards)
+
+    def done(self, shard):
+        with self._lock:
+            shard.active -= 1
+
+    @property
+    def uploaded_bytes(self):
+        return sum(s.uploads.uploaded_bytes for s in self.shards
+                   if s.uploads is not None)
+
+    def close(self):
+        """ Delete the cached uploads and close the upload managers."""
+        for shard in self.shards:
+            if shard.upload_cache is not None:
+                shard.upload_cache.clear(shard.client)
+            if shard.uploads is not None:
+                shard.uploads.close()
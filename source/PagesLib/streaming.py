@@ -0,0 +1,197 @@
+import json
+import time
+from types import SimpleNamespace
+from pydantic import ValidationError
+from PagesLib.Page import entry_model
+import run_log
+
+# ------------------------------------------------------------------------------
+# -- Define classes ------------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+
+class EntryStreamParser:
+    """
+    Incremental parser of a page's JSON response.
+
+    Text is fed as it arrives. Each object of the top-level "entries" list is
+    validated against the entry model and returned as soon as it closes, and
+    the other top-level fields (yr, state_heading, pgnum, ...) are kept as
+    they complete, so a truncated response still gives all its complete
+    entries.
+
+    Parameters:
+        page_schema (type): Page schema of the response (a PagesLib.Page model).
+    """
+
+    def __init__(self, page_schema):
+        self.page_schema = page_schema
+        self.entry_model = entry_model(page_schema)
+        self.text = ""
+        self.entries = []  # validated entries, in order
+        self.page_fields = {}  # complete top-level fields other than entries
+        self.n_invalid = 0
+        self._pos = 0
+        self._stack = []  # open "{" and "["
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._last_string = None  # (start, end) of the last string at depth 1
+        self._key = None  # current top-level key
+        self._value_start = None  # start of a top-level scalar value
+        self._entry_start = None
+
+    def feed(self, text):
+        """
+        Add text to the response.
+
+        Returns:
+            list: Entries completed by this text (validated entry models).
+        """
+        self.text += text
+        new_entries = []
+        buffer = self.text
+        for i in range(self._pos, len(buffer)):
+            char = buffer[i]
+            depth = len(self._stack)
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if depth == 1 and self._string_start is not None:
+                        self._last_string = (self._string_start, i + 1)
+                continue
+
+            if char == '"':
+                self._in_string = True
+                self._string_start = i if depth == 1 else None
+                if depth == 1 and self._key is not None and self._value_start is None:
+                    self._value_start = i
+            elif char in "{[":
+                if depth == 2 and char == "{" and self._key == "entries":
+                    self._entry_start = i
+                self._stack.append(char)
+            elif char in "}]":
+                if self._stack:
+                    self._stack.pop()
+                if depth == 3 and char == "}" and self._entry_start is not None:
+                    entry = self._parse_entry(buffer[self._entry_start:i + 1])
+                    if entry is not None:
+                        new_entries.append(entry)
+                    self._entry_start = None
+                elif depth == 1:
+                    self._end_value(buffer, i)
+            elif depth == 1:
+                if char == ":":
+                    if self._last_string is not None:
+                        self._key = json.loads(buffer[slice(*self._last_string)])
+                    self._value_start = None
+                elif char == ",":
+                    self._end_value(buffer, i)
+                elif not char.isspace() and self._key is not None and \
+                        self._value_start is None:
+                    self._value_start = i
+        self._pos = len(buffer)
+        self.entries.extend(new_entries)
+        return new_entries
+
+    def _end_value(self, buffer, end):
+        """ A top-level value ends at end (a "," or the closing "}")."""
+        if self._key is not None and self._key != "entries" and \
+                self._value_start is not None:
+            try:
+                self.page_fields[self._key] = json.loads(
+                    buffer[self._value_start:end])
+            except json.JSONDecodeError:
+                pass
+        self._key = None
+        self._value_start = None
+        self._last_string = None
+
+    def _parse_entry(self, text):
+        try:
+            return self.entry_model.model_validate_json(text)
+        except ValidationError as e:
+            self.n_invalid += 1
+            run_log.current().debug(f"Skipping invalid entry: {e}",
+                                    stage="stream")
+            return None
+
+    def page(self):
+        """
+        The page parsed so far.
+
+        Returns:
+            Page model: The full response if it is complete and valid,
+            otherwise a page with the complete entries (missing page fields
+            are None).
+        """
+        try:
+            return self.page_schema.model_validate_json(self.text)
+        except ValidationError:
+            pass
+        data = {field: self.page_fields.get(field)
+                for field in self.page_schema.model_fields}
+        data["entries"] = list(self.entries)
+        try:
+            return self.page_schema.model_validate(data)
+        except ValidationError:
+            return self.page_schema.model_construct(**data)
+
+
+# ------------------------------------------------------------------------------
+# -- Define functions ----------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+
+def stream_generate(genai_client, model_id, contents, config, page_schema,
+                    on_entry=None, page=None):
+    """
+    Generate a page with the streaming API, parsing entries as they arrive.
+
+    Parameters:
+        genai_client: Gemini API client.
+        model_id (str): Gemini model ID.
+        contents (list): Prompt and uploaded files.
+        config (dict): Generation config (with the response schema).
+        page_schema (type): Page schema of the response.
+        on_entry (callable): Called with (index, entry) for each complete entry;
+            index 0 means a new attempt has started.
+        page (int): Page number, for logging.
+
+    Returns:
+        object: Response with the same attributes as generate_content's that
+        extract_page_data uses (parsed, text, candidates, usage_metadata).
+        parsed holds the entries received even if the response was truncated.
+    """
+    parser = EntryStreamParser(page_schema)
+    usage_metadata = None
+    candidates = None
+    start = time.time()
+    for chunk in genai_client.models.generate_content_stream(
+            model=model_id, contents=contents, config=config):
+        if getattr(chunk, "usage_metadata", None) is not None:
+            usage_metadata = chunk.usage_metadata
+        if getattr(chunk, "candidates", None):
+            candidates = chunk.candidates
+        new_entries = parser.feed(chunk.text or "")
+        first_index = len(parser.entries) - len(new_entries)
+        if new_entries and first_index == 0:
+            run_log.current().debug(
+                f"First entry after {time.time() - start:.1f}s",
+                stage="stream", page=page)
+        if on_entry is not None:
+            for index, entry in enumerate(new_entries, start=first_index):
+                on_entry(index, entry)
+
+    parsed = parser.page() if parser.text else None
+    if parser.n_invalid:
+        run_log.current().warning(
+            f"{parser.n_invalid} streamed entries did not validate",
+            stage="stream", page=page)
+    return SimpleNamespace(parsed=parsed, text=parser.text,
+                           candidates=candidates,
+                           usage_metadata=usage_metadata)
@@ -0,0 +1,396 @@
+import os
+import re
+import glob
+import json
+import time
+import uuid
+import threading
+from datetime import datetime, timezone, timedelta
+from concurrent.futures import ThreadPoolExecutor
+import run_log
+from PagesLib.digitizer import upload_pages_to_API, upload_display_name
+
+# File API storage per project (files also expire after 48 hours)
+FILE_API_QUOTA_BYTES = 20 * 1024**3
+
+# Display names of the pages uploaded by the digitizer ("{first}-{last}__{name}",
+# then "__{run tag}" for the uploads of an UploadManager)
+UPLOAD_NAME_PATTERN = re.compile(r"^\d+-\d+__")
+
+# ------------------------------------------------------------------------------
+# -- Define classes ------------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+
+class UploadManager:
+    """
+    Tracks the files a run uploads to the File API and deletes them.
+
+    Every upload is recorded in a manifest (a .jsonl file next to the run's
+    results), with its size, so the bytes stored in the project can be kept
+    under the quota: an upload that would go above high_water of the quota
+    first waits for deletions to free space, instead of failing. Released
+    files are deleted in bulk, concurrently, by a background thread.
+
+    Uploads are tagged with the run's run_tag (in their display name): only
+    this run's files are reused or deleted, never those of another process or
+    run sharing the project. Files left by finished or crashed runs are
+    deleted by clean_uploads (cli.py clean-uploads).
+
+    Parameters:
+        genai_client: Gemini API client.
+        manifest_path (str): .jsonl manifest of this run's uploads (None to not
+            save one).
+        run_tag (str): Tag of this run's uploads (a new random one if None).
+        quota_bytes (int): File API storage quota of the project.
+        high_water (float): Fraction of the quota above which uploads wait.
+        gc_interval (float): Seconds between garbage collections.
+        workers (int): Number of concurrent deletions.
+        max_wait (float): Seconds an upload waits for space before failing.
+    """
+
+    def __init__(self, genai_client, manifest_path=None, run_tag=None,
+                 quota_bytes=FILE_API_QUOTA_BYTES, high_water=0.9,
+                 gc_interval=30, workers=8, max_wait=600):
+        self.client = genai_client
+        self.manifest_path = manifest_path
+        self.run_tag = run_tag or uuid.uuid4().hex[:12]
+        self.quota_bytes = quota_bytes
+        self.high_water = high_water
+        self.gc_interval = gc_interval
+        self.max_wait = max_wait
+        self.files = {}  # name -> uploaded file, uploaded by this run and not deleted
+        self.existing = {}  # display name -> file in the File API
+        self.bytes_used = 0  # bytes stored in the File API (whole project)
+        self.uploaded_bytes = 0
+        self.deleted = 0
+        self._released = []  # files waiting to be deleted
+        self._uploading = set()  # display names of the uploads in progress
+        self._lock = threading.Lock()
+        self._space = threading.Condition(self._lock)
+        self._manifest_lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers,
+                                        thread_name_prefix="upload_gc")
+        self._stop = threading.Event()
+        self._record("start", run_tag=self.run_tag)
+        self.refresh()
+        self._thread = threading.Thread(target=self._gc_loop, daemon=True)
+        self._thread.start()
+
+    # Uploads ------------------------------------------------------------------
+
+    def is_own(self, uploaded_file):
+        """ Whether a file of the File API was uploaded by this run."""
+        return (uploaded_file.display_name or "").endswith(f"__{self.run_tag}")
+
+    def refresh(self):
+        """ List the File API to update the stored bytes (whole project) and
+            this run's existing files."""
+        listed = list(self.client.files.list())
+        with self._lock:
+            self.existing = {f.display_name: f for f in listed
+                             if self.is_own(f)}
+            self.bytes_used = sum(getattr(f, "size_bytes", 0) or 0 for f in listed)
+            self._space.notify_all()
+        return listed
+
+    def reserve(self, size_bytes):
+        """ Wait until size_bytes fit under the quota's high water mark."""
+        limit = self.quota_bytes * self.high_water
+        deadline = time.time() + self.max_wait
+        with self._space:
+            while self.bytes_used + size_bytes > limit:
+                if self._released:
+                    self._space.wait(timeout=1)
+                else:
+                    run_log.current().warning(
+                        f"File API storage at {self.bytes_used / 1024**3:.2f} GB, "
+                        "waiting for space to upload", stage="upload")
+                    self._lock.release()
+                    try:
+                        self.collect(orphans=True)
+                    finally:
+                        self._lock.acquire()
+                    if self.bytes_used + size_bytes > limit:
+                        self._space.wait(timeout=min(30, self.gc_interval))
+                if time.time() > deadline:
+                    raise RuntimeError(
+                        f"No space in the File API for {size_bytes} bytes "
+                        f"after {self.max_wait}s")
+            self.bytes_used += size_bytes
+
+    def upload(self, file_path, first_pg, last_pg, png=False):
+        """
+        Upload pages (see digitizer.upload_pages_to_API) and record the file.
+
+        Returns:
+            object: Uploaded file object from the Gemini API.
+        """
+        # (not an orphan while its upload is in progress)
+        display_name = upload_display_name(file_path, first_pg, last_pg, png,
+                                           self.run_tag)
+        with self._lock:
+            self._uploading.add(display_name)
+        try:
+            uploaded_file = upload_pages_to_API(self.client, file_path,
+                                                first_pg, last_pg, png=png,
+                                                existing_files=self.existing,
+                                                reserve=self.reserve,
+                                                run_tag=self.run_tag)
+        except BaseException:
+            with self._lock:
+                self._uploading.discard(display_name)
+            raise
+        with self._lock:
+            self._uploading.discard(display_name)
+            new = uploaded_file.name not in self.files
+            self.files[uploaded_file.name] = uploaded_file
+            self.existing[uploaded_file.display_name] = uploaded_file
+            if new:
+                self.uploaded_bytes += getattr(uploaded_file, "size_bytes", 0) or 0
+        if new:
+            self._record("upload", name=uploaded_file.name,
+                         display_name=uploaded_file.display_name,
+                         size_bytes=getattr(uploaded_file, "size_bytes", None))
+        return uploaded_file
+
+    def release(self, uploaded_file):
+        """ Mark a file as no longer needed (deleted by the next collection)."""
+        with self._lock:
+            if self.files.pop(uploaded_file.name, None) is not None:
+                self.existing.pop(uploaded_file.display_name, None)
+                self._released.append(uploaded_file)
+
+    # Garbage collection -------------------------------------------------------
+
+    def collect(self, orphans=False):
+        """
+        Delete the released files, concurrently.
+
+        Parameters:
+            orphans (bool): Also delete this run's files that are in the File
+                API but not tracked (e.g. an upload whose response was lost;
+                lists the File API).
+
+        Returns:
+            int: Number of files deleted.
+        """
+        with self._lock:
+            to_delete = {f.name: f for f in self._released}
+            self._released = []
+        if orphans:
+            for f in self._orphans():
+                to_delete.setdefault(f.name, f)
+        if not to_delete:
+            return 0
+
+        deleted = [f for f, ok in zip(
+            to_delete.values(),
+            self._pool.map(self._delete, to_delete.values())) if ok]
+        with self._lock:
+            for f in deleted:
+                self.bytes_used -= getattr(f, "size_bytes", 0) or 0
+                self.existing.pop(f.display_name, None)
+            self.bytes_used = max(0, self.bytes_used)
+            self.deleted += len(deleted)
+            self._space.notify_all()
+        run_log.current().debug(f"Deleted {len(deleted)} uploaded files",
+                                stage="release")
+        return len(deleted)
+
+    def _delete(self, uploaded_file):
+        try:
+            self.client.files.delete(name=uploaded_file.name)
+        except Exception as e:
+            run_log.current().warning(
+                f"Failed to delete uploaded file {uploaded_file.name}: {e}",
+                stage="release")
+            return False
+        self._record("delete", name=uploaded_file.name)
+        return True
+
+    def _orphans(self):
+        """ This run's files in the File API that it no longer tracks."""
+        listed = self.refresh()
+        with self._lock:
+            return [f for f in listed
+                    if self.is_own(f) and f.name not in self.files
+                    and f.display_name not in self._uploading]
+
+    def _gc_loop(self):
+        while not self._stop.wait(self.gc_interval):
+            try:
+                self.collect()
+            except Exception as e:
+                run_log.current().warning(f"Upload garbage collection failed: {e}",
+                                          stage="release")
+
+    def _record(self, event, **fields):
+        if not self.manifest_path:
+            return
+        with self._manifest_lock:
+            with open(self.manifest_path, "a", encoding="utf-8") as file:
+                file.write(json.dumps({"event": event, "time": time.time(),
+                                       **fields}) + "\n")
+
+    def close(self):
+        """ Release and delete all of this run's files, collect its orphans
+            and mark the run as finished in its manifest."""
+        self._stop.set()
+        with self._lock:
+            remaining = list(self.files.values())
+        for f in remaining:
+            self.release(f)
+        self.collect(orphans=True)
+        self._record("finished", uploaded_bytes=self.uploaded_bytes,
+                     deleted=self.deleted)
+        self._pool.shutdown(wait=True)
+
+
+def finished_run_files(manifest_path):
+    """ Names of the files uploaded and not deleted by a finished run
+        (none if the run has not finished)."""
+    uploaded = set()
+    finished = False
+    with open(manifest_path, "r", encoding="utf-8") as file:
+        for line in file:
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if event["event"] == "upload":
+                uploaded.add(event["name"])
+            elif event["event"] == "delete":
+                uploaded.discard(event["name"])
+            elif event["event"] == "finished":
+                finished = True
+    return uploaded if finished else set()
+
+
+def clean_uploads(genai_client, manifest_glob, orphan_age=6, dry_run=False):
+    """
+    Delete the files left in the File API by other runs: the files of
+    finished runs that they did not delete (from their manifests), and the
+    digitizer uploads older than orphan_age hours (e.g. from a run that
+    crashed). Runs in progress keep their files, unless older than
+    orphan_age.
+
+    Parameters:
+        genai_client: Gemini API client.
+        manifest_glob (list): Glob patterns of the run manifests (see
+            manifest_paths).
+        orphan_age (float): Hours after which a digitizer upload is deleted.
+        dry_run (bool): If True, only list the files.
+
+    Returns:
+        list: The files deleted (or to delete).
+    """
+    finished = set()
+    for pattern in manifest_glob:
+        for path in glob.glob(pattern):
+            finished |= finished_run_files(path)
+
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=orphan_age)
+    orphans = []
+    for f in genai_client.files.list():
+        created = getattr(f, "create_time", None)
+        old = (isinstance(created, datetime) and created.tzinfo is not None
+               and created < cutoff)
+        if f.name in finished or (
+                old and UPLOAD_NAME_PATTERN.match(f.display_name or "")):
+            orphans.append(f)
+    if dry_run:
+        return orphans
+
+    deleted = []
+    for f in orphans:
+        try:
+            genai_client.files.delete(name=f.name)
+        except Exception as e:
+            run_log.current().warning(
+                f"Failed to delete uploaded file {f.name}: {e}", stage="release")
+            continue
+        deleted.append(f)
+    return deleted
+
+
+def manifest_paths(results_dir):
+    """ Glob patterns of the upload manifests of the runs in results_dir."""
+    return [os.path.join(results_dir, "*", "uploads.jsonl"),
+            os.path.join(results_dir, "*", "uploads_*.jsonl"),
+            os.path.join(results_dir, "uploads_*.jsonl")]
+
+
+class UploadCache:
+    """
+    Uploaded files shared by several runs in one process.
+
+    Each (file, first page, last page, png) is uploaded once, even when several
+    threads ask for it at the same time; the files are kept until clear() is
+    called, since another run may still need them.
+
+    Parameters:
+        uploads (UploadManager): If given, files are uploaded and deleted
+            through it.
+    """
+
+    def __init__(self, uploads=None):
+        self.uploads = uploads
+        self._files = {}  # key -> uploaded file
+        self._locks = {}  # key -> lock held while the key is uploading
+        self._lock = threading.Lock()
+
+    def get(self, genai_client, file_path, first_pg, last_pg, png=False):
+        """
+        Uploaded file of pages first_pg to last_pg, uploading it if needed.
+
+        Parameters:
+            genai_client: Gemini API client.
+            file_path (str): Path to the input PDF file.
+            first_pg (int): First page.
+            last_pg (int): Last page.
+            png (bool): If True, converts the page to PNG format.
+
+        Returns:
+            object: Uploaded file object from the Gemini API.
+        """
+        key = (file_path, first_pg, last_pg, png and first_pg == last_pg)
+        with self._lock:
+            if key in self._files:
+                return self._files[key]
+            key_lock = self._locks.setdefault(key, threading.Lock())
+        with key_lock:
+            if key not in self._files:
+                if self.uploads is not None:
+                    uploaded_file = self.uploads.upload(file_path, first_pg,
+                                                        last_pg, png=png)
+                else:
+                    uploaded_file = upload_pages_to_API(genai_client, file_path,
+                                                        first_pg, last_pg, png=png)
+                with self._lock:
+                    self._files[key] = uploaded_file
+        return self._files[key]
+
+    def __len__(self):
+        return len(self._files)
+
+    def clear(self, genai_client):
+        """ Delete all the cached uploads from the File API."""
+        with self._lock:
+            files = list(self._files.values())
+            self._files.clear()
+            self._locks.clear()
+        if self.uploads is not None:
+            for uploaded_file in files:
+                self.uploads.release(uploaded_file)
+            self.uploads.collect()
+            return
+        for uploaded_file in files:
+            try:
+                genai_client.files.delete(name=uploaded_file.name)
+                run_log.current().debug(f"Deleted uploaded file: {uploaded_file.name}",
+                                        stage="release")
+            except Exception as e:
+                run_log.current().warning(
+                    f"Failed to delete uploaded file {uploaded_file.name}: {e}",
+                    stage="release")
@@ -0,0 +1,423 @@
+# ------------------------------------------------------------------------------
+# Load libraries ---------------------------------------------------------------
+# ------------------------------------------------------------------------------
+import re
+from difflib import SequenceMatcher
+import numpy as np
+import pandas as pd
+
+import profiling
+
+# ------------------------------------------------------------------------------
+# -- Define functions ----------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+# Columns used to split entries into candidate blocks. Only the columns present
+# in both the predicted and the hand-coded data are used.
+BLOCK_COLS = ["Data Year", "Page Number", "State Heading", "Project Number"]
+
+# Common abbreviations in company names, mapped to a single spelling
+COMPANY_ABBREVIATIONS = {
+    "co": "company",
+    "cos": "companies",
+    "corp": "corporation",
+    "inc": "incorporated",
+    "ltd": "limited",
+    "bros": "brothers",
+    "natl": "national",
+    "nat": "natural",
+    "pipe line": "pipeline",
+    "&": "and",
+}
+
+# Words of company names too common to pair entries on (see company_keys)
+GENERIC_COMPANY_WORDS = {"the", "and", "of", "company", "companies",
+                         "corporation", "incorporated", "limited", "gas",
+                         "oil", "pipeline", "natural", "transmission"}
+
+# Letters of a word in its company keys
+COMPANY_KEY_LETTERS = 3
+
+# Company keys shared by more predicted entries of a block than this are too
+# common to pair entries on (unless an entry has no other key)
+MAX_KEY_ENTRIES = 50
+
+# Company similarity from which two entries are taken to be about the same
+# company: the entries linked by such pairs are assigned together, on all of
+# their pair scores (see align_entries)
+LINK_SIMILARITY = 0.8
+
+_PUNCTUATION = re.compile(r"[^\w&\s]")
+_WHITESPACE = re.compile(r"\s+")
+_ABBREVIATIONS = re.compile(
+    r"(?<!\w)(" + "|".join(re.escape(k) for k in COMPANY_ABBREVIATIONS) + r")(?!\w)")
+
+
+def normalize_company(name):
+    """ Normalize a company name for comparison (case, punctuation, common
+        abbreviations and whitespace).
+
+    Args:
+        name (str): raw company name
+
+    Returns:
+        Normalized company name (str); empty string for missing values.
+    """
+    if not isinstance(name, str):
+        return ""
+    name = _PUNCTUATION.sub(" ", name.lower())
+    name = _WHITESPACE.sub(" ", name).strip()
+    name = _ABBREVIATIONS.sub(
+        lambda m: COMPANY_ABBREVIATIONS[m.group(1)], name)
+    return name
+
+
+def company_similarity(a, b):
+    """ Similarity between two normalized company names, between 0 and 1."""
+    if not a or not b:
+        return 0.0
+    if a == b:
+        return 1.0
+    return SequenceMatcher(None, a, b, autojunk=False).ratio()
+
+
+def company_keys(name):
+    """ Keys pairing a normalized company name with the names that may match
+        it: the first and the last letters of each word, leaving out the
+        generic words (an OCR error in one end of a word leaves the other).
+    """
+    keys = set()
+    for word in name.split():
+        if word not in GENERIC_COMPANY_WORDS:
+            keys.add("<" + word[:COMPANY_KEY_LETTERS])
+            keys.add(word[-COMPANY_KEY_LETTERS:] + ">")
+    return keys
+
+
+def mileage_similarity(a, b):
+    """ Similarity between two pipeline lengths, between 0 and 1.
+
+    Unknown lengths (-1 for UNK, -2 for NA, or missing) give a neutral 0.5 so
+    that the match is decided by the company name alone.
+    """
+    if pd.isna(a) or pd.isna(b) or a < 0 or b < 0:
+        return 0.5
+    if a == b:
+        return 1.0
+    return 1.0 - abs(a - b) / max(a, b)
+
+
+def linear_sum_assignment(cost):
+    """ Solve the (rectangular) assignment problem with the Hungarian algorithm.
+
+    Args:
+        cost (np.ndarray): n x m cost matrix to minimize
+
+    Returns:
+        list of (row, col) tuples, one per row if n <= m or one per column
+        otherwise.
+    """
+    cost = np.asarray(cost, dtype=float)
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+    n, m = cost.shape
+    if n == 0:
+        return []
+
+    # potentials and matching are 1-indexed; column 0 is a sentinel
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    match = np.zeros(m + 1, dtype=int)  # match[col] = row
+    way = np.zeros(m + 1, dtype=int)
+    for i in range(1, n + 1):
+        match[0] = i
+        j0 = 0
+        minv = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[j0] = True
+            i0 = match[j0]
+            # reduced costs of the free columns from row i0
+            cur = cost[i0 - 1] - u[i0] - v[1:]
+            free = ~used[1:]
+            better = free & (cur < minv[1:])
+            minv[1:][better] = cur[better]
+            way[1:][better] = j0
+            masked = np.where(free, minv[1:], np.inf)
+            j1 = int(np.argmin(masked)) + 1
+            delta = masked[j1 - 1]
+            u[match[used]] += delta
+            v[used] -= delta
+            minv[1:][free] -= delta
+            j0 = j1
+            if match[j0] == 0:
+                break
+        while j0:
+            j1 = way[j0]
+            match[j0] = match[j1]
+            j0 = j1
+
+    pairs = [(int(match[j]) - 1, j - 1) for j in range(1, m + 1) if match[j]]
+    if transposed:
+        pairs = [(c, r) for r, c in pairs]
+    return sorted(pairs)
+
+
+def _block_keys(df, block_cols):
+    """ Tuple of block values for each row of df."""
+    if not block_cols:
+        return pd.Series([()] * len(df), index=df.index)
+    return pd.Series(list(zip(*[df[c].astype(str) for c in block_cols])),
+                     index=df.index)
+
+
+def _candidate_pairs(pred_keys, true_keys):
+    """
+    Pairs of entries of a block worth scoring: those sharing a company key
+    (skipping the keys of more than MAX_KEY_ENTRIES predicted entries while
+    the entry has a rarer one). A hand-coded entry sharing no key with any
+    prediction is paired with all of them, so that badly misread names can
+    still match.
+
+    Args:
+        pred_keys (list): company_keys of the block's predicted entries
+        true_keys (list): company_keys of the block's hand-coded entries
+
+    Returns:
+        dict of hand-coded position -> list of predicted positions (in the
+        block).
+    """
+    by_key = {}
+    for a, keys in enumerate(pred_keys):
+        for key in keys:
+            by_key.setdefault(key, []).append(a)
+    everything = list(range(len(pred_keys)))
+    pairs = {}
+    for b, keys in enumerate(true_keys):
+        lists = [by_key[key] for key in keys if key in by_key]
+        rare = [rows for rows in lists if len(rows) <= MAX_KEY_ENTRIES]
+        candidates = set()
+        for rows in rare or lists:
+            candidates.update(rows)
+        pairs[b] = sorted(candidates) if candidates else everything
+    return pairs
+
+
+def _components(edges):
+    """ Connected components of pairs of entries: lists of (hand-coded
+        positions, predicted positions) that can be assigned separately.
+
+    Args:
+        edges (iterable): (hand-coded position, predicted position) pairs
+    """
+    parent = {}
+
+    def find(x):
+        while parent.setdefault(x, x) != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    edges = list(edges)
+    for b, a in edges:
+        parent[find(("p", a))] = find(("t", b))
+    components = {}
+    for b, a in edges:
+        true_rows, pred_rows = components.setdefault(find(("t", b)),
+                                                     (set(), set()))
+        true_rows.add(b)
+        pred_rows.add(a)
+    return [(sorted(t), sorted(p)) for t, p in components.values()]
+
+
+def _assign(true_pos, pred_pos, pair_score, min_score):
+    """ Assignment maximizing the total pair_score(b, a) of the given
+        entries, as (hand-coded position, predicted position, score) for the
+        pairs scoring at least min_score."""
+    score = np.empty((len(pred_pos), len(true_pos)))
+    for i, a in enumerate(pred_pos):
+        for j, b in enumerate(true_pos):
+            score[i, j] = pair_score(b, a)
+    return [(true_pos[j], pred_pos[i], score[i, j])
+            for i, j in linear_sum_assignment(-score)
+            if score[i, j] >= min_score]
+
+
+@profiling.profiled("align_entries")
+def align_entries(pred_data, true_data, block_cols=None,
+                  company_col="Pipeline Company", length_col="Pipeline Length",
+                  company_weight=0.7, min_score=0.5):
+    """ Align predicted entries with hand-coded entries.
+
+    Candidates are only compared within blocks of equal block_cols values.
+    Each pair is scored by a weighted mix of company name and mileage
+    similarity, and the assignment maximizing the total score is kept. Within
+    a block, entries are first only compared if their company names share a
+    key (see company_keys and _candidate_pairs), and the assignment is solved
+    separately for each group of entries linked by near-identical names
+    (LINK_SIMILARITY); the entries left over are then compared with each
+    other. The cost grows with the number of entries and the group sizes
+    rather than with all pairs of rows of a block.
+
+    Args:
+        pred_data (pd.DataFrame): predicted entries
+        true_data (pd.DataFrame): hand-coded entries
+        block_cols (list): columns to block on; defaults to the BLOCK_COLS
+            present in both dataframes
+        company_col (str): column with the company name
+        length_col (str): column with the pipeline length
+        company_weight (float): weight of the company similarity in the score
+            (the mileage similarity gets the rest)
+        min_score (float): pairs scoring below this are not matched
+
+    Returns:
+        dict with
+            "matched": pd.DataFrame of aligned pairs, with pred columns
+                suffixed "_pred", true columns suffixed "_true" and a
+                "match_score" column
+            "missed": pd.DataFrame of hand-coded entries with no prediction
+            "hallucinated": pd.DataFrame of predicted entries with no
+                hand-coded counterpart
+    """
+    if block_cols is None:
+        block_cols = [c for c in BLOCK_COLS
+                      if c in pred_data.columns and c in true_data.columns]
+
+    pred_names = pred_data[company_col].map(normalize_company).to_numpy()
+    true_names = true_data[company_col].map(normalize_company).to_numpy()
+    pred_len = pd.to_numeric(pred_data[length_col], errors="coerce").to_numpy()
+    true_len = pd.to_numeric(true_data[length_col], errors="coerce").to_numpy()
+
+    # positional indices of the rows in each block
+    pred_blocks = pd.Series(np.arange(len(pred_data))).groupby(
+        _block_keys(pred_data, block_cols).to_numpy()).agg(list).to_dict()
+    true_blocks = pd.Series(np.arange(len(true_data))).groupby(
+        _block_keys(true_data, block_cols).to_numpy()).agg(list).to_dict()
+
+    pred_idx, true_idx, scores = [], [], []
+    for key, block_true in true_blocks.items():
+        block_pred = pred_blocks.get(key)
+        if not block_pred:
+            continue
+        # company_similarity of the block's pairs (positions in the block),
+        # with the hand-coded side of each matcher built once
+        matchers = {}
+
+        def matcher(b, a):
+            if b not in matchers:
+                matchers[b] = SequenceMatcher(None, b=true_names[block_true[b]],
+                                              autojunk=False)
+            matchers[b].set_seq1(pred_names[block_pred[a]])
+            return matchers[b]
+
+        # scores of the pairs that can be matched, skipping the others on
+        # upper bounds of their company similarity
+        scored, links = {}, []
+
+        def pair_score(b, a):
+            if scored.get((b, a)) is not None:
+                return scored[b, a]
+            return (company_weight * matcher(b, a).ratio() +
+                    (1 - company_weight) *
+                    mileage_similarity(pred_len[block_pred[a]],
+                                       true_len[block_true[b]]))
+
+        def score_pair(b, a):
+            if (b, a) in scored:
+                return
+            scored[b, a] = None
+            p, t = block_pred[a], block_true[b]
+            mileage = (1 - company_weight) * mileage_similarity(pred_len[p],
+                                                                true_len[t])
+            # (the similarity is at most 2 * shorter / total length)
+            bound = 2 * min(len(pred_names[p]), len(true_names[t])) / max(
+                1, len(pred_names[p]) + len(true_names[t]))
+            if company_weight * bound + mileage < min_score:
+                return
+            pair_matcher = matcher(b, a)
+            if company_weight * pair_matcher.quick_ratio() + mileage < min_score:
+                return
+            similarity = pair_matcher.ratio()
+            if company_weight * similarity + mileage >= min_score:
+                scored[b, a] = company_weight * similarity + mileage
+                if similarity >= LINK_SIMILARITY:
+                    links.append((b, a))
+
+        # the candidate pairs first: each group of entries linked by them
+        # (same company) is assigned on all of its pair scores, as low scores
+        # also weigh in the assignment
+        pairs = _candidate_pairs([company_keys(pred_names[p]) for p in block_pred],
+                                 [company_keys(true_names[t]) for t in block_true])
+        for b, candidates in pairs.items():
+            for a in candidates:
+                score_pair(b, a)
+        block_matches = []
+        for true_pos, pred_pos in _components(links):
+            block_matches += _assign(true_pos, pred_pos, pair_score, min_score)
+        # then the few entries left over (misread names, sharing no key or
+        # link) are compared with each other and assigned on those scores
+        true_done = {b for b, _, _ in block_matches}
+        pred_done = {a for _, a, _ in block_matches}
+        pred_left = [a for a in range(len(block_pred)) if a not in pred_done]
+        for b in range(len(block_true)):
+            if b not in true_done:
+                for a in pred_left:
+                    score_pair(b, a)
+        rest = [(b, a) for (b, a), s in scored.items() if s is not None and
+                b not in true_done and a not in pred_done]
+        for true_pos, pred_pos in _components(rest):
+            block_matches += _assign(true_pos, pred_pos,
+                                     lambda b, a: scored.get((b, a)) or 0.0,
+                                     min_score)
+        block_matches = sorted((block_pred[a], block_true[b], s)
+                               for b, a, s in block_matches)
+        for p, t, s in block_matches:
+            pred_idx.append(p)
+            true_idx.append(t)
+            scores.append(s)
+
+    matched = pd.concat([
+        pred_data.iloc[pred_idx].add_suffix("_pred").reset_index(drop=True),
+        true_data.iloc[true_idx].add_suffix("_true").reset_index(drop=True),
+    ], axis=1)
+    matched["match_score"] = scores
+
+    missed = true_data.iloc[np.setdiff1d(np.arange(len(true_data)), true_idx)]
+    hallucinated = pred_data.iloc[
+        np.setdiff1d(np.arange(len(pred_data)), pred_idx)]
+
+    return {"matched": matched, "missed": missed,
+            "hallucinated": hallucinated}
+
+
+def column_accuracy(alignment, columns, n_true=None):
+    """ Per-column accuracy of aligned entries.
+
+    Args:
+        alignment (dict): output of align_entries
+        columns (list): columns to compare
+        n_true (int): number of hand-coded entries; defaults to matched +
+            missed, so missed entries count as incorrect
+
+    Returns:
+        dict of column name to accuracy (float), or None if there are no
+        hand-coded entries.
+    """
+    matched = alignment["matched"]
+    if n_true is None:
+        n_true = len(matched) + len(alignment["missed"])
+    accuracy = {}
+    for col in columns:
+        if n_true == 0:
+            accuracy[col] = None
+            continue
+        pred = matched[f"{col}_pred"]
+        true = matched[f"{col}_true"]
+        if pd.api.types.is_numeric_dtype(pred) and pd.api.types.is_numeric_dtype(true):
+            correct = np.isclose(pred.astype(float), true.astype(float)).sum()
+        else:
+            correct = (pred.astype(str).str.strip().str.upper() ==
+                       true.astype(str).str.strip().str.upper()).sum()
+        accuracy[col] = float(correct / n_true)
+    return accuracy
@@ -0,0 +1,104 @@
+# ------------------------------------------------------------------------------
+# Cost of decoding responses ---------------------------------------------------
+# ------------------------------------------------------------------------------
+# Run from the repository root:
+#     python source/bench_decode.py
+#     python source/bench_decode.py --entries 50 200 1000 --compact
+#
+# Builds sample pages for each page schema, writes them as the model would, and
+# times turning the response text into the page's DataFrame:
+#   parsed: what the SDK does with a pydantic response schema (model_validate_json
+#       builds the page and every entry) followed by page_to_dataframe;
+#   fast: what the SDK does with PageDecoder.response_schema (the compiled
+#       validator) followed by PageDecoder.to_dataframe (PagesLib/decode.py).
+# Both must give the same DataFrame.
+import time
+import argparse
+
+from PagesLib import Page
+from PagesLib.Page import page_to_dataframe
+from PagesLib.compact import compact_schema
+from PagesLib.decode import page_decoder
+from bench_schema import sample_page
+
+# ------------------------------------------------------------------------------
+# -- PARAMETERS ----------------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+# Entries per sample page (dense directory pages have 30 to 60; the largest
+# windows return a few hundred)
+ENTRIES = [40, 200, 1000]
+
+# Decodes timed per page size (the best of REPEATS runs is kept)
+DECODES = 20
+REPEATS = 5
+
+# ------------------------------------------------------------------------------
+# -- Define functions ----------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+
+def best_time(decode, text, decodes=DECODES, repeats=REPEATS):
+    """ Seconds per decode of text (best of repeats runs of decodes calls)."""
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(decodes):
+            decode(text)
+        best = min(best, (time.perf_counter() - start) / decodes)
+    return best
+
+
+def compare(page_schema, n_entries, compact=False):
+    """
+    Decoding time of a sample page with the parsed and the fast path.
+
+    Args:
+        page_schema (type): Page schema.
+        n_entries (int): Entries on the page.
+        compact (bool): If True, the response uses the compact schema.
+
+    Output:
+        Returns a dict with the seconds per page of both paths.
+    """
+    page = sample_page(page_schema, n_entries)
+    wire = compact_schema(page_schema) if compact else None
+    text = (wire.compact_page(page) if compact else page).model_dump_json()
+    wire_page = wire.page_model if compact else page_schema
+    decoder = page_decoder(page_schema, compact)
+
+    def parsed(text):
+        parsed = wire_page.model_validate_json(text)
+        if compact:
+            parsed = wire.expand_page(parsed)
+        return page_to_dataframe(parsed)
+
+    def fast(text):
+        parsed = decoder.response_schema.model_validate_json(text)
+        return decoder.to_dataframe(parsed)
+
+    if not parsed(text).equals(fast(text)):
+        raise AssertionError(f"{page_schema.__name__}: the decoded pages differ")
+    return {"parsed": best_time(parsed, text), "fast": best_time(fast, text)}
+
+
+# ------------------------------------------------------------------------------
+# -- Execution -----------------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the parsed and fast decoding of responses.")
+    parser.add_argument("--entries", type=int, nargs="+", default=ENTRIES)
+    parser.add_argument("--compact", action="store_true",
+                        help="Responses use the compact schema.")
+    args = parser.parse_args()
+
+    print(f"ms per page ({'compact' if args.compact else 'full'} schema)")
+    print(f"{'schema':<22} {'entries':>8} {'parsed':>9} {'fast':>9} {'speedup':>8}")
+    for page_schema in Page.PAGE_FIELDS:
+        for n_entries in args.entries:
+            times = compare(page_schema, n_entries, args.compact)
+            print(f"{page_schema.__name__:<22} {n_entries:>8} "
+                  f"{times['parsed'] * 1000:>9.2f} {times['fast'] * 1000:>9.2f} "
+                  f"{times['parsed'] / times['fast']:>7.1f}x")
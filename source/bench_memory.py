@@ -0,0 +1,259 @@
+# ------------------------------------------------------------------------------
+# Memory benchmark for large scans ---------------------------------------------
+# ------------------------------------------------------------------------------
+# Run from the repository root:
+#     python source/bench_memory.py
+#
+# Digitizes synthetic scans of increasing length (pages with a large image-like
+# content stream) with an offline client that returns a fixed page, each in a
+# fresh interpreter, and reports the peak resident memory of the process. In
+# low-memory mode the peak must stay flat: the run fails (exit code 1) if it
+# grows by more than the tolerance between the shortest and longest scan.
+# The API is not called.
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+from types import SimpleNamespace
+
+# ------------------------------------------------------------------------------
+# -- PARAMETERS ----------------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+# Number of pages of the synthetic scans
+PAGE_COUNTS = [10, 100, 500, 2000]
+
+# Size of each page's content stream, in KB (scanned pages are mostly image data)
+PAGE_KB = 100
+
+# Entries returned for each page
+ENTRIES_PER_PAGE = 40
+
+# Allowed growth of the peak memory from the shortest to the longest scan, in MB
+TOLERANCE_MB = 40
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULT_MARKER = "bench_memory result: "
+
+# ------------------------------------------------------------------------------
+# -- Define classes ------------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+
+class OfflineFiles:
+    """ File API of the offline client (keeps names only)."""
+
+    def __init__(self):
+        self.store = {}
+        self._lock = threading.Lock()
+        self._n = 0
+
+    def list(self):
+        with self._lock:
+            return list(self.store.values())
+
+    def upload(self, file, config):
+        with self._lock:
+            self._n += 1
+            uploaded_file = SimpleNamespace(
+                name=f"files/{self._n}", display_name=config["display_name"],
+                size_bytes=os.path.getsize(file))
+            self.store[uploaded_file.name] = uploaded_file
+        return uploaded_file
+
+    def delete(self, name):
+        with self._lock:
+            self.store.pop(name, None)
+
+
+class OfflineModels:
+    """ Models API of the offline client: every page gets the same entries."""
+
+    def __init__(self, page_schema):
+        from PagesLib.Page import entry_model
+
+        entry_class = entry_model(page_schema)
+        # built without validation, the values only need to fill the columns
+        entries = [entry_class.model_construct(
+            **{field: f"{field} {i}" for field in entry_class.model_fields})
+            for i in range(ENTRIES_PER_PAGE)]
+        page_fields = {field: None for field in page_schema.model_fields}
+        page_fields["entries"] = entries
+        self.page = page_schema.model_construct(**page_fields)
+
+    def generate_content(self, model, contents, config):
+        time.sleep(0.001)
+        return SimpleNamespace(
+            parsed=self.page, text="",
+            candidates=[SimpleNamespace(finish_reason=SimpleNamespace(name="STOP"))],
+            usage_metadata=SimpleNamespace(prompt_token_count=0,
+                                           candidates_token_count=0))
+
+
+class OfflineClient:
+    def __init__(self, page_schema):
+        self.files = OfflineFiles()
+        self.models = OfflineModels(page_schema)
+
+
+# ------------------------------------------------------------------------------
+# -- Define functions ----------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+
+def make_pdf(path, n_pages, page_kb=PAGE_KB):
+    """
+    Write a PDF of n_pages, each with a page_kb KB content stream of random
+    bytes (in a comment, so the page renders blank).
+
+    Args:
+        path (str): Path of the PDF.
+        n_pages (int): Number of pages.
+        page_kb (int): Size of each page's content stream in KB.
+    """
+    rng = random.Random(0)
+    offsets = []
+    with open(path, "wb") as file:
+        def add_object(body):
+            offsets.append(file.tell())
+            file.write(f"{len(offsets)} 0 obj\n".encode() + body + b"\nendobj\n")
+
+        file.write(b"%PDF-1.4\n")
+        kids = " ".join(f"{3 + 2 * i} 0 R" for i in range(n_pages))
+        add_object(b"<< /Type /Catalog /Pages 2 0 R >>")
+        add_object(f"<< /Type /Pages /Kids [{kids}] /Count {n_pages} >>".encode())
+        for i in range(n_pages):
+            add_object(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                       f"/Contents {4 + 2 * i} 0 R >>".encode())
+            data = b"%" + rng.randbytes(page_kb * 1024).hex().encode()[:page_kb * 1024] + b"\n"
+            add_object(f"<< /Length {len(data)} >>\nstream\n".encode()
+                       + data + b"\nendstream")
+        xref = file.tell()
+        file.write(f"xref\n0 {len(offsets) + 1}\n0000000000 65535 f \n".encode())
+        for offset in offsets:
+            file.write(f"{offset:010d} 00000 n \n".encode())
+        file.write(f"trailer\n<< /Size {len(offsets) + 1} /Root 1 0 R >>\n"
+                   f"startxref\n{xref}\n%%EOF\n".encode())
+
+
+def measure_run(n_pages, low_memory=True, max_concurrency=4):
+    """
+    Digitize a synthetic scan in this process and measure its memory.
+
+    Args:
+        n_pages (int): Number of pages of the scan.
+        low_memory (bool): Run in low-memory mode.
+        max_concurrency (int): Pages processed at the same time.
+
+    Output:
+        Returns a dict with the baseline and peak resident memory in MB (the
+        baseline is measured after the imports) and the elapsed seconds.
+    """
+    import psutil
+    import config
+    import run_log
+    from PagesLib import digitizer
+
+    process = psutil.Process()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pdf_path = os.path.join(tmp_dir, "scan.pdf")
+        make_pdf(pdf_path, n_pages)
+        client = OfflineClient(config.page_schema)
+        run_log.set_current(run_log.RunLogger(None, "bench_memory",
+                                              console_level="ERROR"))
+
+        baseline = process.memory_info().rss
+        peak = baseline
+        done = threading.Event()
+
+        def sample():
+            nonlocal peak
+            while not done.is_set():
+                peak = max(peak, process.memory_info().rss)
+                time.sleep(0.01)
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+        start = time.time()
+        try:
+            digitizer.process_pages(client, pdf_path, model=config.page_schema,
+                                    prompt_text="", model_id="offline",
+                                    total_pages=n_pages, start_page=1,
+                                    outfile_path=os.path.join(tmp_dir, "out.csv"),
+                                    intermediate_dir=tmp_dir,
+                                    max_concurrency=max_concurrency,
+                                    low_memory=low_memory)
+        finally:
+            done.set()
+            sampler.join()
+    return {"pages": n_pages, "baseline_mb": baseline / 1024**2,
+            "peak_mb": peak / 1024**2, "elapsed_s": time.time() - start}
+
+
+def run_benchmark(page_counts=PAGE_COUNTS, low_memory=True,
+                  tolerance_mb=TOLERANCE_MB):
+    """
+    Measure each scan length in a fresh interpreter.
+
+    Args:
+        page_counts (list): Number of pages of each scan.
+        low_memory (bool): Run in low-memory mode.
+        tolerance_mb (float): Allowed growth of the peak memory (low-memory only).
+
+    Output:
+        Returns True if the peak memory stays within the tolerance.
+    """
+    print(f"{'pages':>6} {'baseline MB':>12} {'peak MB':>8} {'growth MB':>10} "
+          f"{'seconds':>8}")
+    results = []
+    for n_pages in page_counts:
+        command = [sys.executable, os.path.abspath(__file__), "--child",
+                   str(n_pages)]
+        if not low_memory:
+            command.append("--keep-in-memory")
+        result = subprocess.run(command, cwd=os.path.dirname(SOURCE_DIR),
+                                capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"Run with {n_pages} pages failed:\n{result.stderr}")
+        # (the progress view also goes to stdout)
+        measure = json.loads(result.stdout.rsplit(RESULT_MARKER, 1)[1])
+        results.append(measure)
+        print(f"{n_pages:>6} {measure['baseline_mb']:>12.1f} "
+              f"{measure['peak_mb']:>8.1f} "
+              f"{measure['peak_mb'] - measure['baseline_mb']:>10.1f} "
+              f"{measure['elapsed_s']:>8.1f}")
+
+    growth = ((results[-1]["peak_mb"] - results[-1]["baseline_mb"])
+              - (results[0]["peak_mb"] - results[0]["baseline_mb"]))
+    print(f"Peak memory growth from {page_counts[0]} to {page_counts[-1]} "
+          f"pages: {growth:.1f} MB")
+    return not low_memory or growth <= tolerance_mb
+
+
+# ------------------------------------------------------------------------------
+# -- Execution -----------------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check that memory stays flat on long scans.")
+    parser.add_argument("--pages", type=int, nargs="+", default=PAGE_COUNTS)
+    parser.add_argument("--keep-in-memory", action="store_true",
+                        help="Measure the default mode instead (no check).")
+    parser.add_argument("--tolerance-mb", type=float, default=TOLERANCE_MB)
+    parser.add_argument("--child", type=int, default=None,
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        sys.path.insert(0, SOURCE_DIR)
+        print(RESULT_MARKER + json.dumps(
+            measure_run(args.child, low_memory=not args.keep_in_memory)))
+        sys.exit(0)
+    sys.exit(0 if run_benchmark(args.pages, not args.keep_in_memory,
+                                args.tolerance_mb) else 1)
@@ -0,0 +1,134 @@
+# ------------------------------------------------------------------------------
+# Output size of the compact response schema -----------------------------------
+# ------------------------------------------------------------------------------
+# Run from the repository root:
+#     python source/bench_schema.py
+#     python source/bench_schema.py --api   # exact Gemini token counts
+#
+# Builds sample pages for each page schema, writes them as the model would
+# with the full and with the compact schema (PagesLib/compact.py), checks that
+# the compact page expands back to the same page, and compares their size.
+# Without --api, tokens are estimated (each run of letters, of digits or of
+# punctuation counts as one token).
+import re
+import random
+import argparse
+
+from PagesLib import Page
+from PagesLib.compact import compact_schema
+
+# ------------------------------------------------------------------------------
+# -- PARAMETERS ----------------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+# Entries per sample page (dense directory pages have 30 to 60)
+ENTRIES_PER_PAGE = 40
+
+SAMPLE_VALUES = {
+    "company": ["Texas Eastern Transmission Corp.", "El Paso Natural Gas Co.",
+                "Tennessee Gas Transmission Co.", "Humble Pipe Line Co.",
+                "Northern Natural Gas Co."],
+    "state": ["TX", "LA", "OK", "NM", "KS", "MS"],
+    "city": ["Houston", "Monroe", "Tulsa", "Hobbs", "NA"],
+    "county": ["Harris", "Ouachita", "Lea", "UNK"],
+    "diameter": ["20", "24", "26 & 30", "10 3/4"],
+    "description": ["Compressor station", "Gas field", "NA", "UNK"],
+}
+
+# ------------------------------------------------------------------------------
+# -- Define functions ----------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+
+def sample_value(name, annotation, rng):
+    """ Plausible value of an entry field."""
+    if hasattr(annotation, "__args__") and annotation.__args__:
+        return rng.choice(annotation.__args__)  # Literal
+    if annotation is float:
+        return round(rng.uniform(0.5, 300), 1)
+    if annotation is int:
+        return rng.randint(1, 500)
+    if annotation is bool:
+        return rng.random() < 0.5
+    if name == "length_by_diameter":
+        return f"{rng.randint(1, 90)} mi of {rng.choice(SAMPLE_VALUES['diameter'])} in"
+    for kind in ["company", "state", "city", "county", "diameter", "description"]:
+        if kind in name:
+            return rng.choice(SAMPLE_VALUES[kind])
+    return rng.choice(SAMPLE_VALUES["state"])  # state_heading
+
+
+def sample_page(page_schema, n_entries=ENTRIES_PER_PAGE, seed=0):
+    """ Page of page_schema with n_entries plausible entries."""
+    rng = random.Random(seed)
+    entry_schema = Page.entry_model(page_schema)
+    entries = [entry_schema(**{name: sample_value(name, field.annotation, rng)
+                               for name, field in entry_schema.model_fields.items()})
+               for _ in range(n_entries)]
+    return page_schema(pgnum=12, yr=1950, entries=entries)
+
+
+def estimate_tokens(text):
+    """ Rough token count: runs of letters, of digits and of punctuation
+        (tokenizers merge JSON punctuation such as '":"' into one token)."""
+    return len(re.findall(r"[A-Za-z]+|\d+|[^\sA-Za-z\d]+", text))
+
+
+def compare(page_schema, count_tokens=estimate_tokens, n_entries=ENTRIES_PER_PAGE):
+    """
+    Size of a sample page with the full and the compact schema.
+
+    Args:
+        page_schema (type): Page schema.
+        count_tokens (callable): Text -> number of tokens.
+        n_entries (int): Entries on the page.
+
+    Output:
+        Returns a dict with the characters and tokens of both responses.
+    """
+    page = sample_page(page_schema, n_entries)
+    wire = compact_schema(page_schema)
+    compact = wire.compact_page(page)
+    if wire.expand_page(compact) != page:
+        raise AssertionError(f"{page_schema.__name__}: compact page does not "
+                             "expand back to the same page")
+    full_text = page.model_dump_json()
+    compact_text = compact.model_dump_json()
+    return {"full_chars": len(full_text), "compact_chars": len(compact_text),
+            "full_tokens": count_tokens(full_text),
+            "compact_tokens": count_tokens(compact_text)}
+
+
+# ------------------------------------------------------------------------------
+# -- Execution -----------------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare response sizes with the full and compact schemas.")
+    parser.add_argument("--api", action="store_true",
+                        help="Count tokens with the Gemini API.")
+    parser.add_argument("--model", default="gemini-2.5-pro")
+    parser.add_argument("--entries", type=int, default=ENTRIES_PER_PAGE)
+    args = parser.parse_args()
+
+    count_tokens = estimate_tokens
+    if args.api:
+        from main import make_client
+
+        client = make_client()
+
+        def count_tokens(text):
+            return client.models.count_tokens(model=args.model,
+                                              contents=text).total_tokens
+
+    print(f"{args.entries} entries per page, tokens "
+          f"{'from the API' if args.api else 'estimated'}")
+    print(f"{'schema':<22} {'full tok':>9} {'compact tok':>12} {'saved':>7} "
+          f"{'full chars':>11} {'compact chars':>14}")
+    for page_schema in Page.PAGE_FIELDS:
+        sizes = compare(page_schema, count_tokens, args.entries)
+        saved = 1 - sizes["compact_tokens"] / sizes["full_tokens"]
+        print(f"{page_schema.__name__:<22} {sizes['full_tokens']:>9} "
+              f"{sizes['compact_tokens']:>12} {saved:>7.0%} "
+              f"{sizes['full_chars']:>11} {sizes['compact_chars']:>14}")
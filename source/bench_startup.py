@@ -0,0 +1,137 @@
+# ------------------------------------------------------------------------------
+# Startup time benchmark for cli.py --------------------------------------------
+# ------------------------------------------------------------------------------
+# Run from the repository root:
+#     python source/bench_startup.py
+#
+# For each cli.py command, imports what the command imports in a fresh
+# interpreter, and fails (exit code 1) if that takes longer than its budget or
+# loads a library the command should not need.
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+# ------------------------------------------------------------------------------
+# -- PARAMETERS ----------------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+# Modules imported by each command of cli.py
+COMMAND_IMPORTS = {
+    "cli": ["cli"],
+    "plan": ["cli", "config", "run_config", "PagesLib.document"],
+    "export": ["cli", "convert", "PagesLib.Page"],
+    "eval": ["cli", "eval"],
+    "sample": ["cli", "generate_test_sample.__main__"],
+    "dedup": ["cli", "dedup"],
+    "companies": ["cli", "companies"],
+    "query": ["cli", "config", "results_db"],
+    "digitize": ["cli", "main"],
+}
+
+# Libraries each command must not load
+FORBIDDEN = {
+    "cli": ["google.genai", "pandas", "pydantic", "PyPDF2", "pdf2image"],
+    "plan": ["google.genai", "pandas", "pdf2image"],
+    "export": ["google.genai", "pandas", "PyPDF2", "pdf2image"],
+    "eval": ["google.genai", "PyPDF2", "pdf2image"],
+    "sample": ["google.genai", "pdf2image"],
+    "dedup": ["google.genai", "pydantic", "PyPDF2", "pdf2image"],
+    "companies": ["google.genai", "pydantic", "PyPDF2", "pdf2image"],
+    "query": ["google.genai", "PyPDF2", "pdf2image"],
+    "digitize": [],
+}
+
+# Import time budgets in seconds (on top of the interpreter start up)
+BUDGETS = {
+    "cli": 0.05,
+    "plan": 0.4,
+    "export": 0.6,
+    "eval": 1.0,
+    "sample": 1.2,
+    "dedup": 0.8,
+    "companies": 0.8,
+    "query": 1.0,
+    "digitize": 2.5,
+}
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# ------------------------------------------------------------------------------
+# -- Define functions ----------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+
+def time_imports(modules, repeat=5):
+    """
+    Best wall time of importing modules in a fresh interpreter, and the
+    modules it loaded.
+
+    Args:
+        modules (list): Module names to import.
+        repeat (int): Number of runs (the fastest is kept).
+
+    Output:
+        Returns (seconds, set of loaded module names).
+    """
+    code = "; ".join(f"import {module}" for module in modules) if modules else "pass"
+    best = float("inf")
+    loaded = set()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                                cwd=SOURCE_DIR, capture_output=True, text=True)
+        elapsed = time.perf_counter() - start
+        if result.returncode != 0:
+            raise RuntimeError(f"Importing {modules} failed:\n{result.stderr}")
+        best = min(best, elapsed)
+        # -X importtime lines: "import time: self | cumulative | module"
+        loaded = {line.rsplit("|", 1)[1].strip()
+                  for line in result.stderr.splitlines()
+                  if line.startswith("import time:") and line.count("|") == 2}
+    return best, loaded
+
+
+def run_benchmark(repeat=5, budget_scale=1.0):
+    """
+    Time the imports of every command against its budget.
+
+    Args:
+        repeat (int): Number of runs per command.
+        budget_scale (float): Multiplier of the budgets (for slower machines).
+
+    Output:
+        Returns True if all the commands are within budget.
+    """
+    baseline, _ = time_imports([], repeat)
+    print(f"Interpreter start up: {baseline:.3f}s")
+    print(f"{'command':<10} {'seconds':>8} {'budget':>8}  result")
+
+    ok = True
+    for command, modules in COMMAND_IMPORTS.items():
+        elapsed, loaded = time_imports(modules, repeat)
+        elapsed = max(0.0, elapsed - baseline)
+        budget = BUDGETS[command] * budget_scale
+        problems = [f"loads {name}" for name in FORBIDDEN[command]
+                    if name in loaded]
+        if elapsed > budget:
+            problems.append("over budget")
+        ok = ok and not problems
+        print(f"{command:<10} {elapsed:>8.3f} {budget:>8.3f}  "
+              f"{', '.join(problems) if problems else 'ok'}")
+    return ok
+
+
+# ------------------------------------------------------------------------------
+# -- Execution -----------------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check the start up time of the cli.py commands.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--budget-scale", type=float, default=1.0)
+    args = parser.parse_args()
+
+    sys.exit(0 if run_benchmark(args.repeat, args.budget_scale) else 1)
@@ -0,0 +1,165 @@
+# ------------------------------------------------------------------------------
+# Load libraries ---------------------------------------------------------------
+# ------------------------------------------------------------------------------
+import warnings
+import numpy as np
+import pandas as pd
+
+import profiling
+
+# ------------------------------------------------------------------------------
+# -- Define functions ----------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Bootstrap confidence intervals of the mileage metrics of eval_performance.
+#
+# Every mileage metric compares the predicted and hand-coded miles of a group of
+# entries (all entries, a fuel type, new complete natural gas pipelines of a
+# year, ...). The entries are split into resampling units (pages, or aligned
+# entries: matched pairs, missed and hallucinated entries), and each unit's
+# miles in each group are summed once into a units x groups matrix. A resample
+# is then a vector of counts (how many times each unit was drawn), and the
+# miles of every group in every resample are one matrix product of the counts
+# with these matrices: no loop over resamples or groups.
+
+# Column with the mileage of an entry (hand-coded name, see eval.PRED_TO_TRUE_COLS)
+LENGTH_COL = "Pipeline Length"
+
+# Largest counts matrix built at once (resamples x units); more resamples are
+# drawn in chunks of this size
+MAX_CHUNK_CELLS = 4_000_000
+
+
+def group_miles(df, groups, suffix=""):
+    """
+    Miles of each entry counted in each group.
+
+    Args:
+        df (pd.DataFrame): entries (hand-coded column names)
+        groups (list): conditions of each group, as {column: value} dicts
+            (an empty dict is all entries)
+        suffix (str): suffix of the column names in df (e.g. "_pred" for the
+            predicted side of aligned pairs)
+
+    Returns:
+        np.ndarray of shape (entries, groups): the entry's miles where it is in
+        the group, else 0 (also 0 for unknown or missing lengths).
+    """
+    from eval import UNKNOWN_LENGTHS  # (eval imports this module)
+
+    length = pd.to_numeric(df[LENGTH_COL + suffix], errors="coerce").to_numpy(float)
+    length = np.where(np.isnan(length) | np.isin(length, UNKNOWN_LENGTHS),
+                      0.0, length)
+    # each distinct condition is evaluated once
+    masks = {}
+    miles = np.zeros((len(df), len(groups)))
+    for j, conditions in enumerate(groups):
+        mask = np.ones(len(df), dtype=bool)
+        for condition in conditions.items():
+            if condition not in masks:
+                col, value = condition
+                masks[condition] = (df[col + suffix] == value).to_numpy()
+            mask &= masks[condition]
+        miles[:, j] = np.where(mask, length, 0.0)
+    return miles
+
+
+def page_units(pred_data, true_data, groups, page_col="Page Number"):
+    """
+    Predicted and hand-coded miles of each page in each group.
+
+    Returns:
+        (pred, true) np.ndarrays of shape (pages, groups), over the pages of
+        either dataframe (entries without a page number form one unit).
+
+    Raises:
+        ValueError: If page_col is missing from either dataframe.
+    """
+    missing = [name for name, df in [("predicted", pred_data),
+                                     ("hand-coded", true_data)]
+               if page_col not in df.columns]
+    if missing:
+        raise ValueError(f"Cannot resample by {page_col}: the "
+                         f"{' and '.join(missing)} data has no such column.")
+    codes, pages = pd.factorize(pd.concat([pred_data[page_col],
+                                           true_data[page_col]]),
+                                use_na_sentinel=False)
+    pred_codes, true_codes = codes[:len(pred_data)], codes[len(pred_data):]
+    pred = np.zeros((len(pages), len(groups)))
+    true = np.zeros((len(pages), len(groups)))
+    np.add.at(pred, pred_codes, group_miles(pred_data, groups))
+    np.add.at(true, true_codes, group_miles(true_data, groups))
+    return pred, true
+
+
+def entry_units(alignment, groups):
+    """
+    Predicted and hand-coded miles of each aligned entry in each group: the
+    matched pairs, then the missed entries (no predicted miles), then the
+    hallucinated entries (no hand-coded miles).
+
+    Args:
+        alignment (dict): output of align.align_entries
+        groups (list): conditions of each group (see group_miles)
+
+    Returns:
+        (pred, true) np.ndarrays of shape (units, groups).
+    """
+    matched, missed, hallucinated = (alignment["matched"], alignment["missed"],
+                                     alignment["hallucinated"])
+    pred = np.vstack([group_miles(matched, groups, "_pred"),
+                      np.zeros((len(missed), len(groups))),
+                      group_miles(hallucinated, groups)])
+    true = np.vstack([group_miles(matched, groups, "_true"),
+                      group_miles(missed, groups),
+                      np.zeros((len(hallucinated), len(groups)))])
+    return pred, true
+
+
+def resample_counts(n_units, n_resamples, rng):
+    """ Number of times each unit is drawn in each resample (n_resamples x
+        n_units), from one array of drawn indices."""
+    drawn = rng.integers(0, n_units, size=(n_resamples, n_units))
+    drawn += (np.arange(n_resamples) * n_units)[:, None]
+    return np.bincount(drawn.ravel(), minlength=n_resamples * n_units).reshape(
+        n_resamples, n_units)
+
+
+@profiling.profiled("bootstrap_mileage")
+def bootstrap_mileage(pred, true, n_resamples=10000, confidence=0.95, seed=0):
+    """
+    Percentile bootstrap intervals of the mileage metrics of each group.
+
+    Args:
+        pred (np.ndarray): predicted miles of each unit in each group
+            (units x groups, see page_units and entry_units)
+        true (np.ndarray): hand-coded miles, same shape
+        n_resamples (int): number of resamples
+        confidence (float): coverage of the intervals
+        seed (int): random seed
+
+    Returns:
+        dict with "mi_pct_err" and "mi_pred_over_true" arrays of shape
+        (groups, 2) (low and high bound; NaN where the hand-coded miles are 0
+        in every resample).
+    """
+    n_units = pred.shape[0]
+    rng = np.random.default_rng(seed)
+    pred_sums = np.empty((n_resamples, pred.shape[1]))
+    true_sums = np.empty((n_resamples, true.shape[1]))
+    chunk = max(1, MAX_CHUNK_CELLS // max(n_units, 1))
+    for start in range(0, n_resamples, chunk):
+        stop = min(n_resamples, start + chunk)
+        counts = resample_counts(n_units, stop - start, rng).astype(float)
+        pred_sums[start:stop] = counts @ pred
+        true_sums[start:stop] = counts @ true
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        true_sums[true_sums <= 0] = np.nan
+        ratio = pred_sums / true_sums
+        pct_err = np.abs(pred_sums - true_sums) / true_sums
+    tail = (1 - confidence) / 2 * 100
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # groups never defined
+        return {metric: np.nanpercentile(values, [tail, 100 - tail], axis=0).T
+                for metric, values in [("mi_pct_err", pct_err),
+                                       ("mi_pred_over_true", ratio)]}
@@ -0,0 +1,109 @@
+# ------------------------------------------------------------------------------
+# Check of the merging of entries extracted more than once ---------------------
+# ------------------------------------------------------------------------------
+# Run from the repository root:
+#     python source/check_dedup.py
+#
+# Builds the extractions of overlapping page windows of a volume whose printed
+# page numbers are the absolute page numbers + 2, where the extraction of page
+# 10 also picked up an entry of the next page (printed page 13, absolute page
+# 11), then merges them with dedup.py, in memory and from a csv (with and
+# without a window). The stray entry must be kept from the extraction of page
+# 11, its own page, with the provenance of both extractions.
+import os
+import sys
+import tempfile
+import pandas as pd
+
+from dedup import dedup_entries, dedup_csv
+
+# ------------------------------------------------------------------------------
+# -- PARAMETERS ----------------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+# Printed page number of each absolute page: absolute page + PAGE_OFFSET
+PAGE_OFFSET = 2
+
+# Pages of the volume, each with these entries (company, length)
+PAGES = {
+    10: [("Alpha Gas Company", 12.5), ("Beta Pipe Line Company", 3.0)],
+    11: [("Gamma Oil Corporation", 40.0), ("Delta Gas Company", 7.25)],
+    12: [("Epsilon Pipeline Company", 1.5)],
+}
+
+# Entry of page 11 also extracted with page 10
+STRAY = ("Gamma Oil Corporation", 40.0)
+
+# ------------------------------------------------------------------------------
+# -- Define functions ----------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+
+def entry(page, company, length, target):
+    """ One digitized entry of absolute page `page`, extracted for `target`."""
+    return {"Data Year": 1950, "Page Number": page + PAGE_OFFSET,
+            "Pipeline Company": company, "Origin State": "TX",
+            "Terminus State": "LA", "Total Pipeline Length": length,
+            "model_id": "check", "absolute_page_n": target}
+
+
+def extractions():
+    """ The entries of each page's extraction, in page order (the extraction
+        of page 10 with the stray entry of page 11)."""
+    rows = []
+    for target, entries in PAGES.items():
+        rows += [entry(target, company, length, target)
+                 for company, length in entries]
+        if target == 10:
+            rows.append(entry(11, *STRAY, target))
+    return pd.DataFrame(rows)
+
+
+def check_merged(merged, label):
+    """ Raise AssertionError if the stray entry was not merged as expected."""
+    n_entries = sum(len(entries) for entries in PAGES.values())
+    assert len(merged) == n_entries, \
+        f"{label}: {len(merged)} entries, expected {n_entries}"
+    stray = merged.loc[merged["Pipeline Company"] == STRAY[0]]
+    assert len(stray) == 1, f"{label}: stray entry kept {len(stray)} times"
+    stray = stray.iloc[0]
+    assert stray["absolute_page_n"] == 11, \
+        f"{label}: stray entry kept from page {stray['absolute_page_n']}"
+    assert (stray["n_extractions"], str(stray["source_pages"])) == (2, "10;11"), \
+        f"{label}: provenance {stray['n_extractions']}, {stray['source_pages']}"
+    single = merged.loc[merged["Pipeline Company"] != STRAY[0]]
+    assert (single["n_extractions"] == 1).all() and (
+        single["source_pages"].astype(str)
+        == single["absolute_page_n"].astype(str)).all(), \
+        f"{label}: wrong provenance of the other entries"
+    print(f"{label}: ok ({len(merged)} entries)")
+
+
+def check():
+    df = extractions()
+    check_merged(dedup_entries(df), "dedup_entries")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        in_path = os.path.join(tmp_dir, "entries.csv")
+        out_path = os.path.join(tmp_dir, "merged.csv")
+        df.to_csv(in_path, index=False)
+        for window in [None, 3]:
+            dedup_csv(in_path, out_path, chunksize=2, window=window)
+            check_merged(pd.read_csv(out_path), f"dedup_csv window={window}")
+        # windows of one page do not overlap: nothing is merged
+        dedup_csv(in_path, out_path, chunksize=2, window=1)
+        n_merged = len(pd.read_csv(out_path))
+        assert n_merged == len(df), \
+            f"dedup_csv window=1: {n_merged} entries, expected {len(df)}"
+        print(f"dedup_csv window=1: ok ({n_merged} entries)")
+
+
+# ------------------------------------------------------------------------------
+# -- Execution -----------------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    try:
+        check()
+    except AssertionError as e:
+        print(f"FAILED: {e}")
+        sys.exit(1)
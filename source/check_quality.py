@@ -0,0 +1,107 @@
+# ------------------------------------------------------------------------------
+# Check of the quality gate on the repository's ground truth -------------------
+# ------------------------------------------------------------------------------
+# Run from the repository root:
+#     python source/check_quality.py
+#     python source/check_quality.py outputs/1947_pg2_groundtruth_clean.xlsx --page 2
+#
+# Builds the QualityGate of quality.py on a hand-coded file (these have no Page
+# Number column, so the gate is keyed on the data year of the pages with ground
+# truth), then scores predictions made from the hand-coded entries themselves,
+# on the page with ground truth and on a sampled page without it:
+#   exact: the hand-coded entries, which must pass;
+#   wrong: the same entries with wrong companies, lengths and fuel types,
+#       which must fail.
+# Also checks that the gate refuses this ground truth without its pages.
+import sys
+import argparse
+
+from eval import load_true_data
+from quality import QualityGate
+
+# ------------------------------------------------------------------------------
+# -- PARAMETERS ----------------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+TRUE_PATHS = ["outputs/1951_pg2_handcoded_JW_cleaned.csv",
+              "outputs/1947_pg2_groundtruth_clean.xlsx"]
+
+# Absolute page of the document covered by the ground truth, and a sampled page
+TRUE_PAGE = 2
+SAMPLED_PAGE = 7
+
+# ------------------------------------------------------------------------------
+# -- Define functions ----------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+
+def predictions(true_data, page, wrong=False):
+    """ Hand-coded entries as the digitizer would save them for a page (with
+        wrong values if wrong)."""
+    pred = true_data.copy()
+    pred["Total Pipeline Length"] = pred.pop("Pipeline Length")
+    pred["Page Number"] = page
+    pred["absolute_page_n"] = page
+    pred["model_id"] = "check"
+    if wrong:
+        pred["Pipeline Company"] = "Zzyzx Pipe Line Company"
+        pred["Total Pipeline Length"] = pred["Total Pipeline Length"] * 3 + 10
+        pred["Fuel Type"] = "UNKNOWN"
+    return pred
+
+
+def check(true_path, page=TRUE_PAGE):
+    """
+    Run the checks on a ground truth file.
+
+    Output:
+        Returns the verdicts, as {case: verdict}, and raises AssertionError if
+        one is not the expected one.
+    """
+    true_data = load_true_data(true_path)
+    try:
+        QualityGate(true_data)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError(f"{true_path}: accepted without quality_pages")
+
+    verdicts = {}
+    for case, wrong, expected in [("exact", False, "pass"),
+                                  ("wrong", True, "fail")]:
+        gate = QualityGate(true_data, min_entries=1, true_pages=[page],
+                           n_sample=2)
+        probes = gate.probe_pages(range(1, 11))
+        assert page in probes, f"{true_path}: page {page} is not probed"
+        # the sampled page has no ground truth: it must not be scored
+        gate.add_page(predictions(true_data, SAMPLED_PAGE, wrong=True),
+                      SAMPLED_PAGE)
+        assert gate.verdict is None, f"{true_path}: judged before page {page}"
+        verdicts[case] = gate.add_page(predictions(true_data, page, wrong), page)
+        print(f"{true_path} {case}: {gate.summary()}")
+        if verdicts[case] != expected:
+            raise AssertionError(f"{true_path} {case}: {verdicts[case]}, "
+                                 f"expected {expected}")
+    return verdicts
+
+
+# ------------------------------------------------------------------------------
+# -- Execution -----------------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check the quality gate on hand-coded ground truth files.")
+    parser.add_argument("true_paths", nargs="*", default=TRUE_PATHS)
+    parser.add_argument("--page", type=int, default=TRUE_PAGE,
+                        help="Absolute page covered by the ground truth.")
+    args = parser.parse_args()
+
+    failed = False
+    for true_path in args.true_paths:
+        try:
+            check(true_path, args.page)
+        except AssertionError as e:
+            print(f"FAILED: {e}")
+            failed = True
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,464 @@
+# ------------------------------------------------------------------------------
+# Command line interface -------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Run from the repository root:
+#     python source/cli.py digitize --gov --start-page 3 --n-pages 10
+#     python source/cli.py plan --prescan
+#     python source/cli.py eval <pred .csv> <hand-coded .csv>
+#     python source/cli.py export <folder of .csv>
+#     python source/cli.py sample <digitized .csv> <scanned .pdf>
+#     python source/cli.py dedup <digitized .csv> [more .csv]
+#     python source/cli.py companies <digitized .csv> [more .csv] --truth <hand-coded>
+#     python source/cli.py query --year 1947 --fuel "NATURAL GAS" --last-runs 5
+#     python source/cli.py import-runs <run folder of pg{N}.csv> [more folders]
+#     python source/cli.py clean-uploads --dry-run
+#
+# Each command imports only the libraries it needs, inside its function, so
+# that e.g. export does not load google.genai or pandas (see bench_startup.py).
+import os
+import json
+import argparse
+
+# ------------------------------------------------------------------------------
+# -- Define functions ----------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+# RunConfig parameters that do not depend on the pipeline type
+RUN_PARAMETERS = ["gemini_model_id", "output_dir", "page_window",
+                  "page_placement", "upload_pages_once", "all_pages",
+                  "start_page", "n_pages", "png", "prescan", "hedge_requests",
+                  "hedge_percentile", "hedge_max_fraction",
+                  "stream_responses", "max_concurrency", "low_memory",
+                  "merge_duplicate_entries", "compact_schema", "fast_decode",
+                  "store_results", "api_key_pool", "quality_true_path",
+                  "quality_pages", "quality_sample", "quality_min_accuracy",
+                  "quality_max_mi_pct_err", "quality_min_entries",
+                  "quality_action", "profile_stages", "profile_memory",
+                  "upload_quota_gb",
+                  "orphan_upload_hours", "log_level", "console_level",
+                  "identifier"]
+
+
+def run_config_from_args(args):
+    """ RunConfig of config.py, with the parameters given on the command line."""
+    import config
+    from run_config import RunConfig
+
+    changes = {}
+    if args.input:
+        changes["input_file_path"] = args.input
+    if args.model:
+        changes["gemini_model_id"] = args.model
+    if args.output_dir:
+        changes["output_dir"] = args.output_dir
+    if args.start_page is not None or args.n_pages is not None:
+        changes["all_pages"] = False
+        changes["start_page"] = args.start_page or config.start_page
+        changes["n_pages"] = args.n_pages or config.n_pages
+    if args.page_window is not None:
+        changes["page_window"] = args.page_window
+    if args.page_placement:
+        changes["page_placement"] = args.page_placement
+    if args.png:
+        changes["png"] = True
+    if args.prescan:
+        changes["prescan"] = True
+    if args.no_prescan:
+        changes["prescan"] = False
+    if args.hedge:
+        changes["hedge_requests"] = True
+    if args.stream:
+        changes["stream_responses"] = True
+    if args.max_concurrency is not None:
+        changes["max_concurrency"] = args.max_concurrency
+    if args.low_memory:
+        changes["low_memory"] = True
+    if args.no_dedup:
+        changes["merge_duplicate_entries"] = False
+    if args.compact:
+        changes["compact_schema"] = True
+    if args.no_fast_decode:
+        changes["fast_decode"] = False
+    if args.no_store:
+        changes["store_results"] = False
+    if args.key_pool:
+        changes["api_key_pool"] = args.key_pool
+    if args.quality:
+        changes["quality_true_path"] = args.quality
+    if args.quality_pages:
+        changes["quality_pages"] = args.quality_pages
+    if args.quality_action:
+        changes["quality_action"] = args.quality_action
+    if args.profile or args.profile_memory:
+        changes["profile_stages"] = True
+    if args.profile_memory:
+        changes["profile_memory"] = True
+
+    if args.gov is None and args.extended is None and not args.input:
+        return config.get_run_config(**changes)
+
+    # pipeline type or input changed: the schema, prompt and output name
+    # follow them
+    gov = config.gov if args.gov is None else args.gov
+    extended = (config.extended_variables if args.extended is None
+                else args.extended)
+    input_file_path = changes.pop("input_file_path", (
+        config.government_file_path if gov else config.private_file_path))
+    base = config.get_run_config(**changes)
+    kept = {name: getattr(base, name) for name in RUN_PARAMETERS}
+    return RunConfig.for_pipelines(input_file_path, gov=gov,
+                                   extended_variables=extended, **kept)
+
+
+def digitize(args):
+    from main import main
+
+    main(run_config_from_args(args))
+
+
+def plan(args):
+    """ Print what digitize would do, without calling the API."""
+    from PagesLib.document import check_document
+
+    rc = run_config_from_args(args)
+    start_page, n_pages = check_document(rc.input_file_path,
+                                         all_pages=rc.all_pages,
+                                         start_page=rc.start_page,
+                                         n_pages=rc.n_pages)
+    summary = {
+        "run_id": rc.run_id,
+        "input": rc.input_file_path,
+        "model_id": rc.gemini_model_id,
+        "prompt": rc.prompt_text_path,
+        "page_schema": rc.page_schema.__name__,
+        "pages": f"{start_page}-{start_page + n_pages - 1}",
+        "n_pages": n_pages,
+        "page_window": rc.page_window,
+        "page_placement": rc.page_placement,
+        "output": os.path.join(rc.results_dir, rc.output_file_name),
+    }
+    if rc.prescan:
+        from PagesLib import prescan
+
+        status = prescan.prescan_pages(rc.input_file_path, start_page, n_pages)
+        summary["blank_pages"] = [N for N, r in status.items()
+                                  if r["status"] == "blank"]
+        summary["duplicate_pages"] = {N: r["duplicate_of"]
+                                      for N, r in status.items()
+                                      if r["status"] == "duplicate"}
+        summary["api_calls"] = sum(r["status"] == "ok" for r in status.values())
+    else:
+        summary["api_calls"] = n_pages
+    print(json.dumps(summary, indent=4))
+
+
+def evaluate(args):
+    from eval import eval_performance
+
+    profiler = None
+    if args.profile:
+        import profiling
+
+        profiler = profiling.StageProfiler(memory=args.profile_memory)
+        profiling.set_current(profiler)
+    try:
+        performance = eval_performance(args.pred_path, args.true_path,
+                                       filter_year_start=args.year_start,
+                                       filter_year_end=args.year_end,
+                                       filter_pg=args.page,
+                                       log=not args.no_log,
+                                       bootstrap=args.bootstrap,
+                                       n_resamples=args.resamples)
+    except ValueError as e:  # inputs that cannot be evaluated this way
+        raise SystemExit(f"eval: {e}")
+    print(json.dumps(performance, indent=4, default=str))
+    if profiler is not None:
+        paths = profiler.write(args.profile, prefix="eval_profile")
+        profiler.close()
+        print(profiler.summary_table())
+        print(f"Profile written to {paths['folded']}")
+
+
+def export(args):
+    from convert import csv_to_xlsx
+    from PagesLib import Page
+
+    csv_to_xlsx(args.input_folder, force=args.force, workers=args.workers,
+                page_schema=getattr(Page, args.schema) if args.schema else None)
+
+
+def dedup(args):
+    """ Merge duplicate entries of digitized csv files (e.g. several runs
+        over the same volume) into one csv."""
+    import pandas as pd
+    from dedup import dedup_entries
+
+    data = pd.concat([pd.read_csv(path) for path in args.input_csv],
+                     ignore_index=True)
+    merged = dedup_entries(data)
+    output = args.output or args.input_csv[0].replace(".csv", "_dedup.csv")
+    merged.to_csv(output, index=False)
+    print(f"{len(data)} entries, {len(merged)} after merging duplicates, "
+          f"saved to {output}")
+
+
+def companies(args):
+    """ Add the canonical company names to digitized csv files (building or
+        extending the company index with their names and the hand-coded
+        ones)."""
+    from companies import build_company_index
+
+    index_path = args.index or os.path.join(
+        os.path.dirname(os.path.abspath(args.input_csv[0])), "company_index.csv")
+    index = build_company_index(args.input_csv, args.truth, index_path,
+                                threshold=args.threshold)
+    for path in args.input_csv:
+        n_rows = index.annotate_csv(path)
+        print(f"{path}: {n_rows} entries")
+    print(f"{len(index.names)} distinct names, {index.n_companies} companies, "
+          f"index saved to {index_path}")
+
+
+def default_db():
+    """ Results database of config.py's output folder. """
+    import config
+
+    return os.path.join(config.output_dir, "results.sqlite")
+
+
+def query(args):
+    """ Print or export entries of the results database. """
+    from results_db import query_entries, export_dataframe
+
+    df = query_entries(args.db or default_db(), year=args.year, fuel=args.fuel,
+                       company=args.company, run_ids=args.run,
+                       last_runs=args.last_runs, where=args.where,
+                       with_runs=args.with_runs)
+    if args.output:
+        export_dataframe(df, args.output)
+        print(f"{len(df)} entries saved to {args.output}")
+    else:
+        print(df.to_string(max_rows=20))
+        print(f"{len(df)} entries")
+
+
+def import_runs(args):
+    """ Add run folders of pg{N}.csv files to the results database. """
+    from results_db import import_run_folder
+
+    db_path = args.db or default_db()
+    for folder in args.folders:
+        n_entries = import_run_folder(db_path, folder)
+        print(f"{folder}: {n_entries} entries")
+
+
+def clean_uploads(args):
+    """ Delete the uploads left in the File API by finished or crashed runs
+        (see PagesLib/uploads.py), for each key of the pool if there is one."""
+    import config
+    from main import make_client
+    from utils import load_api_keys
+    from PagesLib.uploads import clean_uploads as clean, manifest_paths
+
+    rc = config.get_run_config()
+    key_pool = args.key_pool or rc.api_key_pool
+    keys = load_api_keys(key_pool) if key_pool else {"default": None}
+    hours = rc.orphan_upload_hours if args.hours is None else args.hours
+    for name, api_key in keys.items():
+        files = clean(make_client(api_key), manifest_paths(rc.results_dir),
+                      orphan_age=hours, dry_run=args.dry_run)
+        action = "to delete" if args.dry_run else "deleted"
+        print(f"{name}: {len(files)} files {action}")
+        for f in files:
+            print(f"  {f.name} {f.display_name}")
+
+
+def sample(args):
+    from generate_test_sample.__main__ import subset_by_pages
+
+    output_dir = args.output_dir or os.path.join(
+        os.path.dirname(args.input_csv), "tests")
+    subset_by_pages(args.input_csv, args.input_pdf, output_dir, pct=args.pct,
+                    seed=args.seed)
+
+
+def add_run_arguments(parser):
+    """ Options that change the parameters of config.py for one run."""
+    parser.add_argument("--input", default=None,
+                        help="Pdf to digitize (outputs are named after it).")
+    kind = parser.add_mutually_exclusive_group()
+    kind.add_argument("--gov", dest="gov", action="store_true", default=None,
+                      help="Government pipelines.")
+    kind.add_argument("--private", dest="gov", action="store_false",
+                      help="Private pipelines.")
+    variables = parser.add_mutually_exclusive_group()
+    variables.add_argument("--extended", dest="extended", action="store_true",
+                           default=None, help="All variables.")
+    variables.add_argument("--core", dest="extended", action="store_false",
+                           help="Core variables only.")
+    parser.add_argument("--model", default=None, help="Gemini model ID.")
+    parser.add_argument("--output-dir", default=None)
+    parser.add_argument("--start-page", type=int, default=None)
+    parser.add_argument("--n-pages", type=int, default=None)
+    parser.add_argument("--page-window", type=int, default=None)
+    parser.add_argument("--page-placement", default=None,
+                        choices=["top", "middle", "bottom"])
+    parser.add_argument("--png", action="store_true")
+    parser.add_argument("--prescan", action="store_true",
+                        help="Skip blank pages and reuse the data of duplicate "
+                             "pages (see PagesLib/prescan.py).")
+    parser.add_argument("--no-prescan", action="store_true")
+    parser.add_argument("--hedge", action="store_true",
+                        help="Resend requests that are slower than usual.")
+    parser.add_argument("--stream", action="store_true",
+                        help="Stream responses and keep partial pages.")
+    parser.add_argument("--max-concurrency", type=int, default=None,
+                        help="Maximum pages processed at the same time.")
+    parser.add_argument("--low-memory", action="store_true",
+                        help="Keep memory flat on very large scans.")
+    parser.add_argument("--no-dedup", action="store_true",
+                        help="Keep entries extracted more than once.")
+    parser.add_argument("--compact", action="store_true",
+                        help="Short keys and codes in responses.")
+    parser.add_argument("--no-fast-decode", action="store_true",
+                        help="Parse responses into models (response.parsed).")
+    parser.add_argument("--no-store", action="store_true",
+                        help="Write pg{N}.csv files instead of the results database.")
+    parser.add_argument("--key-pool", default=None,
+                        help="File of API keys (one per line) to spread pages across.")
+    parser.add_argument("--quality", default=None, metavar="TRUE_PATH",
+                        help="Score probe pages against this ground truth first.")
+    parser.add_argument("--quality-pages", type=int, nargs="+", default=None,
+                        help="Absolute pages with ground truth (probed first).")
+    parser.add_argument("--quality-action", choices=["abort", "deprioritize"],
+                        default=None, help="What to do with a run that fails.")
+    parser.add_argument("--profile", action="store_true",
+                        help="Time each stage per page (flame graph and summary).")
+    parser.add_argument("--profile-memory", action="store_true",
+                        help="Also measure each stage's memory peak (slower).")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="Digitize scanned directories with Gemini.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    parser_digitize = commands.add_parser(
+        "digitize", help="Digitize a document (parameters from config.py).")
+    add_run_arguments(parser_digitize)
+    parser_digitize.set_defaults(func=digitize)
+
+    parser_plan = commands.add_parser(
+        "plan", help="Show the pages and outputs of a run, without the API.")
+    add_run_arguments(parser_plan)
+    parser_plan.set_defaults(func=plan)
+
+    parser_eval = commands.add_parser(
+        "eval", help="Evaluate digitized data against hand-coded data.")
+    parser_eval.add_argument("pred_path")
+    parser_eval.add_argument("true_path")
+    parser_eval.add_argument("--year-start", type=int, default=1945)
+    parser_eval.add_argument("--year-end", type=int, default=1950)
+    parser_eval.add_argument("--page", type=int, default=None)
+    parser_eval.add_argument("--no-log", action="store_true")
+    parser_eval.add_argument("--bootstrap", default=None,
+                             choices=["pages", "entries"],
+                             help="Confidence intervals of the mileage metrics.")
+    parser_eval.add_argument("--resamples", type=int, default=10000)
+    parser_eval.add_argument("--profile", default=None, metavar="OUT_DIR",
+                             help="Time the evaluation stages, written to OUT_DIR.")
+    parser_eval.add_argument("--profile-memory", action="store_true",
+                             help="With --profile, also measure memory peaks.")
+    parser_eval.set_defaults(func=evaluate)
+
+    parser_export = commands.add_parser(
+        "export", help="Convert a folder of digitized csv files to xlsx.")
+    parser_export.add_argument("input_folder")
+    parser_export.add_argument("--force", action="store_true")
+    parser_export.add_argument("--workers", type=int, default=None)
+    parser_export.add_argument("--schema", default=None,
+                               help="Page schema class name in PagesLib.Page.")
+    parser_export.set_defaults(func=export)
+
+    parser_dedup = commands.add_parser(
+        "dedup", help="Merge entries extracted more than once.")
+    parser_dedup.add_argument("input_csv", nargs="+",
+                              help="Digitized csv files (in extraction order).")
+    parser_dedup.add_argument("--output", default=None,
+                              help="Defaults to the first file + _dedup.csv.")
+    parser_dedup.set_defaults(func=dedup)
+
+    parser_companies = commands.add_parser(
+        "companies", help="Add canonical company names to digitized csv files.")
+    parser_companies.add_argument("input_csv", nargs="+",
+                                  help="Digitized csv files (updated in place).")
+    parser_companies.add_argument("--truth", nargs="+", default=[],
+                                  help="Hand-coded .csv or .xlsx files.")
+    parser_companies.add_argument("--index", default=None,
+                                  help="Company index csv, reused if it exists "
+                                       "(defaults to company_index.csv next to "
+                                       "the first file).")
+    parser_companies.add_argument("--threshold", type=float, default=0.9,
+                                  help="Similarity of two names of a company.")
+    parser_companies.set_defaults(func=companies)
+
+    parser_query = commands.add_parser(
+        "query", help="Entries of the results database (print or export).")
+    parser_query.add_argument("--db", default=None,
+                              help="Defaults to results.sqlite in the output folder.")
+    parser_query.add_argument("--year", type=int, default=None)
+    parser_query.add_argument("--fuel", default=None,
+                              help="Inferred fuel type, e.g. \"NATURAL GAS\".")
+    parser_query.add_argument("--company", default=None)
+    parser_query.add_argument("--run", nargs="+", default=None,
+                              help="Run ids.")
+    parser_query.add_argument("--last-runs", type=int, default=None)
+    parser_query.add_argument("--where", default=None,
+                              help="SQL condition on the run_entries view.")
+    parser_query.add_argument("--with-runs", action="store_true",
+                              help="Add the run id and metadata columns.")
+    parser_query.add_argument("--output", default=None,
+                              help="Save to a .csv, .xlsx or .parquet file.")
+    parser_query.set_defaults(func=query)
+
+    parser_import = commands.add_parser(
+        "import-runs", help="Add run folders of pg{N}.csv to the results database.")
+    parser_import.add_argument("folders", nargs="+")
+    parser_import.add_argument("--db", default=None)
+    parser_import.set_defaults(func=import_runs)
+
+    parser_clean = commands.add_parser(
+        "clean-uploads",
+        help="Delete uploads left in the File API by finished or crashed runs.")
+    parser_clean.add_argument("--hours", type=float, default=None,
+                              help="Age of the uploads of crashed runs to delete "
+                                   "(defaults to orphan_upload_hours).")
+    parser_clean.add_argument("--key-pool", default=None,
+                              help="File of API keys, to clean each key's project.")
+    parser_clean.add_argument("--dry-run", action="store_true",
+                              help="Only list the files.")
+    parser_clean.set_defaults(func=clean_uploads)
+
+    parser_sample = commands.add_parser(
+        "sample", help="Sample pages of a digitized csv for manual checking.")
+    parser_sample.add_argument("input_csv")
+    parser_sample.add_argument("input_pdf")
+    parser_sample.add_argument("--output-dir", default=None)
+    parser_sample.add_argument("--pct", type=float, default=0.05)
+    parser_sample.add_argument("--seed", type=int, default=42)
+    parser_sample.set_defaults(func=sample)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.func(args)
+
+
+# ------------------------------------------------------------------------------
+# -- Execution -----------------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
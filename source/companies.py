@@ -0,0 +1,334 @@
+# ------------------------------------------------------------------------------
+# Load libraries ---------------------------------------------------------------
+# ------------------------------------------------------------------------------
+import os
+import csv
+import functools
+from collections import Counter, defaultdict
+from difflib import SequenceMatcher
+import pandas as pd
+
+from align import normalize_company
+
+# ------------------------------------------------------------------------------
+# -- Define functions ----------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Canonical company names: the "Pipeline Company" values of the outputs vary in
+# spelling, abbreviations and OCR noise across pages and years. The company
+# index maps each normalized name (see align.normalize_company) to a canonical
+# spelling, added to the outputs as the "Company Canonical" column.
+#
+# Names are clustered around leaders: the hand-coded names first, then the
+# other names from the most to the least frequent. A name joins the most
+# similar leader if their cores (the normalized names without legal forms such
+# as "company" or "corporation") are at least `threshold` similar, otherwise it
+# becomes a leader, spelled as its most frequent raw spelling (or hand-coded
+# spelling). Every word of either core must also be close to a word of the
+# other. Names are only compared with the leaders sharing a block key (the
+# first or last 4 letters of a word of the core, so that an OCR error in one
+# end of a word still leaves a key), and blocks of very common keys ("pipe",
+# "natu", ...) are skipped while the name has a smaller one: the cost grows with
+# the number of distinct names, not with its square.
+#
+# The index is saved as a csv (name, canonical) and reused: names already in it
+# keep their canonical name, only new names are compared, and mappings can be
+# corrected by hand in the file.
+
+# Column with the company names, and column added
+COMPANY_COL = "Pipeline Company"
+CANONICAL_COL = "Company Canonical"
+
+# Words left out of the core of a name (legal forms)
+LEGAL_FORMS = {"the", "company", "companies", "corporation", "incorporated",
+               "limited", "llc", "lp"}
+
+# Legal forms stripped from the end of a word
+LONG_LEGAL_FORMS = sorted((form for form in LEGAL_FORMS if len(form) >= 6),
+                          key=len, reverse=True)
+
+# Letters of a word in its block keys
+KEY_LETTERS = 4
+
+# Block keys of a name that a leader may lack and still be compared (an OCR
+# error in a short word changes both of its keys)
+MISSING_KEYS = 2
+
+
+@functools.lru_cache(maxsize=None)
+def is_legal_form(word):
+    """ Whether a word is a legal form, allowing for an OCR error or two in
+        the longer ones ("cornpany", "corporatlon")."""
+    if word in LEGAL_FORMS:
+        return True
+    return len(word) >= 6 and any(
+        SequenceMatcher(None, word, form).ratio() >= 0.8
+        for form in LONG_LEGAL_FORMS)
+
+
+def name_core(name):
+    """ Normalized name without its legal forms, also when a lost space glued
+        one to the previous word ("gascompany"); the name itself if nothing
+        else is left."""
+    words = []
+    for word in name.split():
+        if is_legal_form(word):
+            continue
+        for form in LONG_LEGAL_FORMS:
+            if word.endswith(form) and len(word) > len(form):
+                word = word[:-len(form)]
+                break
+        words.append(word)
+    return " ".join(words) or name
+
+
+def block_keys(core):
+    """ Block keys of a name core: first and last letters of each word."""
+    keys = set()
+    for word in core.split():
+        keys.add("<" + word[:KEY_LETTERS])
+        keys.add(word[-KEY_LETTERS:] + ">")
+    return keys
+
+
+def words_agree(a, b, similarity=0.75):
+    """ Whether every word of 3 letters or more of each core is close to a
+        word of the other one (or part of a word that lost a space):
+        names that share most of their letters but differ by a word ("cabot
+        gas" and "coastal gas", "texas gas" and "texas dow gas") are
+        different companies."""
+    a, b = a.split(), b.split()
+    for words, others in [(a, b), (b, a)]:
+        others = others + [x + y for x, y in zip(others, others[1:])]
+        for word in words:
+            if len(word) >= 3 and not any(
+                    word in other or
+                    SequenceMatcher(None, word, other).ratio() >= similarity
+                    for other in others):
+                return False
+    return True
+
+
+def read_companies(path, col=COMPANY_COL, chunksize=100_000):
+    """
+    Count the raw company names of a csv or xlsx file.
+
+    Args:
+        path (str): Digitized or hand-coded data (.csv, read in chunks, or
+            .xlsx).
+        col (str): Column with the company names.
+        chunksize (int): Rows of a csv read at a time.
+
+    Returns:
+        Counter of raw name -> number of rows.
+    """
+    counts = Counter()
+    if path.endswith(".xlsx"):
+        chunks = [pd.read_excel(path, usecols=[col])]
+    elif path.endswith(".csv"):
+        chunks = pd.read_csv(path, usecols=[col], chunksize=chunksize)
+    else:
+        raise ValueError(f"Company data file {path} must be .xlsx or .csv format.")
+    for chunk in chunks:
+        counts.update(chunk[col].dropna().astype(str).value_counts().to_dict())
+    return counts
+
+
+# ------------------------------------------------------------------------------
+# -- Define classes ------------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+
+class CompanyIndex:
+    """
+    Canonical company name of each normalized name (see the notes above).
+
+    Args:
+        threshold (float): Lowest similarity of the cores of two names of the
+            same company (see align.company_similarity).
+        max_block (int): Largest block of leaders compared with a name, unless
+            all of the name's blocks are larger (then only its smallest one).
+    """
+
+    def __init__(self, threshold=0.9, max_block=200):
+        self.threshold = threshold
+        self.max_block = max_block
+        self.names = {}  # normalized name -> canonical name
+        self._leaders = {}  # canonical name -> core
+        self._cores = {}  # core -> first canonical name with this core
+        self._blocks = defaultdict(list)  # block key -> canonical names
+        self._normalized = {}  # raw name -> normalized name
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        """ Index saved by save() (an empty index if path does not exist)."""
+        index = cls(**kwargs)
+        if os.path.exists(path):
+            with open(path, encoding="utf-8", newline="") as file:
+                for row in csv.DictReader(file):
+                    index._add_leader(row["canonical"])
+                    index.names[row["name"]] = row["canonical"]
+        return index
+
+    def save(self, path):
+        """ Write the index as a csv of name, canonical (sorted by canonical
+            name, for reviewing)."""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["name", "canonical"])
+            writer.writerows(sorted(self.names.items(),
+                                    key=lambda item: (item[1], item[0])))
+        os.replace(tmp_path, path)
+
+    @property
+    def n_companies(self):
+        return len(self._leaders)
+
+    def normalize(self, name):
+        """ normalize_company, once per distinct raw name."""
+        if name not in self._normalized:
+            self._normalized[name] = normalize_company(name)
+        return self._normalized[name]
+
+    def _add_leader(self, canonical):
+        if canonical in self._leaders:
+            return
+        core = name_core(self.normalize(canonical))
+        self._leaders[canonical] = core
+        self._cores.setdefault(core, canonical)
+        for key in block_keys(core):
+            self._blocks[key].append(canonical)
+
+    def _candidates(self, core):
+        """ Leaders sharing the block keys of a core, but for MISSING_KEYS
+            (skipping the large blocks while there is a smaller one)."""
+        blocks = [self._blocks[key] for key in block_keys(core)
+                  if key in self._blocks]
+        if not blocks:
+            return []
+        blocks = ([block for block in blocks if len(block) <= self.max_block]
+                  or [min(blocks, key=len)])
+        shared = Counter()
+        for block in blocks:
+            shared.update(block)
+        needed = max(1, len(blocks) - MISSING_KEYS)
+        return [canonical for canonical, n in shared.items() if n >= needed]
+
+    def _match(self, core):
+        """ Most similar leader of a core (None below the threshold)."""
+        if core in self._cores:
+            return self._cores[core]
+        best, best_score = None, self.threshold
+        # company_similarity, with the core's side of the matcher built once
+        matcher = SequenceMatcher(None, b=core, autojunk=False)
+        for canonical in self._candidates(core):
+            other = self._leaders[canonical]
+            # upper bounds of the similarity first (cheap)
+            if 2 * min(len(core), len(other)) < best_score * (len(core) + len(other)):
+                continue
+            matcher.set_seq1(other)
+            if matcher.quick_ratio() < best_score:
+                continue
+            score = matcher.ratio()
+            if score >= best_score and words_agree(core, other):
+                best, best_score = canonical, score
+        return best
+
+    def add(self, counts):
+        """
+        Add company names to the index: the names of earlier calls lead (add
+        the hand-coded names first, so that their spellings are canonical).
+
+        Args:
+            counts (dict): Raw name -> number of rows (see read_companies).
+
+        Returns:
+            Number of new normalized names (int).
+        """
+        # rows and raw spellings of each new normalized name
+        rows, spellings = Counter(), defaultdict(Counter)
+        for raw, n in counts.items():
+            name = self.normalize(raw)
+            if name and name not in self.names:
+                rows[name] += n
+                spellings[name][raw] += n
+        for name, _ in rows.most_common():
+            canonical = self._match(name_core(name))
+            if canonical is None:
+                canonical = spellings[name].most_common(1)[0][0]
+                self._add_leader(canonical)
+            self.names[name] = canonical
+        return len(rows)
+
+    def canonical(self, names):
+        """
+        Canonical name of each raw name (added to the index if new).
+
+        Args:
+            names (pd.Series): Raw company names.
+
+        Returns:
+            pd.Series of canonical names (missing where the name is missing).
+        """
+        self.add(names.dropna().astype(str).value_counts().to_dict())
+        mapping = {raw: self.names.get(self.normalize(raw))
+                   for raw in names.dropna().unique()}
+        return names.map(mapping)
+
+    def annotate(self, df, col=COMPANY_COL, out_col=CANONICAL_COL):
+        """ df with the canonical names of col in out_col (a copy)."""
+        df = df.copy()
+        df[out_col] = self.canonical(df[col])
+        return df
+
+    def annotate_csv(self, in_path, out_path=None, chunksize=100_000):
+        """
+        Add the canonical names to a csv, read in chunks.
+
+        Args:
+            in_path (str): Digitized entries.
+            out_path (str): csv to write (defaults to in_path).
+            chunksize (int): Rows read at a time.
+
+        Returns:
+            Number of rows written (int).
+        """
+        out_path = out_path or in_path
+        tmp_path = out_path + ".companies"
+        n_written = 0
+        for chunk in pd.read_csv(in_path, chunksize=chunksize):
+            chunk[CANONICAL_COL] = self.canonical(chunk[COMPANY_COL])
+            chunk.to_csv(tmp_path, mode="w" if n_written == 0 else "a",
+                         header=n_written == 0, index=False)
+            n_written += len(chunk)
+        if n_written:
+            os.replace(tmp_path, out_path)
+        return n_written
+
+
+def build_company_index(pred_paths, true_paths=(), index_path=None, **kwargs):
+    """
+    Company index of digitized and hand-coded files.
+
+    Args:
+        pred_paths (list): Digitized csv files.
+        true_paths (list): Hand-coded csv or xlsx files (their names are
+            compared first, and their spellings preferred).
+        index_path (str): Saved index to extend (and save), if any.
+        **kwargs: CompanyIndex parameters.
+
+    Returns:
+        CompanyIndex
+    """
+    index = (CompanyIndex.load(index_path, **kwargs) if index_path
+             else CompanyIndex(**kwargs))
+    for path in true_paths:
+        index.add(read_companies(path))
+    counts = Counter()
+    for path in pred_paths:
+        counts.update(read_companies(path))
+    index.add(counts)
+    if index_path:
+        index.save(index_path)
+    return index
@@ -1,5 +1,6 @@
 import os
 from datetime import datetime
+from run_config import RunConfig
 from PagesLib.Page import PagePrivateCore, PageGovCore, PagePrivateExtended, PageGovExtended
 
 # ------------------------------------------------------------------------------
@@ -50,6 +51,9 @@ else:
 # Set the number of pages before and after page N to feed into Gemini when digitizing page N
 page_window = 1
 page_placement = "top"
+# With page_window > 1, upload each page once as its own file and share it
+# between the overlapping windows (instead of uploading one file per window)
+upload_pages_once = True
 
 # Define number of pages to digitize.
 all_pages = True  # If True, just does all the pages in the document
@@ -58,8 +62,106 @@ n_pages = 1  # The number of pages (total) to digitize
 
 # Indicate whether the pages should be saved as .png instead of .pdf
 # ! NOTE: .png files must be a single page, so this only works with page_window=1
+# (or with upload_pages_once, where each page of the window is its own file)
 png = False
 
+# Prescan pages locally before calling the API: skip blank pages and reuse the
+# results of near-duplicate pages (rescans). Requires poppler (as for png).
+# Every reused page is logged as a warning and listed in run_info.json: check
+# them, since a page wrongly taken for a duplicate loses its own entries.
+prescan = False
+
+# Hedge slow requests: if a page has no response after hedge_percentile of the
+# model's observed latency, send the request again and keep the first valid
+# response. At most hedge_max_fraction of the requests are sent twice.
+hedge_requests = False
+hedge_percentile = 95
+hedge_max_fraction = 0.1
+
+# Stream responses: entries are parsed as they arrive (saved to
+# pg{N}.partial.jsonl until the page is done), and a response truncated at the
+# output token limit keeps its complete entries. Not combined with hedging.
+stream_responses = False
+
+# Maximum number of pages processed at the same time. The number of requests
+# in flight starts low and adapts: it grows while requests succeed and is cut
+# on 503/429 errors and timeouts (requests pause if the errors persist).
+# Set to 1 to process the pages one at a time.
+max_concurrency = 8
+
+# Low-memory mode for very large scans: each page's data is appended to the
+# output file once written instead of being kept until the end (main.main then
+# returns None), and fewer pages are processed ahead.
+low_memory = False
+
+# Merge entries extracted more than once (overlapping page windows, duplicate
+# pages, reruns) in the final output, keeping where they came from in the
+# n_extractions and source_pages columns (see dedup.py). With low_memory, only
+# entries extracted within page_window pages of each other are merged.
+merge_duplicate_entries = True
+
+# Compact response schema: the model answers with short keys and codes instead
+# of the field names and Literal values of page_schema (expanded back before
+# saving), which saves output tokens on dense pages (see
+# PagesLib/compact.py and bench_schema.py)
+compact_schema = False
+
+# Fast decoding: responses are validated and read into columns by a validator
+# compiled once per page schema, instead of building a pydantic model for the
+# page and every entry and reading them back (see PagesLib/decode.py and
+# bench_decode.py); the output is the same
+fast_decode = True
+
+# Results store: each run writes its metadata (model, prompt hash, schema), the
+# status and raw response of each page and the digitized entries to one SQLite
+# database, output_dir/results.sqlite, instead of a pg{N}.csv file per page
+# (query it with `python source/cli.py query`, see results_db.py)
+store_results = True
+
+# Pool of API keys: a file with one Gemini API key per line (optionally
+# "name key"), each from its own project, to go beyond one project's quota.
+# Pages are sent to the key with the most free requests (each key has its own
+# adaptive limit), move to another key when one is exhausted, and the rows get
+# the name of their key in a "shard" column (see PagesLib/shards.py).
+# None uses the key in secret/GEMINI_API_KEY.txt.
+api_key_pool = None
+
+# Quality-first scheduling: with a ground truth file, the run first processes
+# its probe pages (quality_pages, the absolute pages with ground truth, then
+# quality_sample pages spread across the document) and scores them against the
+# ground truth as they finish. Once quality_min_entries hand-coded entries are
+# covered, a run whose mean column accuracy is below quality_min_accuracy or
+# whose total mileage error is above quality_max_mi_pct_err fails the check:
+# its other pages are skipped (quality_action = "abort") or processed one at a
+# time ("deprioritize"). See quality.py. None disables the check.
+# quality_pages is required when the ground truth has no Page Number column
+# (as the hand-coded files in outputs/): only these pages are then scored, and
+# the run is judged once they are all done.
+quality_true_path = None
+quality_pages = None
+quality_sample = 10
+quality_min_accuracy = 0.6
+quality_max_mi_pct_err = 0.5
+quality_min_entries = 30
+quality_action = "abort"
+
+# Stage profiling: time each stage of the run (PDF splitting, rasterization,
+# uploads, API requests, decoding, page_to_dataframe, CSV writes, dedup) per
+# page, and write a flame graph profile (profile.folded) and a per-stage summary
+# (profile_summary.csv, also logged) to the run's intermediate folder. With
+# profile_memory, the memory peak of each stage is also measured (slower). See
+# profiling.py.
+profile_stages = False
+profile_memory = False
+
+# Uploaded files: each run tags its uploads, records them in uploads.jsonl and
+# deletes them in the background (only its own: other runs may share the
+# project). Uploads wait for space when the project's File API storage nears
+# upload_quota_gb. Uploads left by finished or crashed runs are deleted by
+# `cli.py clean-uploads`, for crashed runs once older than orphan_upload_hours.
+upload_quota_gb = 20
+orphan_upload_hours = 6
+
 
 # ------------------------------------------------------------------------------
 # END OF SET PARAMETERS --------------------------------------------------------
@@ -74,44 +176,73 @@ OUTPUT_FILE_NAME = OUTPUT_FILE_BASE_NAME + "_" + identifier + ".csv"
 intermediate_dir = os.path.join(
     results_dir, OUTPUT_FILE_BASE_NAME + "_" + identifier)
 
-# TODO: move this to utils
-# Define logging function
+# Logging -----------------------------------------------------------------
+# Events are written as JSON lines to log_{OUTPUT_FILE_BASE_NAME}_{identifier}.jsonl
+# in log_dir by a background thread. Levels: "DEBUG", "INFO", "WARNING", "ERROR"
+log_level = "DEBUG"  # minimum level written to the log file
+console_level = "INFO"  # minimum level printed to the console
+
+
+# Run configuration -------------------------------------------------------
+# The parameters above are the default run. Other runs (e.g. gov and private
+# in one process) can be made with get_run_config(**changes) or RunConfig.
+
+
+def get_run_config(**changes):
+    """ RunConfig of the parameters in this module, with optional changes."""
+    return RunConfig(input_file_path=INPUT_FILE_PATH,
+                     page_schema=page_schema,
+                     prompt_text_path=prompt_text_path,
+                     gemini_model_id=gemini_model_id,
+                     output_file_base_name=OUTPUT_FILE_BASE_NAME,
+                     output_dir=output_dir,
+                     page_window=page_window,
+                     page_placement=page_placement,
+                     upload_pages_once=upload_pages_once,
+                     all_pages=all_pages,
+                     start_page=start_page,
+                     n_pages=n_pages,
+                     png=png,
+                     prescan=prescan,
+                     hedge_requests=hedge_requests,
+                     hedge_percentile=hedge_percentile,
+                     hedge_max_fraction=hedge_max_fraction,
+                     stream_responses=stream_responses,
+                     max_concurrency=max_concurrency,
+                     low_memory=low_memory,
+                     merge_duplicate_entries=merge_duplicate_entries,
+                     compact_schema=compact_schema,
+                     fast_decode=fast_decode,
+                     store_results=store_results,
+                     api_key_pool=api_key_pool,
+                     quality_true_path=quality_true_path,
+                     quality_pages=quality_pages,
+                     quality_sample=quality_sample,
+                     quality_min_accuracy=quality_min_accuracy,
+                     quality_max_mi_pct_err=quality_max_mi_pct_err,
+                     quality_min_entries=quality_min_entries,
+                     quality_action=quality_action,
+                     profile_stages=profile_stages,
+                     profile_memory=profile_memory,
+                     upload_quota_gb=upload_quota_gb,
+                     orphan_upload_hours=orphan_upload_hours,
+                     log_level=log_level,
+                     console_level=console_level,
+                     identifier=identifier).replace(**changes)
+
+
+def get_run_logger(log_dir=log_dir):
+    return get_run_config().get_logger(log_dir)
 
 
 def write_log(message, log_dir=log_dir):
-    if not os.path.exists(log_dir):
-        os.makedirs(log_dir)
-    file_path = os.path.join(log_dir, f"log_{identifier}.txt")
-    with open(file_path, "a", encoding="utf-8") as file:
-        timestamp = datetime.now().strftime("%H%M:%S")
-        file.write(f"[{timestamp}] {message}\n\n")
+    get_run_config().write_log(message, log_dir)
 
 
 def log_config(log_dir=log_dir):
-    if not os.path.exists(log_dir):
-        os.makedirs(log_dir)
-
-    # Save text of gemini prompt--------
-    with open(prompt_text_path, "r") as file:
-        prompt_text = file.read()
-    with open(os.path.join(log_dir, "prompt_text.txt"), "a",
-              encoding="utf-8") as file:
-        file.write(prompt_text)
-
-    # Save parameter values ----------
-    file_path = os.path.join(log_dir, f"log_{identifier}.txt")
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-    with open(file_path, "a", encoding="utf-8") as file:
-        file.write(f"[{timestamp}] \n\n")
-        file.write(f"CONFIG PARAMETERS\n\n")
-        # file.write(f"Directory file year: {input_file_year}\n")
-        file.write(f"Start page: {start_page}\n")
-        file.write(f"End page: {start_page + n_pages - 1}\n")
-        file.write(f"Page window: {page_window}\n")
-        file.write(f"Prompt text file: {prompt_text_name}\n")
-        file.write(f"Gemini model: {gemini_model_id}\n\n")
+    get_run_config().log_config(log_dir)
 
 
 # ------------------------------------------------------------------------------
 # -----------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
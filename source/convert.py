@@ -1,66 +1,113 @@
-# write a quick script to convert a folder of csv's into xlsx
+# convert a folder of csv's into xlsx
 
-import pandas as pd
 import os
+import csv
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 
-from pandas.io.formats import excel
-
-
-def csv_to_xlsx(input_folder):
-    # Loop through all CSV files in the input folder
-    for filename in os.listdir(input_folder):
-        if filename.endswith(".csv"):
-            basename = os.path.splitext(filename)[0]
-            in_path = os.path.join(input_folder, filename)
-            # Read the CSV file into a DataFrame
-            # read everything in as text, including numbers, and don't drop NAs, they should be text as well
-            df = pd.read_csv(in_path, dtype=str, keep_default_na=False)
-
-            # add a new column called "Notes" and have all rows be empty
-            df["Notes"] = ""
-
-            # rearrange all the columns to be in this order:
-            # Data Year, State Heading/Project Number, Pipeline Company, Construction Complete, New Construction, Total Pipeline Length, Pipeline Length by Diameter, Pipeline Diameter, Fuel Type Raw, Fuel Type Inferred, Origin City, Origin County, Origin State, Other Origin Description, Terminus City, Terminus County, Terminus State, Other Terminus Description, Interstate or Intrastate, FPC, Parallel or Loop, Function, Connection, Page Number, model_id, absolute_page_n, Notes
-            cols = df.columns.tolist()
-            new_order = [
-                "Data Year",
-                "State Heading" if "State Heading" in cols else "Project Number",
-                "Pipeline Company",
-                "Construction Complete",
-                "New Construction",
-                "Total Pipeline Length",
-                "Pipeline Length by Diameter",
-                "Pipeline Diameter",
-                "Fuel Type Raw",
-                "Fuel Type Inferred",
-                "Origin City",
-                "Origin County",
-                "Origin State",
-                "Other Origin Description",
-                "Terminus City",
-                "Terminus County",
-                "Terminus State",
-                "Other Terminus Description",
-                "Interstate or Intrastate",
-                "FPC",
-                "Parallel or Loop",
-                "Function",
-                "Connection",
-                "Page Number",
-                "model_id",
-                "absolute_page_n",
-                "Notes"
-            ]
-            df = df.reindex(columns=new_order)
-
-            # export as xlsx
-            out_path = os.path.join(input_folder, basename + ".xlsx")
-
-            # disable the default header style for Excel exports
-            excel.ExcelFormatter.header_style = None
-
-            df.to_excel(out_path, index=False)
-            print(f"Converted {filename} to {basename + '.xlsx'}")
-
-
-csv_to_xlsx("C:/Users/hl2266/Documents/predoc/State Permitting project/Code/pipeline_digitization/outputs/gemini_output/private_1943_1951_extended_vars_2025-11-21-12-58-19")
+from openpyxl import Workbook
+
+from PagesLib import Page
+
+# Columns added after the page schema columns
+EXTRA_COLUMNS = ["model_id", "absolute_page_n", "Notes"]
+
+
+def infer_page_schema(columns):
+    """ Guess the page schema that produced a csv from its column names."""
+    if "State Heading" in columns:
+        return (Page.PagePrivateExtended if "Pipeline Diameter" in columns
+                else Page.PagePrivateCore)
+    return (Page.PageGovExtended if "Pipeline Diameter" in columns
+            else Page.PageGovCore)
+
+
+def export_columns(columns, page_schema=None):
+    """ Column order of the exported xlsx: the page schema columns, then
+        model_id, absolute_page_n and a "Notes" column (empty unless the csv
+        has one), then the other columns of the csv, in csv order (provenance,
+        shard, canonical company names, ...)."""
+    if page_schema is None:
+        page_schema = infer_page_schema(columns)
+    known = [col for col, _, _ in Page.page_columns(page_schema)] + EXTRA_COLUMNS
+    return known + [col for col in columns if col not in known]
+
+
+def csv_to_xlsx_file(in_path, out_path, page_schema=None):
+    """ Convert one csv to xlsx, streaming rows so that memory use does not
+        grow with the file size. All values are written as text. """
+    with open(in_path, "r", newline="", encoding="utf-8") as file:
+        reader = csv.reader(file)
+        header = next(reader, [])
+        columns = export_columns(header, page_schema)
+        positions = [header.index(col) if col in header else None
+                     for col in columns]
+
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        sheet.append(columns)
+        for row in reader:
+            sheet.append([
+                row[p] if p is not None and p < len(row) and row[p] != ""
+                else None for p in positions
+            ])
+
+    # write to a temporary file first so a crash never leaves a partial xlsx
+    # that looks up to date
+    temp_path = out_path + ".tmp"
+    workbook.save(temp_path)
+    os.replace(temp_path, out_path)
+    return out_path
+
+
+def csv_to_xlsx(input_folder, force=False, workers=None, page_schema=None):
+    """ Convert all csv files in input_folder to xlsx files, in parallel.
+
+    Args:
+        input_folder (str): folder with the csv files
+        force (bool): if False, skip csv files whose xlsx is newer than the csv
+        workers (int): number of worker processes (defaults to the CPU count)
+        page_schema: page schema of the csv files (inferred if None)
+
+    Returns:
+        list of paths to the xlsx files that were written
+    """
+    jobs = []
+    for filename in sorted(os.listdir(input_folder)):
+        if not filename.endswith(".csv"):
+            continue
+        in_path = os.path.join(input_folder, filename)
+        out_path = os.path.join(input_folder,
+                                os.path.splitext(filename)[0] + ".xlsx")
+        if (not force and os.path.exists(out_path)
+                and os.path.getmtime(out_path) >= os.path.getmtime(in_path)):
+            continue
+        jobs.append((in_path, out_path))
+
+    print(f"Converting {len(jobs)} csv files in {input_folder}")
+    written = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(csv_to_xlsx_file, in_path, out_path, page_schema)
+                   for in_path, out_path in jobs]
+        for (in_path, out_path), future in zip(jobs, futures):
+            try:
+                written.append(future.result())
+                print(f"Converted {os.path.basename(in_path)} to {os.path.basename(out_path)}")
+            except Exception as e:
+                print(f"FAILURE - Could not convert {in_path}: {e}")
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert a folder of digitized csv files to xlsx.")
+    parser.add_argument("input_folder")
+    parser.add_argument("--force", action="store_true",
+                        help="Convert files even if the xlsx is up to date.")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--schema", default=None,
+                        help="Page schema class name in PagesLib.Page (inferred if not set).")
+    args = parser.parse_args()
+
+    csv_to_xlsx(args.input_folder, force=args.force, workers=args.workers,
+                page_schema=getattr(Page, args.schema) if args.schema else None)
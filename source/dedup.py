@@ -0,0 +1,251 @@
+# ------------------------------------------------------------------------------
+# Load libraries ---------------------------------------------------------------
+# ------------------------------------------------------------------------------
+import os
+from collections import Counter
+import pandas as pd
+
+from align import normalize_company
+
+# ------------------------------------------------------------------------------
+# -- Define functions ----------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Entries extracted more than once (a page seen in several overlapping windows,
+# or a page extracted again by a rerun into the same output) are merged here.
+#
+# An extraction is a block of consecutive rows with the same target page
+# (absolute_page_n) and model: page_to_dataframe output, as appended to the
+# results. Entries of the same extraction are never merged with each other,
+# since a directory can list the same pipeline twice on a page. Across
+# extractions, entries with the same key are the same entry: the extraction
+# kept is the first one whose target page is the entry's own page, i.e. whose
+# target page is the entry's printed page number under the volume's page offset
+# (the most common "Page Number" - absolute_page_n of the rows), otherwise the
+# first one.
+#
+# With a window (low-memory runs, whose rows come in page order), a key is only
+# kept while it was seen in the last `window` target pages: overlapping page
+# windows of that size cannot extract it again after that. Its entry is then
+# resolved with the page offset of the rows so far, and memory stays bounded
+# on long scans (entries extracted again by reruns are then not merged).
+
+# Columns of the entry key (normalized in EntryIndex.entry_keys)
+KEY_COLS = ["Data Year", "Page Number", "Pipeline Company", "Origin State",
+            "Terminus State", "Total Pipeline Length"]
+
+# Columns identifying an extraction
+SOURCE_COLS = ["absolute_page_n", "model_id"]
+
+# Provenance columns added to the merged entries
+PROVENANCE_COLS = ["n_extractions", "source_pages"]
+
+
+def _numbers(col, digits=None):
+    """ Column as floats (rounded), with None for missing values."""
+    col = pd.to_numeric(col, errors="coerce")
+    if digits is not None:
+        col = col.round(digits)
+    return col.astype(object).where(col.notna(), None)
+
+
+def _states(col):
+    return col.astype("string").str.strip().str.upper().fillna("")
+
+
+class EntryIndex:
+    """ Hash index of entry keys, built one chunk of rows at a time: add()
+        each chunk in order, then resolve() gives the rows to drop.
+
+    Args:
+        window (int): If set, keys not seen in the last window target pages
+            are resolved and dropped from the index (see the notes above).
+    """
+
+    def __init__(self, window=None):
+        self.window = window
+        self.n_rows = 0
+        # key -> {extraction number: [row numbers]}, in order of appearance
+        self.keys = {}
+        self.extractions = []  # target page of each extraction
+        self.offsets = Counter()  # "Page Number" - absolute_page_n, per row
+        self.dropped = set()  # rows of entries kept from another extraction
+        self.provenance = {}  # row -> provenance, for entries seen more than once
+        self._companies = {}  # company name -> normalized name
+        self._last_source = None
+        # with a window: target page -> keys last seen on it (in page order)
+        self._recent = {}
+        self._key_targets = {}  # key -> last target page
+
+    def entry_keys(self, df):
+        """ Key of each row: data year, printed page, company name (see
+            align.normalize_company), origin and terminus states and length
+            (rounded to 2 decimals). Equal keys are the same pipeline entry.
+        """
+        # each distinct company name is normalized once
+        names = df["Pipeline Company"]
+        for name in names.dropna().unique():
+            if name not in self._companies:
+                self._companies[name] = normalize_company(name)
+        companies = names.map(self._companies).fillna("")
+        return zip(_numbers(df["Data Year"]), _numbers(df["Page Number"]),
+                   companies, _states(df["Origin State"]),
+                   _states(df["Terminus State"]),
+                   _numbers(df["Total Pipeline Length"], 2))
+
+    def add(self, df):
+        """ Index a chunk of rows (continuing the row numbers of the previous
+            chunks)."""
+        missing = [c for c in KEY_COLS + SOURCE_COLS[:1] if c not in df.columns]
+        if missing:
+            raise ValueError(f"Cannot merge entries, missing columns {missing}")
+        # (missing values as None, since NaN differs from itself)
+        sources = zip(*[df[c].astype(object).where(df[c].notna(), None)
+                        if c in df.columns else [None] * len(df)
+                        for c in SOURCE_COLS])
+        targets = _numbers(df["absolute_page_n"])
+        for row, (source, target, key) in enumerate(
+                zip(sources, targets, self.entry_keys(df)), start=self.n_rows):
+            if source != self._last_source:
+                self.extractions.append(target)
+                self._last_source = source
+                if self.window is not None and target is not None:
+                    self._evict(target)
+            extraction = len(self.extractions) - 1
+            if key[1] is not None and target is not None:
+                self.offsets[key[1] - target] += 1
+            self.keys.setdefault(key, {}).setdefault(
+                extraction, []).append(row)
+            if self.window is not None and target is not None:
+                self._key_targets[key] = target
+                self._recent.setdefault(target, []).append(key)
+        self.n_rows += len(df)
+
+    def _evict(self, target):
+        """ Resolve and drop the keys last seen window target pages or more
+            before target."""
+        offset = self._offset()
+        for page in list(self._recent):
+            if page > target - self.window:
+                break
+            for key in self._recent.pop(page):
+                if self._key_targets.get(key) == page:
+                    del self._key_targets[key]
+                    self._resolve_key(key, self.keys.pop(key), offset)
+
+    def _offset(self):
+        """ Most common "Page Number" - absolute_page_n of the rows so far."""
+        return self.offsets.most_common(1)[0][0] if self.offsets else None
+
+    def _resolve_key(self, key, by_extraction, offset):
+        """ Keep the rows of one extraction of a key (see the notes above)."""
+        extractions = list(by_extraction)
+        if len(extractions) == 1:
+            return
+        chosen = next((e for e in extractions
+                       if key[1] is not None and offset is not None and
+                       self.extractions[e] is not None and
+                       key[1] - self.extractions[e] == offset),
+                      extractions[0])
+        pages = sorted({self.extractions[e] for e in extractions
+                        if self.extractions[e] is not None})
+        provenance = (len(extractions), ";".join(str(int(p)) for p in pages))
+        for e, rows in by_extraction.items():
+            if e == chosen:
+                for row in rows:
+                    self.provenance[row] = provenance
+            else:
+                self.dropped.update(rows)
+
+    def resolve(self):
+        """ Resolve the keys still in the index.
+
+        Returns:
+            set of the row numbers to drop. The rows kept of entries seen in
+            several extractions are in self.provenance, as row number ->
+            (number of extractions with the entry, their target pages joined
+            with ";"); see row_provenance for the others.
+        """
+        offset = self._offset()
+        for key, by_extraction in self.keys.items():
+            self._resolve_key(key, by_extraction, offset)
+        self.keys = {}
+        self._recent, self._key_targets = {}, {}
+        return self.dropped
+
+
+def _provenance(index, rows, targets):
+    """ n_extractions and source_pages of the given kept rows, with their
+        absolute_page_n (targets)."""
+    n_extractions, source_pages = [], []
+    for row, target in zip(rows, targets):
+        if row in index.provenance:
+            n, pages = index.provenance[row]
+        else:
+            n, pages = 1, "" if target is None else str(int(target))
+        n_extractions.append(n)
+        source_pages.append(pages)
+    return n_extractions, source_pages
+
+
+def dedup_entries(df):
+    """ Merge the entries extracted more than once (see the notes above).
+
+    Runs in one pass over the rows (a hash index of the entry keys).
+
+    Args:
+        df (pd.DataFrame): digitized entries (page_to_dataframe output, with
+            absolute_page_n)
+
+    Returns:
+        pd.DataFrame with each entry once, in the original order, and the
+        provenance columns n_extractions and source_pages.
+    """
+    index = EntryIndex()
+    index.add(df)
+    dropped = index.resolve()
+    rows = [r for r in range(len(df)) if r not in dropped]
+    merged = df.drop(columns=PROVENANCE_COLS, errors="ignore").iloc[rows].copy()
+    merged["n_extractions"], merged["source_pages"] = _provenance(
+        index, rows, _numbers(merged["absolute_page_n"]))
+    return merged.reset_index(drop=True)
+
+
+def dedup_csv(in_path, out_path, chunksize=100_000, window=None):
+    """ dedup_entries for a csv file, read in chunks (memory grows with the
+        number of rows, not with the data, or is bounded with a window).
+
+    Args:
+        in_path (str): csv of digitized entries
+        out_path (str): csv to write (may be in_path)
+        chunksize (int): rows read at a time
+        window (int): If set, only entries extracted within window target
+            pages of each other are merged (see EntryIndex); the rows must be
+            in page order.
+
+    Returns:
+        Number of rows written (int).
+    """
+    index = EntryIndex(window)
+    for chunk in pd.read_csv(in_path, chunksize=chunksize):
+        index.add(chunk)
+    if not index.n_rows:
+        return 0
+    dropped = index.resolve()
+
+    tmp_path = out_path + ".dedup"
+    n_written = 0
+    first_row = 0
+    for chunk in pd.read_csv(in_path, chunksize=chunksize):
+        n_rows = len(chunk)
+        rows = [r for r in range(first_row, first_row + n_rows)
+                if r not in dropped]
+        chunk = chunk.drop(columns=PROVENANCE_COLS, errors="ignore").iloc[
+            [r - first_row for r in rows]].copy()
+        chunk["n_extractions"], chunk["source_pages"] = _provenance(
+            index, rows, _numbers(chunk["absolute_page_n"]))
+        chunk.to_csv(tmp_path, mode="w" if first_row == 0 else "a",
+                     header=first_row == 0, index=False)
+        first_row += n_rows
+        n_written += len(chunk)
+    os.replace(tmp_path, out_path)
+    return n_written
@@ -3,49 +3,52 @@
 # ------------------------------------------------------------------------------
 import os
 from datetime import datetime
+import numpy as np
 import pandas as pd
 import json
 
-import config
-from config import write_log
 # from PagesLib import Page, digitizer
-from PagesLib.Page import Entry
+from PagesLib.Page import CoreEntry
 from typing import get_args
+from align import align_entries, column_accuracy
+from bootstrap import bootstrap_mileage, page_units, entry_units
+import profiling
 
 # ------------------------------------------------------------------------------
 # -- Define functions ----------------------------------------------------------
 # ------------------------------------------------------------------------------
 
-# TODO: we should pass the config as an argument instead of importing it. also we should move write_log to utils
+# Predicted column names that differ from the cleaned hand-coded column names
+PRED_TO_TRUE_COLS = {
+    "Fuel Type Inferred": "Fuel Type",
+    "Total Pipeline Length": "Pipeline Length",
+}
 
+# Lengths coding an unknown mileage (excluded from the mileage error)
+UNKNOWN_LENGTHS = [-1, -2]
 
-def eval_performance(pred_path, true_path, filter_year_start=1945, filter_year_end=1950, filter_pg=None):
+# Loaded ground truth data, keyed by (path, modification time)
+_TRUE_DATA_CACHE = {}
+
+
+@profiling.profiled("load_true_data")
+def load_true_data(true_path):
     """
-    Evaluate the performance of digitization results. Computes accuracy as well as total and group-wise mileage.
+    Load hand-coded ground truth data, reusing it if the file is unchanged.
 
     Args:
-        pred_path (str): Path to csv with predicted data.
         true_path (str): Path to spreadsheet with hand-coded ground truth data.
-        filter_year_start (int): Only evaluate predictions starting from this year.
-        filter_year_end (int): Only evaluate predictions ending in this year (inclusive).
-        filter_pg (int): Only evaluate predictions from this page.
-
-    NOTE: filter_year must be the data year, not publication year. 
 
     Output:
-        Returns performance (dict): Dictionary with performance metrics.
-        Also logs performance to log file.
+        Returns ground truth (pd.DataFrame), with boolean columns as strings.
+        The dataframe is shared between calls and should not be modified.
     """
-    # TODO: the difficult part (and not sure how to resolve it easily automatically) is matching entries because the hand-coded vs generated data may have different number of projects, whether it's because the LLM made something up/missed something or if it was simply a matter of discretion when one entry has multiple projects.
-    assert os.path.exists(
-        pred_path), f"Predicted data file {pred_path} does not exist."
     assert os.path.exists(
         true_path), f"True data file {true_path} does not exist."
+    key = (os.path.abspath(true_path), os.path.getmtime(true_path))
+    if key in _TRUE_DATA_CACHE:
+        return _TRUE_DATA_CACHE[key]
 
-    eval_log_dir = os.path.join(config.output_dir, "performance_evals")
-
-    # Load the predicted and true data
-    pred_data = pd.read_csv(pred_path)
     if true_path.endswith(".xlsx"):
         true_data = pd.read_excel(true_path)
     elif true_path.endswith(".csv"):
@@ -55,15 +58,97 @@ def eval_performance(pred_path, true_path, filter_year_start=1945, filter_year_e
             f"Ground truth data file {true_path} must be .xlsx or .csv format.")
 
     # convert boolean columns to string
-    pred_data['New Construction'] = pred_data['New Construction'].astype(
-        str).str.upper()
-    pred_data['Construction Complete'] = pred_data['Construction Complete'].astype(
-        str).str.upper()
     true_data['New Construction'] = true_data['New Construction'].astype(
         str).str.upper()
     true_data['Construction Complete'] = true_data['Construction Complete'].astype(
         str).str.upper()
 
+    _TRUE_DATA_CACHE[key] = true_data
+    return true_data
+
+
+def prepare_pred_data(pred_data):
+    """
+    Predicted data in the form of the hand-coded data: hand-coded column names
+    and boolean columns as strings.
+
+    Args:
+        pred_data (pd.DataFrame): Predicted data (as saved by the digitizer).
+
+    Output:
+        Returns the converted data (pd.DataFrame, a new dataframe).
+    """
+    # use the hand-coded names for predicted columns
+    pred_data = pred_data.rename(columns={
+        k: v for k, v in PRED_TO_TRUE_COLS.items() if v not in pred_data.columns})
+
+    # convert boolean columns to string
+    pred_data['New Construction'] = pred_data['New Construction'].astype(
+        str).str.upper()
+    pred_data['Construction Complete'] = pred_data['Construction Complete'].astype(
+        str).str.upper()
+    return pred_data
+
+
+def eval_columns(true_data):
+    """
+    Columns whose accuracy is evaluated: the entry columns that were hand-coded
+    (from the CoreEntry field descriptions, with their hand-coded names).
+    """
+    col_names = ["Data Year"] + [
+        PRED_TO_TRUE_COLS.get(field.description, field.description)
+        for field in CoreEntry.model_fields.values()]
+    return [col for col in col_names if col in true_data.columns]
+
+
+@profiling.profiled("eval_performance")
+def eval_performance(pred_path, true_path, filter_year_start=1945, filter_year_end=1950, filter_pg=None, true_data=None, log=True, run_config=None,
+                     bootstrap=None, n_resamples=10000, confidence=0.95, seed=0):
+    """
+    Evaluate the performance of digitization results. Computes accuracy as well as total and group-wise mileage.
+
+    Args:
+        pred_path (str): Path to csv with predicted data.
+        true_path (str): Path to spreadsheet with hand-coded ground truth data.
+        filter_year_start (int): Only evaluate predictions starting from this year.
+        filter_year_end (int): Only evaluate predictions ending in this year (inclusive).
+        filter_pg (int): Only evaluate predictions from this page.
+        true_data (pd.DataFrame): Ground truth already loaded with load_true_data
+            (true_path is then only used to label the results).
+        log (bool): If True, logs performance to the performance_evals log.
+        run_config (RunConfig): Run whose output folder and log are used
+            (defaults to config.get_run_config()).
+        bootstrap (str): If "pages" or "entries", also computes bootstrap
+            confidence intervals of the mileage metrics, resampling pages or
+            aligned entries (see bootstrap.py), in "mi_pct_err_ci" and
+            "mi_pred_over_true_ci" ({"low", "high"} for each metric). Without
+            page numbers in both datasets, "pages" resamples data years.
+        n_resamples (int): Number of bootstrap resamples.
+        confidence (float): Coverage of the confidence intervals.
+        seed (int): Random seed of the bootstrap.
+
+    NOTE: filter_year must be the data year, not publication year. 
+
+    Output:
+        Returns performance (dict): Dictionary with performance metrics.
+        Also logs performance to log file.
+    """
+    # NOTE: predicted and hand-coded entries are matched with align_entries,
+    # since the two may have a different number of projects (the LLM made
+    # something up/missed something, or one entry has multiple projects).
+    assert os.path.exists(
+        pred_path), f"Predicted data file {pred_path} does not exist."
+
+    if run_config is None and log:
+        import config  # only needed for the default run's log folder
+        run_config = config.get_run_config()
+
+    # Load the predicted and true data
+    with profiling.stage("read_predictions"):
+        pred_data = prepare_pred_data(pd.read_csv(pred_path))
+    if true_data is None:
+        true_data = load_true_data(true_path)
+
     # filter by year and page if specified
     true_data = true_data.loc[true_data["Data Year"].between(
         filter_year_start, filter_year_end, inclusive="both")]
@@ -74,29 +159,30 @@ def eval_performance(pred_path, true_path, filter_year_start=1945, filter_year_e
         pred_data = pred_data.loc[pred_data["Page Number"] == filter_pg]
 
     # verify columnn names are correct in both files
-    # (retrieve column names from Entry class description field)
-    col_names = [
-        Entry.model_fields[vars].description for vars in Entry.model_fields.keys()]
+    # (retrieve column names from CoreEntry class description field, keeping
+    # the ones that were hand-coded)
+    col_names = eval_columns(true_data)
     assert set(col_names).issubset(set(pred_data.columns)
                                    ), f"Predicted data is missing columns: {set(col_names) - set(pred_data.columns)}"
-    assert set(col_names).issubset(set(true_data.columns)
-                                   ), f"True data is missing columns: {set(col_names) - set(true_data.columns)}"
 
     # define performance metrics --------------------------
     print("Computing performance metrics...")
-    mileage_groups = ["fuel", "new_construction",
+    mileage_groups = ["fuel_corrected", "new_construction",
                       "construction_complete", "inter_or_intra"]
-    mileage_cols = [Entry.model_fields[g].description for g in mileage_groups]
+    mileage_cols = [
+        PRED_TO_TRUE_COLS.get(CoreEntry.model_fields[g].description,
+                              CoreEntry.model_fields[g].description)
+        for g in mileage_groups]
     performance = {
-        # "accuracy": {"Data Year": None} | {col: None for col in col_names},
         "accuracy": {col: None for col in col_names},
+        "alignment": {"matched": None, "missed": None, "hallucinated": None},
         "mi_pred_over_true": {
             "Total": None,
             "Data Year": {yr: None for yr in range(filter_year_start, filter_year_end + 1)},
             **{
                 col_name: {
                     arg: None for arg in get_args(
-                        Entry.model_fields[group].annotation)
+                        CoreEntry.model_fields[group].annotation)
                 } for (col_name, group) in zip(mileage_cols, mileage_groups)
             },
             "Pipeline Length": {  # by quartile of true distribution?
@@ -121,7 +207,7 @@ def eval_performance(pred_path, true_path, filter_year_start=1945, filter_year_e
             **{
                 col_name: {
                     arg: None for arg in get_args(
-                        Entry.model_fields[group].annotation)
+                        CoreEntry.model_fields[group].annotation)
                 } for (col_name, group) in zip(mileage_cols, mileage_groups)
             },
             "Pipeline Length": {  # by quartile of true distribution?
@@ -143,18 +229,21 @@ def eval_performance(pred_path, true_path, filter_year_start=1945, filter_year_e
     }
 
     # compute performance metrics -------------------------
-    # # compute accuracy for each column
-    # for col in performance["accuracy"].keys():
-    #     correct = (pred_data[col] == true_data[col]).sum()
-    #     total = len(true_data)
-    #     performance["accuracy"][col] = correct / total
+    # align predicted and true entries, then compute accuracy for each column
+    # (missed entries count as incorrect)
+    alignment = align_entries(pred_data, true_data)
+    for key in performance["alignment"].keys():
+        performance["alignment"][key] = len(alignment[key])
+    with profiling.stage("column_accuracy"):
+        performance["accuracy"] = column_accuracy(alignment, col_names,
+                                                  n_true=len(true_data))
 
     # compute mileage error
-    # filter out unknown pipeline lengths (-1 and -2)
+    # filter out unknown pipeline lengths (UNKNOWN_LENGTHS)
     true_data_excl_unknown = true_data.loc[
-        ~true_data['Pipeline Length'].isin([-1, -2])]
+        ~true_data['Pipeline Length'].isin(UNKNOWN_LENGTHS)]
     pred_data_excl_unknown = pred_data.loc[
-        ~pred_data['Pipeline Length'].isin([-1, -2])]
+        ~pred_data['Pipeline Length'].isin(UNKNOWN_LENGTHS)]
 
     # total mileage
     true_total_mi = true_data_excl_unknown['Pipeline Length'].sum()
@@ -166,7 +255,7 @@ def eval_performance(pred_path, true_path, filter_year_start=1945, filter_year_e
     # mileage by group
     for col_name, group in zip(mileage_cols, mileage_groups):
         print(f"Computing mileage performance for group: {col_name}")
-        for arg in get_args(Entry.model_fields[group].annotation):
+        for arg in get_args(CoreEntry.model_fields[group].annotation):
             true_mi = true_data_excl_unknown.loc[
                 (true_data_excl_unknown[col_name] == arg),
                 'Pipeline Length'].sum()
@@ -244,10 +333,71 @@ def eval_performance(pred_path, true_path, filter_year_start=1945, filter_year_e
         performance["mi_pred_over_true"]["New Complete Natural Gas Intrastate by Year"][yr] = (
             pred_mi_intra / true_mi_intra)
 
+    # confidence intervals of the mileage metrics
+    if bootstrap is not None:
+        print(f"Bootstrapping mileage metrics over {bootstrap}...")
+        # conditions of the entries counted in each metric
+        new_complete_gas = {"Fuel Type": "NATURAL GAS",
+                            "New Construction": "TRUE",
+                            "Construction Complete": "TRUE"}
+        metric_groups = {("Total",): {}}
+        for col_name, group in zip(mileage_cols, mileage_groups):
+            for arg in get_args(CoreEntry.model_fields[group].annotation):
+                metric_groups[(col_name, arg)] = {col_name: arg}
+        for yr in range(filter_year_start, filter_year_end + 1):
+            year = {**new_complete_gas, "Data Year": yr}
+            metric_groups[("New Complete Natural Gas by Year", yr)] = year
+            metric_groups[("New Complete Natural Gas Interstate by Year", yr)] = {
+                **year, "Interstate or Intrastate": "INTERSTATE"}
+            metric_groups[("New Complete Natural Gas Intrastate by Year", yr)] = {
+                **year, "Interstate or Intrastate": "INTRASTATE"}
+        groups = list(metric_groups.values())
+
+        unit_col = None
+        if bootstrap == "pages":
+            # hand-coded files without page numbers are resampled by year
+            unit_col = "Page Number"
+            if unit_col not in pred_data.columns or \
+                    unit_col not in true_data.columns:
+                unit_col = "Data Year"
+                print("No Page Number in both datasets, resampling data "
+                      "years instead of pages.")
+            pred_units, true_units = page_units(pred_data, true_data, groups,
+                                                page_col=unit_col)
+            if len(pred_units) < 2:
+                raise ValueError(
+                    f"Only {len(pred_units)} {unit_col} to resample: use "
+                    "bootstrap='entries' (--bootstrap entries).")
+        elif bootstrap == "entries":
+            pred_units, true_units = entry_units(alignment, groups)
+        else:
+            raise ValueError(
+                f"bootstrap must be 'pages' or 'entries', not {bootstrap}")
+        intervals = bootstrap_mileage(pred_units, true_units,
+                                      n_resamples=n_resamples,
+                                      confidence=confidence, seed=seed)
+        for metric, bounds in intervals.items():
+            ci = {}
+            for key, (low, high) in zip(metric_groups, bounds):
+                value = (None if np.isnan(low)
+                         else {"low": float(low), "high": float(high)})
+                if len(key) == 1:
+                    ci[key[0]] = value
+                else:
+                    ci.setdefault(key[0], {})[key[1]] = value
+            performance[f"{metric}_ci"] = ci
+        performance["bootstrap"] = {"unit": bootstrap,
+                                    "unit_col": unit_col,
+                                    "n_units": len(pred_units),
+                                    "n_resamples": n_resamples,
+                                    "confidence": confidence}
+
     # Log the evaluation results
     # TODO: create separate folder for performance evaluations and rename the log file something better
-    write_log(
-        f"Evaluation results for {pred_path} vs {true_path}:\n{json.dumps(performance, indent=4)}", log_dir=eval_log_dir)
+    if log:
+        run_config.write_log(
+            f"Evaluation results for {pred_path} vs {true_path}:\n{json.dumps(performance, indent=4)}",
+            log_dir=run_config.eval_log_dir)
 
     print("Evaluation complete.")
 
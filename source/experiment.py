@@ -0,0 +1,295 @@
+# ------------------------------------------------------------------------------
+# Load libraries ---------------------------------------------------------------
+# ------------------------------------------------------------------------------
+import os
+import json
+import time
+import random
+import itertools
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import pandas as pd
+
+import config
+import run_log
+from config import write_log
+from PagesLib import digitizer
+from PagesLib import Page
+from PagesLib.Page import page_to_dataframe
+from eval import eval_performance, load_true_data
+from utils import estimate_cost, load_api_key
+
+# ------------------------------------------------------------------------------
+# -- SET PARAMETERS ------------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+# Each variant is one combination of the values below
+GRID = {
+    "prompt": ["pipeline_extended_prompt_priv.txt"],  # file in source/prompts
+    "page_schema": ["PagePrivateExtended"],  # class name in PagesLib.Page
+    "model_id": ["gemini-2.5-flash", "gemini-2.5-pro"],
+    "png": [False],
+}
+
+# Pages to digitize for every variant (absolute page numbers in the pdf).
+# If None, N_SAMPLE pages are sampled: the TRUE_PAGES, then pages drawn at
+# random with SEED.
+PAGES = None
+N_SAMPLE = 10
+SEED = 42
+
+# Ground truth used to score each variant (set to None to skip scoring), and
+# the absolute pages of the pdf it covers (the hand-coded files have no page
+# numbers; e.g. [N] for the page of INPUT_FILE_PATH with page 2 of the 1951
+# report). Only the predictions of these pages are scored: without them, or if
+# none of them is digitized, the variants are not scored.
+TRUE_PATH = "outputs/1951_pg2_handcoded_JW_cleaned.csv"
+TRUE_PAGES = None
+FILTER_YEAR_START = 1950
+FILTER_YEAR_END = 1950
+
+# Number of API requests in flight at once
+MAX_WORKERS = 8
+
+# ------------------------------------------------------------------------------
+# -- Define functions ----------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+
+def make_client():
+    """ Gemini API client from the API key file (google.genai is imported
+        here, as in main.make_client, since it takes about a second to load)."""
+    from google import genai
+    return genai.Client(api_key=load_api_key())
+
+
+def make_variants(grid):
+    """
+    Expand a grid of parameter lists into a list of variants.
+
+    Args:
+        grid (dict): Parameter name to list of values.
+
+    Output:
+        Returns list of variant dicts, each with a unique "name".
+    """
+    variants = []
+    for i, values in enumerate(itertools.product(*grid.values())):
+        variant = dict(zip(grid.keys(), values))
+        variant["name"] = "_".join([
+            f"{i:02d}",
+            variant["model_id"],
+            os.path.splitext(variant["prompt"])[0],
+            variant["page_schema"],
+            "png" if variant["png"] else "pdf",
+        ])
+        variants.append(variant)
+    return variants
+
+
+def sample_pages(file_path, n_sample, seed, include=None):
+    """ Sample n_sample absolute page numbers from the pdf: the pages in
+        include (those with ground truth), then pages drawn at random."""
+    _, total_pages = digitizer.check_document(file_path, all_pages=True)
+    pages = [N for N in dict.fromkeys(include or []) if 1 <= N <= total_pages]
+    others = [N for N in range(1, total_pages + 1) if N not in pages]
+    rng = random.Random(seed)
+    pages += rng.sample(others, max(0, min(n_sample - len(pages),
+                                              len(others))))
+    return sorted(pages)
+
+
+def _extract(client, uploaded_file, variant, prompt_text, N):
+    """ Digitize one page for one variant, returning (df, seconds, usage)."""
+    usage = {}
+    start = time.time()
+    result = digitizer.extract_page_data(client, uploaded_file,
+                                         getattr(Page, variant["page_schema"]),
+                                         prompt_text, variant["model_id"],
+                                         usage=usage)
+    seconds = time.time() - start
+    if not result:
+        return None, seconds, usage
+    df = page_to_dataframe(result)
+    df["model_id"] = variant["model_id"]
+    df["absolute_page_n"] = N
+    return df, seconds, usage
+
+
+def run_experiment(client, file_path, variants, pages, experiment_dir,
+                   true_path=None, true_pages=None, filter_year_start=1945,
+                   filter_year_end=1950, max_workers=8):
+    """
+    Digitize the same pages with several prompt/schema/model variants at once.
+
+    Each page is uploaded once per file format (pdf/png) and shared by all
+    variants. Each variant's output is saved as {name}.csv in experiment_dir,
+    with its run_info.json in the {name} folder (as read by leaderboard.py).
+
+    Args:
+        client: Gemini API client.
+        file_path (str): Path to the PDF file.
+        variants (list): Variants from make_variants.
+        pages (list): Absolute page numbers to digitize.
+        experiment_dir (str): Folder for the experiment outputs.
+        true_path (str): Hand-coded ground truth to score variants against.
+        true_pages (list): Absolute pages covered by the ground truth: only
+            their predictions are scored ("scored_pages" in the report), and
+            the variants are not scored if none of them is in pages.
+        filter_year_start (int): Only evaluate predictions starting from this year.
+        filter_year_end (int): Only evaluate predictions ending in this year (inclusive).
+        max_workers (int): Number of API requests in flight at once.
+
+    Output:
+        Returns report (pd.DataFrame) with accuracy, cost and latency per variant.
+    """
+    log = run_log.current()
+    os.makedirs(experiment_dir, exist_ok=True)
+
+    prompts = {}
+    for prompt in {v["prompt"] for v in variants}:
+        with open(os.path.join("source/prompts", prompt), "r",
+                  encoding="utf-8") as file:
+            prompts[prompt] = file.read()
+
+    # Variants are only scored on the pages with ground truth (other pages
+    # would count as hallucinated entries)
+    true_data = load_true_data(true_path) if true_path else None
+    scored_pages = (sorted(set(true_pages or []) & set(pages))
+                    if true_data is not None else [])
+    if true_data is not None and not scored_pages:
+        log.warning(f"None of the pages {pages} is covered by {true_path} "
+                    f"(true_pages={true_pages}), the variants are not scored",
+                    stage="experiment")
+        true_data = None
+
+    # Upload each page once per file format -----------------------------------
+    # (the uploads are deleted even if the experiment fails or is interrupted)
+    uploads = {}
+    results = {v["name"]: [] for v in variants}
+    try:
+        for png in {v["png"] for v in variants}:
+            for N in pages:
+                uploads[(N, png)] = digitizer.upload_pages_to_API(
+                    client, file_path, N, N, png=png)
+
+        # Digitize all (variant, page) pairs concurrently ----------------------
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {
+                pool.submit(_extract, client, uploads[(N, v["png"])], v,
+                            prompts[v["prompt"]], N): (v["name"], N)
+                for v in variants for N in pages
+            }
+            for future in as_completed(futures):
+                name, N = futures[future]
+                try:
+                    df, seconds, usage = future.result()
+                except Exception as e:
+                    log.error(f"FAILURE - {name}: {e}", stage="experiment",
+                              page=N)
+                    df, seconds, usage = None, None, {}
+                results[name].append((N, df, seconds, usage))
+                log.debug(f"Finished {name}", stage="experiment", page=N)
+                log.progress(sum(len(r) for r in results.values()),
+                             len(futures), stage="variant pages")
+    finally:
+        for uploaded_file in uploads.values():
+            try:
+                client.files.delete(name=uploaded_file.name)
+            except Exception as e:
+                log.warning(f"Failed to delete uploaded file "
+                            f"{uploaded_file.name}: {e}", stage="experiment")
+
+    # Save and score each variant ----------------------------------------------
+    rows = []
+    for v in variants:
+        page_results = sorted(results[v["name"]], key=lambda r: r[0])
+        dfs = [df for _, df, _, _ in page_results if df is not None]
+        seconds = pd.Series([s for _, _, s, _ in page_results if s is not None],
+                            dtype=float)
+        input_tokens = sum(u.get("input_tokens", 0) for *_, u in page_results)
+        output_tokens = sum(u.get("output_tokens", 0) for *_, u in page_results)
+        # digitized pages with ground truth
+        scored = {N: df for N, df, _, _ in page_results
+                  if df is not None and N in scored_pages}
+
+        pred_path = os.path.join(experiment_dir, v["name"] + ".csv")
+        run_info = {
+            "model_id": v["model_id"],
+            "prompt": v["prompt"],
+            "page_schema": v["page_schema"],
+            "png": v["png"],
+            "pages": pages,
+            "scored_pages": list(scored),
+            "elapsed_s": seconds.sum(),
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+        }
+        os.makedirs(os.path.join(experiment_dir, v["name"]), exist_ok=True)
+        with open(os.path.join(experiment_dir, v["name"], "run_info.json"),
+                  "w", encoding="utf-8") as file:
+            json.dump(run_info, file, indent=4)
+
+        row = {
+            **{k: v[k] for k in ["name", "model_id", "prompt", "page_schema", "png"]},
+            "pages_ok": len(dfs),
+            "pages_failed": len(pages) - len(dfs),
+            "latency_mean_s": seconds.mean(),
+            "latency_p95_s": seconds.quantile(0.95),
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "cost_usd": estimate_cost(v["model_id"], input_tokens, output_tokens),
+        }
+        if true_data is not None:
+            row["scored_pages"] = len(scored)
+        if dfs:
+            pd.concat(dfs, ignore_index=True).to_csv(pred_path, index=False)
+            if scored:
+                scored_path = os.path.join(experiment_dir, v["name"],
+                                           "scored_pages.csv")
+                pd.concat(scored.values(), ignore_index=True).to_csv(
+                    scored_path, index=False)
+                try:
+                    performance = eval_performance(
+                        scored_path, true_path,
+                        filter_year_start=filter_year_start,
+                        filter_year_end=filter_year_end,
+                        true_data=true_data, log=False)
+                    accuracy = [a for a in performance["accuracy"].values()
+                                if a is not None]
+                    row["accuracy_mean"] = (sum(accuracy) / len(accuracy)
+                                            if accuracy else None)
+                    row["mi_pct_err_total"] = performance["mi_pct_err"]["Total"]
+                except Exception as e:
+                    log.error(f"FAILURE - Could not evaluate {pred_path}: {e}",
+                              stage="experiment")
+        rows.append(row)
+
+    report = pd.DataFrame(rows)
+    report.to_csv(os.path.join(experiment_dir, "report.csv"), index=False)
+    write_log(f"Experiment report for {experiment_dir}:\n{report.to_string()}")
+    return report
+
+
+if __name__ == "__main__":
+    timestamp = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
+    experiment_dir = os.path.join(config.output_dir, "experiments", timestamp)
+
+    log = run_log.get_logger(experiment_dir, "experiment")
+    run_log.set_current(log)
+    client = make_client()
+
+    pages = PAGES or sample_pages(config.INPUT_FILE_PATH, N_SAMPLE, SEED,
+                                  include=TRUE_PAGES if TRUE_PATH else None)
+    log.info(f"Running {len(make_variants(GRID))} variants on pages {pages}",
+             stage="experiment")
+
+    report = run_experiment(client, config.INPUT_FILE_PATH, make_variants(GRID),
+                            pages, experiment_dir, true_path=TRUE_PATH,
+                            true_pages=TRUE_PAGES,
+                            filter_year_start=FILTER_YEAR_START,
+                            filter_year_end=FILTER_YEAR_END,
+                            max_workers=MAX_WORKERS)
+    log.info(f"Experiment report:\n{report.to_string()}", stage="experiment")
+    log.info(f"Saved experiment report in {experiment_dir}", stage="done")
+    log.close()
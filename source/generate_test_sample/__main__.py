@@ -1,17 +1,20 @@
-import pandas as pd
-import random
-import sys
 import os
+import sys
+import csv
+import argparse
+import numpy as np
+import pandas as pd
 from PyPDF2 import PdfReader, PdfWriter
-import openpyxl
+from openpyxl import Workbook
 
 # ----------------------------------------------------------------------------------
 # -- PARAMETERS---------------------------------------------------------------------
 # ----------------------------------------------------------------------------------
 
-PCT = 0.05  # Fraction of unique pages values to sample (e.g., 0.5 for 50%)
+PCT = 0.05  # Fraction of pages to sample in each stratum (e.g., 0.5 for 50%)
 SEED = 42  # Random seed for reproducibility
-
+N_DENSITY_BINS = 3  # Number of entry density strata (entries per page quantiles)
+CHUNKSIZE = 50000  # Number of csv rows read at a time
 
 # ----------------------------------------------------------------------------------
 # -- SET PATHS ---------------------------------------------------------------------
@@ -19,122 +22,144 @@ SEED = 42  # Random seed for reproducibility
 # Get the parent directory and add it to the Python path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
-# Now you can import config
-import config
-
-# TO UPDATE FOR EACH DIGITIZED DIRECTORY SEPARATELY ---------------
-year = "1974"
-digitized_dir = os.path.join(config.data_dir, "raw_data", "urban_renewal_directories", "gemini_output",
-                    year, "Run_2025-02-28_18-51-21__by1pages")
-
-# General path definitions ---------------
-os.makedirs(os.path.join(digitized_dir, "tests"), exist_ok=True)  # Create directory for test files if it doesn't exist
-
-
-INPUT_CSV_FILE = os.path.join(digitized_dir, f"Urban_Renewal_Directory_{year}.csv")  # Path to the input CSV file
-
-OUTPUT_CSV_FILE = os.path.join(digitized_dir, "tests", "directory_test_pages.csv")  # Path to save the output CSV file
-
-OUTPUT_XLSX_FILE = os.path.join(digitized_dir, "tests", "directory_test_pages.xlsx")  # Path to save the output Excel file
-
-INPUT_PDF_FILE = config.get_directory_filepath(year)  # Path to the input PDF file
-
-OUTPUT_PDF_FILE = os.path.join(digitized_dir, "tests", "scanned_test_pages.pdf") # Path to save the filtered PDF
-
-
-PCT = 0.05  # Fraction of unique pages values to sample (e.g., 0.5 for 50%)
-SEED = 42  # Random seed for reproducibility
+from PagesLib import Page  # noqa: E402
+from convert import infer_page_schema  # noqa: E402
 
 # ----------------------------------------------------------------------------------
 # -- FUNCTIONS ---------------------------------------------------------------------
 # ----------------------------------------------------------------------------------
-def subset_by_pages(input_csv, output_csv, output_xlsx, pct, seed, input_pdf, output_pdf):
-    # Set the random seed for reproducibility
-    random.seed(seed)
-
-    # Read the CSV file
-    df = pd.read_csv(input_csv)
-
-    # Ensure 'absolute_page_n' is an integer column
-    df['absolute_page_n'] = pd.to_numeric(df['absolute_page_n'], errors='coerce').dropna().astype(int)
-
-    # Check if 'PAGES' column exists
-    if 'absolute_page_n' not in df.columns:
-        raise ValueError("The input CSV must contain a 'absolute_page_n' column.")
-
-    # Get unique pages values
-    unique_pages = df['absolute_page_n'].unique()
-
-    # Determine the number of pages to sample
-    num_samples = max(1, int(len(unique_pages) * pct))
-
-    # Randomly select a subset of pages
-    sampled_pages = random.sample(list(unique_pages), num_samples)
-
-    # Ensure sampled pages are integers
-    sampled_pages = [int(page) for page in sampled_pages]
 
-    # Filter the dataframe
-    filtered_df = df[df['absolute_page_n'].isin(sampled_pages)]
 
-    # Save to output CSV
-    filtered_df.to_csv(output_csv, index=False)
+def page_stats(input_csv, chunksize=CHUNKSIZE):
+    """Count entries and get the data year of each page, reading only those columns in chunks.
+
+    Returns a DataFrame indexed by absolute_page_n with "entries" and "Data Year" columns.
+    """
+    counts = []
+    years = []
+    for chunk in pd.read_csv(input_csv, usecols=["absolute_page_n", "Data Year"],
+                             chunksize=chunksize):
+        chunk["absolute_page_n"] = pd.to_numeric(chunk["absolute_page_n"], errors="coerce")
+        chunk = chunk.dropna(subset=["absolute_page_n"])
+        chunk["absolute_page_n"] = chunk["absolute_page_n"].astype(int)
+        grouped = chunk.groupby("absolute_page_n")
+        counts.append(grouped.size())
+        years.append(grouped["Data Year"].first())
+
+    if not counts:
+        raise ValueError(f"No pages found in {input_csv}.")
+    stats = pd.DataFrame({
+        "entries": pd.concat(counts).groupby(level=0).sum(),
+        "Data Year": pd.concat(years).groupby(level=0).first(),
+    })
+    return stats
+
+
+def stratified_sample(stats, pct, seed, n_density_bins=N_DENSITY_BINS):
+    """Sample pages within each (Data Year, entry density) stratum.
+
+    At least one page is drawn from every stratum.
+    """
+    rng = np.random.default_rng(seed)
+    density = pd.qcut(stats["entries"].rank(method="first"),
+                      q=min(n_density_bins, len(stats)), labels=False)
+    strata = stats.assign(density=density)
+    strata["Data Year"] = strata["Data Year"].fillna("UNK")
+
+    sampled_pages = []
+    for _, group in strata.groupby(["Data Year", "density"]):
+        n = max(1, int(round(len(group) * pct)))
+        sampled_pages.extend(rng.choice(group.index.to_numpy(), size=n, replace=False))
+    return sorted(int(page) for page in sampled_pages)
+
+
+def write_sample(input_csv, output_csv, output_xlsx, sampled_pages, chunksize=CHUNKSIZE):
+    """Write the rows of the sampled pages to csv and xlsx, one chunk at a time.
+
+    The xlsx gets an empty "Incorrect ..." column for each data column for the reviewer to fill in.
+    """
+    with open(input_csv, "r", newline="", encoding="utf-8") as file:
+        header = next(csv.reader(file))
+    review_columns = [f"Incorrect {col}" for col, _, _ in
+                      Page.page_columns(infer_page_schema(header))
+                      if col not in ("Data Year", "Page Number")]
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(header + review_columns)
+
+    n_rows = 0
+    sampled = set(sampled_pages)
+    for i, chunk in enumerate(pd.read_csv(input_csv, dtype=str, keep_default_na=False,
+                                          chunksize=chunksize)):
+        pages = pd.to_numeric(chunk["absolute_page_n"], errors="coerce")
+        chunk = chunk.loc[pages.isin(sampled)]
+        chunk.to_csv(output_csv, mode="w" if i == 0 else "a", header=(i == 0), index=False)
+        for row in chunk.itertuples(index=False):
+            sheet.append([value if value != "" else None for value in row])
+        n_rows += len(chunk)
+
+    workbook.save(output_xlsx)
+    print(f"Filtered dataset saved to {output_csv} and {output_xlsx} with {n_rows} rows.")
 
-    # Add test columns for user to fill in
-    test_columns = [
-        "Incorrect State", "Incorrect City Spelling", "Incorrect City Assignment",
-        "Incorrect Project Name Spelling", "Incorrect Project Before",
-        "Incorrect Project After", "Incorrect Project Type", "Incorrect Project ID",
-        "Incorrect Planning Date", "Incorrect Execution Date", "Incorrect Completion Date",
-        "Incorrect Project Approved Grants", "Incorrect Federal Grants Status",
-        "Incorrect Project Disbursed Grants"
-    ]
 
-    # Add empty columns to the DataFrame
-    for col in test_columns:
-        df[col] = ""
-
-
-    # Save to output Excel file
-    filtered_df.to_excel(output_xlsx, index=False, engine='openpyxl')
+def extract_pdf_pages(input_pdf, output_pdf, pages_to_keep):
+    """Extracts selected pages from a PDF and saves a new PDF.
 
-    print(f"Filtered dataset saved to {output_csv} and {output_xlsx} with {len(filtered_df)} rows.")
+    Pages are read lazily, in order, so only the selected pages are loaded.
+    """
+    reader = PdfReader(input_pdf)
+    writer = PdfWriter()
+    total_pages = len(reader.pages)
 
-    # Process PDF file
-    extract_pdf_pages(input_pdf, output_pdf, sampled_pages)
+    for page_num in sorted(pages_to_keep):  # Ensure order is maintained
+        if 1 <= page_num <= total_pages:  # Ensure page exists
+            writer.add_page(reader.pages[page_num - 1])  # PDF pages are 0-indexed
+        else:
+            print(f"Warning: Page {page_num} is out of range and will be skipped.")
 
+    # Save the new PDF
+    with open(output_pdf, "wb") as output_file:
+        writer.write(output_file)
 
-def extract_pdf_pages(input_pdf, output_pdf, pages_to_keep):
-    """Extracts selected pages from a PDF and saves a new PDF."""
-    try:
-        reader = PdfReader(input_pdf)
-        writer = PdfWriter()
+    print(f"Filtered PDF saved to {output_pdf} with {len(writer.pages)} pages.")
 
-        for page_num in sorted(pages_to_keep):  # Ensure order is maintained
-            if 1 <= page_num <= len(reader.pages):  # Ensure page exists
-                writer.add_page(reader.pages[page_num - 1])  # PDF pages are 0-indexed
-            else:
-                print(f"Warning: Page {page_num} is out of range and will be skipped.")
 
-        # Save the new PDF
-        with open(output_pdf, "wb") as output_file:
-            writer.write(output_file)
+def subset_by_pages(input_csv, input_pdf, output_dir, pct=PCT, seed=SEED):
+    """Sample pages of a digitized csv and write the review csv/xlsx and the scanned pages pdf."""
+    os.makedirs(output_dir, exist_ok=True)  # Create directory for test files if it doesn't exist
 
-        print(f"Filtered PDF saved to {output_pdf} with {len(writer.pages)} pages.")
-
-    except Exception as e:
-        print(f"Error processing PDF: {e}")
+    stats = page_stats(input_csv)
+    sampled_pages = stratified_sample(stats, pct, seed)
+    print(f"Sampled {len(sampled_pages)} of {len(stats)} pages: {sampled_pages}")
 
+    write_sample(input_csv,
+                 os.path.join(output_dir, "directory_test_pages.csv"),
+                 os.path.join(output_dir, "directory_test_pages.xlsx"),
+                 sampled_pages)
+    extract_pdf_pages(input_pdf, os.path.join(output_dir, "scanned_test_pages.pdf"),
+                      sampled_pages)
+    return sampled_pages
 
 
 # ----------------------------------------------------------------------------------
 # -- Execution ---------------------------------------------------------------------
 # ----------------------------------------------------------------------------------
 
-# Run the function
-subset_by_pages(INPUT_CSV_FILE, OUTPUT_CSV_FILE, OUTPUT_XLSX_FILE, PCT, SEED,
-                INPUT_PDF_FILE, OUTPUT_PDF_FILE)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Sample pages of a digitized csv for manual verification.")
+    parser.add_argument("input_csv", help="Digitized csv (with absolute_page_n and Data Year columns).")
+    parser.add_argument("input_pdf", help="Scanned pdf that was digitized.")
+    parser.add_argument("--output-dir", default=None,
+                        help="Output folder (defaults to a tests folder next to the csv).")
+    parser.add_argument("--pct", type=float, default=PCT)
+    parser.add_argument("--seed", type=int, default=SEED)
+    args = parser.parse_args()
+
+    output_dir = args.output_dir or os.path.join(os.path.dirname(args.input_csv), "tests")
+    subset_by_pages(args.input_csv, args.input_pdf, output_dir, pct=args.pct, seed=args.seed)
 
 
 # ----------------------------------------------------------------------------------
-# ----------------------------------------------------------------------------------
\ No newline at end of file
+# ----------------------------------------------------------------------------------
@@ -0,0 +1,201 @@
+# ------------------------------------------------------------------------------
+# Load libraries ---------------------------------------------------------------
+# ------------------------------------------------------------------------------
+import os
+import glob
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+
+import config
+from config import write_log
+from eval import eval_performance, load_true_data
+from utils import estimate_cost
+
+# ------------------------------------------------------------------------------
+# -- Define functions ----------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+# Ground truth shared by the evaluation workers (set once per worker process)
+_TRUE_DATA = None
+
+
+def read_run_info(pred_path):
+    """
+    Read the run_info.json saved by main.py for a prediction file.
+
+    The file is looked up in the intermediate folder named after the csv
+    (for final outputs) and then in the folder of the csv (for pg{N}.csv files).
+
+    Args:
+        pred_path (str): Path to csv with predicted data.
+
+    Output:
+        Returns run info (dict), empty if no run_info.json was found.
+    """
+    for folder in [os.path.splitext(pred_path)[0], os.path.dirname(pred_path)]:
+        info_path = os.path.join(folder, "run_info.json")
+        if os.path.exists(info_path):
+            with open(info_path, "r", encoding="utf-8") as file:
+                return json.load(file)
+    return {}
+
+
+def flatten_metrics(performance, prefix=""):
+    """
+    Flatten the nested performance dict from eval_performance.
+
+    Args:
+        performance (dict): Nested performance metrics.
+        prefix (str): Prefix for the flattened keys.
+
+    Output:
+        Returns dict of "metric/group/value" keys to metric values.
+    """
+    flat = {}
+    for key, value in performance.items():
+        name = f"{prefix}/{key}" if prefix else str(key)
+        if isinstance(value, dict):
+            flat.update(flatten_metrics(value, name))
+        else:
+            flat[name] = value
+    return flat
+
+
+def _init_worker(true_data):
+    global _TRUE_DATA
+    _TRUE_DATA = true_data
+
+
+def _eval_run(pred_path, true_path, filter_year_start, filter_year_end, filter_pg,
+              bootstrap=None):
+    """ Evaluate one prediction file against the worker's ground truth."""
+    performance = eval_performance(pred_path, true_path,
+                                   filter_year_start=filter_year_start,
+                                   filter_year_end=filter_year_end,
+                                   filter_pg=filter_pg,
+                                   true_data=_TRUE_DATA,
+                                   log=False,
+                                   bootstrap=bootstrap)
+    run_info = read_run_info(pred_path)
+    if "model_id" not in run_info:
+        models = pd.read_csv(pred_path, usecols=lambda c: c == "model_id")
+        if "model_id" in models.columns:
+            run_info["model_id"] = ";".join(
+                models["model_id"].dropna().astype(str).unique())
+    return performance, run_info
+
+
+def build_leaderboard(pred_paths, true_path, filter_year_start=1945,
+                      filter_year_end=1950, filter_pg=None, workers=None,
+                      bootstrap=None):
+    """
+    Evaluate several prediction files against the same ground truth in parallel.
+
+    The ground truth is loaded once and shared with all evaluation workers.
+
+    Args:
+        pred_paths (list): Paths to csv files with predicted data.
+        true_path (str): Path to spreadsheet with hand-coded ground truth data.
+        filter_year_start (int): Only evaluate predictions starting from this year.
+        filter_year_end (int): Only evaluate predictions ending in this year (inclusive).
+        filter_pg (int): Only evaluate predictions from this page.
+        workers (int): Number of worker processes (defaults to the CPU count).
+        bootstrap (str): "pages" or "entries" to add confidence intervals of
+            the mileage metrics (see eval_performance).
+
+    Output:
+        Returns leaderboard (pd.DataFrame) with one row per run, sorted by
+        total mileage error. Also logs the leaderboard to the log file.
+    """
+    true_data = load_true_data(true_path)
+
+    rows = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(true_data,)) as pool:
+        futures = {
+            pool.submit(_eval_run, pred_path, true_path, filter_year_start,
+                        filter_year_end, filter_pg, bootstrap): pred_path
+            for pred_path in pred_paths
+        }
+        for future in as_completed(futures):
+            pred_path = futures[future]
+            try:
+                performance, run_info = future.result()
+            except Exception as e:
+                print(f"FAILURE - Could not evaluate {pred_path}: {e}")
+                continue
+
+            input_tokens = run_info.get("input_tokens")
+            output_tokens = run_info.get("output_tokens")
+            cost = None
+            if input_tokens is not None and output_tokens is not None:
+                cost = estimate_cost(run_info.get("model_id"), input_tokens,
+                                     output_tokens)
+            rows.append({
+                "run": os.path.splitext(os.path.basename(pred_path))[0],
+                "pred_path": pred_path,
+                "model_id": run_info.get("model_id"),
+                "prompt": run_info.get("prompt"),
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens,
+                "cost_usd": cost,
+                "elapsed_s": run_info.get("elapsed_s"),
+                **flatten_metrics(performance),
+            })
+
+    leaderboard = pd.DataFrame(rows)
+    if "mi_pct_err/Total" in leaderboard.columns:
+        leaderboard = leaderboard.sort_values("mi_pct_err/Total",
+                                              ignore_index=True)
+
+    summary_cols = [c for c in ["run", "model_id", "prompt", "cost_usd",
+                                "mi_pct_err/Total"] if c in leaderboard.columns]
+    write_log(
+        f"Leaderboard for {len(rows)} runs vs {true_path}:\n{leaderboard[summary_cols].to_string()}",
+        log_dir=os.path.join(config.output_dir, "performance_evals"))
+
+    return leaderboard
+
+
+def write_leaderboard(leaderboard, out_path):
+    """ Save the leaderboard as .csv or .parquet (by file extension)."""
+    if out_path.endswith(".parquet"):
+        leaderboard.to_parquet(out_path, index=False)
+    elif out_path.endswith(".csv"):
+        leaderboard.to_csv(out_path, index=False)
+    else:
+        raise ValueError(
+            f"Leaderboard file {out_path} must be .csv or .parquet format.")
+    print(f"Saved leaderboard for {len(leaderboard)} runs to {out_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Evaluate many prediction files against one ground truth file.")
+    parser.add_argument("pred_paths", nargs="+",
+                        help="Prediction csv files (glob patterns are expanded).")
+    parser.add_argument("--truth", required=True,
+                        help="Hand-coded ground truth (.csv or .xlsx).")
+    parser.add_argument("--out", default=os.path.join(
+        config.output_dir, "performance_evals", "leaderboard.csv"),
+        help="Output .csv or .parquet file.")
+    parser.add_argument("--year-start", type=int, default=1945)
+    parser.add_argument("--year-end", type=int, default=1950)
+    parser.add_argument("--page", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--bootstrap", default=None, choices=["pages", "entries"],
+                        help="Add confidence intervals of the mileage metrics.")
+    args = parser.parse_args()
+
+    pred_paths = sorted({p for pattern in args.pred_paths
+                         for p in (glob.glob(pattern) or [pattern])})
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+    leaderboard = build_leaderboard(pred_paths, args.truth,
+                                    filter_year_start=args.year_start,
+                                    filter_year_end=args.year_end,
+                                    filter_pg=args.page,
+                                    workers=args.workers,
+                                    bootstrap=args.bootstrap)
+    write_leaderboard(leaderboard, args.out)
@@ -1,93 +1,320 @@
 # ------------------------------------------------------------------------------
 # Load libraries ---------------------------------------------------------------
 # ------------------------------------------------------------------------------
-from google import genai
 import os
-from datetime import datetime
-import pandas as pd
+import json
+import time
+import dataclasses
+from concurrent.futures import ThreadPoolExecutor
 
 # Load the user-defined files -----
 
 import config
-from config import write_log
-from PagesLib import digitizer
-from eval import eval_performance
+from PagesLib import digitizer, prescan
+from PagesLib.uploads import UploadCache, UploadManager
+from PagesLib.hedging import HedgePolicy
+from PagesLib.shards import Shard, ShardPool
+from results_db import ResultsStore
+from quality import QualityGate
+import profiling
+import run_log
+from utils import load_api_key, load_api_keys
 
 # Note: API requires an API key, saved in GEMINI_API_KEY.txt in this directory
 
 
-def main():
-    # TODO: pass in config here instead of importing?
+def make_client(api_key=None):
+    """ Gemini API client from the API key (read from the key file if not
+        given). google.genai is imported here since it takes about a second
+        to load."""
+    from google import genai
+    return genai.Client(api_key=api_key or load_api_key())
+
+
+def make_upload_manager(rc, client, manifest_path):
+    """ UploadManager with the storage settings of a RunConfig."""
+    return UploadManager(client, manifest_path=manifest_path,
+                         quota_bytes=int(rc.upload_quota_gb * 1024**3))
+
+
+def make_shards(rc, manifest_prefix, shared=False):
+    """
+    ShardPool of the API keys in rc.api_key_pool, each with its own client and
+    upload manager (manifest {manifest_prefix}_{key name}.jsonl).
+
+    Args:
+        rc (RunConfig): Parameters of the run.
+        manifest_prefix (str): Path of the upload manifests, without the key name.
+        shared (bool): If True, each key also gets an UploadCache, for runs
+            sharing the pool (see run_many).
+
+    Output:
+        Returns the ShardPool (close it when done).
+    """
+    shards = []
+    for name, api_key in load_api_keys(rc.api_key_pool).items():
+        client = make_client(api_key)
+        uploads = make_upload_manager(rc, client,
+                                      f"{manifest_prefix}_{name}.jsonl")
+        shards.append(Shard(name, client, uploads,
+                            UploadCache(uploads) if shared else None))
+    return ShardPool(shards)
+
+
+def main(run_config=None, client=None, upload_cache=None, shards=None):
+    """
+    Digitize a document.
+
+    Args:
+        run_config (RunConfig): Parameters of the run (defaults to the
+            parameters in config.py).
+        client: Gemini API client (created from the API key if not given).
+        upload_cache (UploadCache): Uploads shared with other runs (see run_many).
+        shards (ShardPool): API keys shared with other runs (see run_many);
+            by default, the keys of rc.api_key_pool if set.
+
+    Output:
+        Returns the digitized data (pd.DataFrame, or None if nothing was found
+        or with low_memory, where the data is only saved).
+        Also saves the results, run_info.json and the run log in the run's
+        output folders, and records the run in the results database.
+    """
+    rc = run_config or config.get_run_config()
     # --------------------------------------------------------------------------
     # -- Execution -------------------------------------------------------------
     # --------------------------------------------------------------------------
-    # Valid parameters check
-    if (config.page_window > 1 and config.png == True):
-        raise ValueError(
-            f"Page window is {config.page_window} but .png files must be a single page!"
-        )
-
     # Create output directory
-    if not os.path.exists(config.results_dir):
-        os.makedirs(config.results_dir)
-    if not os.path.exists(config.log_dir):
-        os.makedirs(config.log_dir)
-    if not os.path.exists(config.intermediate_dir):
-        os.makedirs(config.intermediate_dir)
+    if not os.path.exists(rc.results_dir):
+        os.makedirs(rc.results_dir, exist_ok=True)
+    if not os.path.exists(rc.log_dir):
+        os.makedirs(rc.log_dir, exist_ok=True)
+    if not os.path.exists(rc.intermediate_dir):
+        os.makedirs(rc.intermediate_dir)
 
     # Log parameters used -----------------------------------------
-    config.log_config()
+    log = rc.get_logger()
+    log_token = run_log.set_current(log)
+    rc.log_config()
 
-    print(f"Using task prompt in {config.prompt_text_name}")
-    print(f"Saving output in {config.results_dir}")
+    log.info(f"Using task prompt in {rc.prompt_text_name}", stage="setup")
+    log.info(f"Saving output in {rc.results_dir}", stage="setup")
 
     # Set the input data
-    filepath = config.INPUT_FILE_PATH
+    filepath = rc.input_file_path
 
     # get pages to digitize
     start_page, n_pages = digitizer.check_document(filepath,
-                                                   all_pages=config.all_pages,
-                                                   start_page=config.start_page,
-                                                   n_pages=config.n_pages)
-
-    # Create a client -----------------------------------------
+                                                   all_pages=rc.all_pages,
+                                                   start_page=rc.start_page,
+                                                   n_pages=rc.n_pages)
 
-    # get API key
-    with open("secret/GEMINI_API_KEY.txt", "r", encoding="utf-8") as file:
-        api_key = file.read()
-        print("Successfully loaded API key")
-
-    client = genai.Client(api_key=api_key)
-    print("Successfully loaded Gemini AI client with API key")
+    # Create a client (or one per key of the pool) ------------------
+    own_shards = shards is None and rc.api_key_pool is not None
+    if own_shards:
+        shards = make_shards(rc, os.path.join(rc.intermediate_dir, "uploads"))
+    if shards is not None:
+        log.info(f"Spreading pages across {len(shards)} API keys",
+                 stage="setup")
+    elif client is None:
+        client = make_client()
+        log.info("Successfully loaded Gemini AI client with API key",
+                 stage="setup")
 
     # Read in the structured prompt
-    with open(config.prompt_text_path, "r", encoding="utf-8") as file:
+    with open(rc.prompt_text_path, "r", encoding="utf-8") as file:
         task = file.read()
 
     # Defined .csv outfile path
-    outpath = os.path.join(config.results_dir, config.OUTPUT_FILE_NAME)
-    print(f"Outpath set to: {outpath}")
+    outpath = os.path.join(rc.results_dir, rc.output_file_name)
+    log.info(f"Outpath set to: {outpath}", stage="setup")
+
+    # Find blank and duplicate pages ---------------------------------
+    page_status = None
+    if rc.prescan:
+        try:
+            page_status = prescan.prescan_pages(filepath, start_page, n_pages)
+            prescan.write_prescan_report(
+                page_status, os.path.join(rc.intermediate_dir,
+                                          "prescan_report.csv"))
+        except Exception as e:
+            log.warning(f"Prescan failed, processing all pages: {e}",
+                        stage="prescan")
 
     # Run digitizer process ------------------------------------------
-    df = digitizer.process_pages(client,
-                                 filepath,
-                                 model=config.page_schema,
-                                 prompt_text=task,
-                                 model_id=config.gemini_model_id,
-                                 total_pages=n_pages,
-                                 start_page=start_page,
-                                 outfile_path=outpath,
-                                 intermediate_dir=config.intermediate_dir,
-                                 page_window=config.page_window,
-                                 page_placement=config.page_placement,
-                                 png=config.png)
-    write_log("PROCESS COMPLETE")
-    print("\n Digitizing task complete !! ")
+    hedge = (HedgePolicy(percentile=rc.hedge_percentile,
+                         max_fraction=rc.hedge_max_fraction)
+             if rc.hedge_requests else None)
+    # score the probe pages first, if there is ground truth to check against
+    quality = QualityGate.from_run_config(rc)
+    # every upload is recorded in uploads.jsonl and deleted, even if the run fails
+    # (with a pool of keys, in each key's uploads_{name}.jsonl)
+    if shards is not None:
+        uploads = None
+    elif upload_cache is not None and upload_cache.uploads is not None:
+        uploads = upload_cache.uploads
+    else:
+        uploads = make_upload_manager(
+            rc, client, os.path.join(rc.intermediate_dir, "uploads.jsonl"))
+    # Record the run in the results database (pages are written as they are done)
+    store = None
+    if rc.store_results:
+        store = ResultsStore(rc.results_db, rc.run_id)
+        store.start_run(model_id=rc.gemini_model_id,
+                        prompt=rc.prompt_text_name, prompt_text=task,
+                        page_schema=rc.page_schema.__name__,
+                        input_file=filepath, output_file=outpath,
+                        parameters={f.name: getattr(rc, f.name)
+                                    for f in dataclasses.fields(rc)})
+    # time the stages of the run (see profiling.py)
+    profiler = None
+    if rc.profile_stages:
+        profiler = profiling.StageProfiler(memory=rc.profile_memory)
+        profiler_token = profiling.set_current(profiler)
+    usage = {}
+    run_start = time.time()
+    try:
+        with profiling.stage("process_pages"):
+            df = digitizer.process_pages(client,
+                                         filepath,
+                                         model=rc.page_schema,
+                                         prompt_text=task,
+                                         model_id=rc.gemini_model_id,
+                                         total_pages=n_pages,
+                                         start_page=start_page,
+                                         outfile_path=outpath,
+                                         intermediate_dir=rc.intermediate_dir,
+                                         page_window=rc.page_window,
+                                         page_placement=rc.page_placement,
+                                         png=rc.png,
+                                         usage=usage,
+                                         page_status=page_status,
+                                         shared_uploads=rc.upload_pages_once,
+                                         upload_cache=upload_cache,
+                                         hedge=hedge,
+                                         stream=rc.stream_responses,
+                                         uploads=uploads,
+                                         max_concurrency=rc.max_concurrency,
+                                         low_memory=rc.low_memory,
+                                         dedup=rc.merge_duplicate_entries,
+                                         compact=rc.compact_schema,
+                                         fast_decode=rc.fast_decode,
+                                         quality=quality,
+                                         store=store,
+                                         shards=shards)
+    except BaseException:
+        if store is not None:
+            store.finish_run(status="failed")
+            store.close()
+        raise
+    finally:
+        if uploads is not None and \
+                uploads is not getattr(upload_cache, "uploads", None):
+            uploads.close()
+        if own_shards:
+            shards.close()
+        if profiler is not None:
+            profiling.reset_current(profiler_token)
+            profiler.close()
+            paths = profiler.write(rc.intermediate_dir)
+            log.info(f"Stage profile (flame graph: {paths['folded']}):\n"
+                     + profiler.summary_table(), stage="profile")
+
+    # Save run metadata next to the intermediate results (read by leaderboard.py)
+    run_info = {
+        "model_id": rc.gemini_model_id,
+        "prompt": rc.prompt_text_name,
+        "page_schema": rc.page_schema.__name__,
+        "start_page": start_page,
+        "n_pages": n_pages,
+        "elapsed_s": time.time() - run_start,
+        **usage,
+    }
+    if page_status is not None:
+        run_info["duplicate_pages"] = {
+            N: r["duplicate_of"] for N, r in page_status.items()
+            if r["status"] == "duplicate"}
+    if hedge is not None:
+        run_info["hedged_requests"] = hedge.hedged
+    run_info["uploaded_bytes"] = (shards or uploads).uploaded_bytes
+    if quality is not None:
+        run_info["quality"] = quality.report()
+    with open(os.path.join(rc.intermediate_dir, "run_info.json"), "w",
+              encoding="utf-8") as file:
+        json.dump(run_info, file, indent=4)
+    if store is not None:
+        store.finish_run(run_info, status=(
+            "aborted" if quality is not None and quality.failed and
+            quality.action == "abort" else "done"))
+        store.close()
+
+    rc.write_log("PROCESS COMPLETE")
+    log.info("Digitizing task complete !! ", stage="done")
+    log.close()
+    run_log.reset_current(log_token)
+    return df
 
     # --------------------------------------------------------------------------
     # --------------------------------------------------------------------------
     # --------------------------------------------------------------------------
 
 
+def run_many(run_configs, client=None, max_workers=None):
+    """
+    Run several digitizations concurrently in one process.
+
+    The runs share one Gemini client and one upload cache, so a page used by
+    several runs (e.g. core and extended variables of the same document) is
+    uploaded once. The uploads are recorded in uploads_{timestamp}.jsonl in
+    the first run's results folder and deleted when all runs are done. With
+    the first run's api_key_pool, the runs share its keys instead (one upload
+    cache and uploads_{timestamp}_{key name}.jsonl per key).
+
+    Args:
+        run_configs (list): RunConfig of each run (each needs its own output
+            name or identifier).
+        client: Gemini API client (created from the API key if not given).
+        max_workers (int): Number of runs at a time (defaults to all of them).
+
+    Output:
+        Returns a dict of RunConfig.run_id -> digitized data (pd.DataFrame or None).
+    """
+    run_ids = [rc.run_id for rc in run_configs]
+    if len(set(run_ids)) != len(run_ids):
+        raise ValueError(
+            "Runs must have distinct output names or identifiers, got "
+            f"{run_ids}")
+
+    os.makedirs(run_configs[0].results_dir, exist_ok=True)
+    if run_configs[0].api_key_pool is not None:
+        shards = make_shards(run_configs[0], os.path.join(
+            run_configs[0].results_dir, f"uploads_{run_configs[0].identifier}"),
+            shared=True)
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers or len(run_configs)) as pool:
+                futures = {rc.run_id: pool.submit(main, rc, shards=shards)
+                           for rc in run_configs}
+                return {run_id: future.result()
+                        for run_id, future in futures.items()}
+        finally:
+            shards.close()
+
+    if client is None:
+        client = make_client()
+    uploads = make_upload_manager(
+        run_configs[0], client,
+        os.path.join(run_configs[0].results_dir,
+                     f"uploads_{run_configs[0].identifier}.jsonl"))
+    upload_cache = UploadCache(uploads)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers or len(run_configs)) as pool:
+            futures = {rc.run_id: pool.submit(main, rc, client, upload_cache)
+                       for rc in run_configs}
+            return {run_id: future.result() for run_id, future in futures.items()}
+    finally:
+        upload_cache.clear(client)
+        uploads.close()
+
+
 if __name__ == "__main__":
     main()
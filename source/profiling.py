@@ -0,0 +1,240 @@
+# ------------------------------------------------------------------------------
+# Load libraries ---------------------------------------------------------------
+# ------------------------------------------------------------------------------
+import os
+import csv
+import time
+import functools
+import threading
+import contextlib
+import contextvars
+import tracemalloc
+from collections import defaultdict
+
+# ------------------------------------------------------------------------------
+# -- Define functions ----------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Stage-level profiling: the pipeline wraps its named stages (PDF splitting,
+# rasterization, uploads, API requests, decoding, page_to_dataframe, CSV writes,
+# dedup, eval steps) in `with profiling.stage(name, page=N):`. Without a current
+# profiler (the default) this is a shared no-op context; with one (see
+# set_current), each stage records its wall time, the CPU time of its thread
+# and, with memory=True, the peak of memory allocated during the stage
+# (tracemalloc, which slows Python down noticeably).
+#
+# Stages nest: the stages entered while another is open are its children. At the
+# end of the run, the profiler writes
+#   - profile.folded: one line per stack of stages ("a;b;c <microseconds>", the
+#     wall time spent in c itself), for flamegraph.pl, speedscope or inferno;
+#   - profile_pages.csv: every stage call (stage, page, wall, CPU, peak);
+#   - profile_summary.csv: the per-stage summary table (also logged).
+# Pages are processed by several threads at once, so the times of a stage are
+# summed across threads, and memory peaks are approximate (tracemalloc's peak
+# is process-wide): profile with max_concurrency = 1 for exact peaks.
+
+# Profiler used by the pipeline functions (per thread/context, like run_log)
+_CURRENT = contextvars.ContextVar("stage_profiler", default=None)
+# Open stages of this thread/context: tuple of _Frame
+_STACK = contextvars.ContextVar("profile_stack", default=())
+_NO_STAGE = contextlib.nullcontext()
+
+
+class _Frame:
+    __slots__ = ("name", "page", "thread", "start", "cpu_start", "children",
+                 "memory_start", "memory_peak")
+
+    def __init__(self, name, page):
+        self.name = name
+        self.page = page
+        self.thread = threading.get_ident()
+        self.children = 0.0  # wall time of the child stages in this thread
+        self.memory_start = self.memory_peak = 0
+        self.start = time.perf_counter()
+        self.cpu_start = time.thread_time()
+
+
+def set_current(profiler):
+    """ Set the profiler used by the pipeline functions in this thread and the
+        threads it starts with its context (None to stop profiling).
+
+    Returns:
+        A token for reset_current.
+    """
+    return _CURRENT.set(profiler)
+
+
+def reset_current(token):
+    _CURRENT.reset(token)
+
+
+def current():
+    """ Profiler used by the pipeline functions (None if not profiling)."""
+    return _CURRENT.get()
+
+
+def stage(name, page=None):
+    """
+    Context manager timing a stage with the current profiler (a no-op if
+    there is none).
+
+    Args:
+        name (str): Name of the stage.
+        page (int): Page number (defaults to the enclosing stage's page).
+    """
+    profiler = _CURRENT.get()
+    if profiler is None:
+        return _NO_STAGE
+    return profiler.stage(name, page)
+
+
+def profiled(name):
+    """ Decorator timing each call of a function as the stage name."""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+# ------------------------------------------------------------------------------
+# -- Define classes ------------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+
+class StageProfiler:
+    """
+    Wall time, CPU time and memory peak of the pipeline's stages, per page.
+
+    Args:
+        memory (bool): If True, memory allocations are traced (tracemalloc is
+            started if it is not running, and stopped by close()).
+    """
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.records = []  # (stack, page, wall s, cpu s, peak bytes) per call
+        self.folded = defaultdict(float)  # stack -> seconds in its last stage
+        self._lock = threading.Lock()
+        self._started_tracemalloc = False
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+
+    @contextlib.contextmanager
+    def stage(self, name, page=None):
+        stack = _STACK.get()
+        if page is None and stack:
+            page = stack[-1].page
+        frame = _Frame(name, page)
+        if self.memory:
+            frame.memory_start = self._observe_memory(stack)
+        token = _STACK.set(stack + (frame,))
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - frame.start
+            cpu = time.thread_time() - frame.cpu_start
+            peak = 0
+            if self.memory:
+                self._observe_memory(stack + (frame,))
+                peak = max(0, frame.memory_peak - frame.memory_start)
+            _STACK.reset(token)
+            # a stage entered in a page thread is not part of the wall time
+            # of its parent in the thread that submitted the page
+            if stack and stack[-1].thread == frame.thread:
+                stack[-1].children += wall
+            path = ";".join(f.name for f in stack) + (";" if stack else "") + name
+            with self._lock:
+                self.records.append((path, page, wall, cpu, peak))
+                self.folded[path] += max(0.0, wall - frame.children)
+
+    def _observe_memory(self, frames):
+        """ Current traced memory; the peak since the last observation is
+            credited to the open frames."""
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        for frame in frames:
+            frame.memory_peak = max(frame.memory_peak, peak)
+        return current
+
+    def summary(self):
+        """
+        Per-stage summary, in stack order (each stage followed by its
+        children).
+
+        Returns:
+            list of dicts with the stage (its full stack), calls, pages, total
+            wall and CPU seconds, mean and 95th percentile wall milliseconds
+            and the largest memory peak in MB (None without memory).
+        """
+        stages = defaultdict(list)
+        with self._lock:
+            for path, page, wall, cpu, peak in self.records:
+                stages[path].append((page, wall, cpu, peak))
+        rows = []
+        for path, calls in stages.items():
+            walls = sorted(wall for _, wall, _, _ in calls)
+            rows.append({
+                "stage": path,
+                "calls": len(calls),
+                "pages": len({page for page, *_ in calls if page is not None}),
+                "wall_s": sum(walls),
+                "cpu_s": sum(cpu for _, _, cpu, _ in calls),
+                "mean_ms": 1000 * sum(walls) / len(walls),
+                "p95_ms": 1000 * walls[min(len(walls) - 1,
+                                           int(0.95 * len(walls)))],
+                "peak_mb": (max(peak for *_, peak in calls) / 2**20
+                            if self.memory else None),
+            })
+        return sorted(rows, key=lambda row: row["stage"].split(";"))
+
+    def summary_table(self):
+        """ The summary as a text table (child stages indented)."""
+        lines = [f"{'stage':<36} {'calls':>6} {'pages':>6} {'wall s':>9} "
+                 f"{'cpu s':>9} {'mean ms':>9} {'p95 ms':>9} {'peak MB':>8}"]
+        for row in self.summary():
+            *parents, name = row["stage"].split(";")
+            name = "  " * len(parents) + name
+            peak = "" if row["peak_mb"] is None else f"{row['peak_mb']:.1f}"
+            lines.append(
+                f"{name:<36} {row['calls']:>6} {row['pages']:>6} "
+                f"{row['wall_s']:>9.3f} {row['cpu_s']:>9.3f} "
+                f"{row['mean_ms']:>9.2f} {row['p95_ms']:>9.2f} {peak:>8}")
+        return "\n".join(lines)
+
+    def write(self, out_dir, prefix="profile"):
+        """
+        Write the folded stacks, the stage calls and the summary to out_dir.
+
+        Returns:
+            dict with the paths of the files written.
+        """
+        os.makedirs(out_dir, exist_ok=True)
+        paths = {kind: os.path.join(out_dir, f"{prefix}{suffix}")
+                 for kind, suffix in [("folded", ".folded"),
+                                      ("pages", "_pages.csv"),
+                                      ("summary", "_summary.csv")]}
+        with self._lock:
+            folded = dict(self.folded)
+            records = list(self.records)
+        with open(paths["folded"], "w", encoding="utf-8") as file:
+            for path, seconds in sorted(folded.items()):
+                file.write(f"{path} {round(seconds * 1e6)}\n")
+        with open(paths["pages"], "w", encoding="utf-8", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["stage", "page", "wall_s", "cpu_s", "peak_bytes"])
+            writer.writerows(records)
+        summary = self.summary()
+        with open(paths["summary"], "w", encoding="utf-8", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=list(summary[0]) if summary
+                                    else ["stage"])
+            writer.writeheader()
+            writer.writerows(summary)
+        return paths
+
+    def close(self):
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
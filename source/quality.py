@@ -0,0 +1,239 @@
+# ------------------------------------------------------------------------------
+# Load libraries ---------------------------------------------------------------
+# ------------------------------------------------------------------------------
+import random
+import threading
+import pandas as pd
+
+from align import align_entries, column_accuracy
+from dedup import dedup_entries
+from eval import (UNKNOWN_LENGTHS, eval_columns, load_true_data,
+                  prepare_pred_data)
+
+# ------------------------------------------------------------------------------
+# -- Define functions ----------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Quality-first scheduling: a run first processes its probe pages (the pages
+# with hand-coded ground truth, and a sample spread over the document) and
+# scores them as they finish, with the metrics of eval_performance (mean column
+# accuracy and total mileage error of the aligned entries, after merging the
+# entries extracted more than once, as in the final output).
+#
+# If the ground truth has a Page Number column, predicted entries are matched
+# to the ground truth of their printed page (Data Year, Page Number), so a
+# probe page counts even if it was not known to have ground truth. Otherwise
+# (as in the hand-coded files of outputs/), only the entries of the pages with
+# ground truth (true_pages, absolute page numbers) are scored, against the
+# ground truth of their Data Year, and the run is only judged once all of
+# these pages are done. Once enough hand-coded entries are covered, a run below
+# the thresholds fails the check: its other pages are not sent ("abort"), or
+# are processed one at a time ("deprioritize"), leaving the quota to the other
+# runs.
+
+# What a run that fails the quality check does with its other pages
+QUALITY_ACTIONS = ["abort", "deprioritize"]
+
+# Columns locating an entry's page, with and without printed page numbers
+PAGE_KEY_COLS = ["Data Year", "Page Number"]
+YEAR_KEY_COLS = ["Data Year"]
+
+
+def probe_pages(pages, true_pages=None, n_sample=10, seed=0):
+    """
+    Pages to process first: the pages with ground truth, then one page drawn
+    at random from each of n_sample equal slices of the document.
+
+    Args:
+        pages (list): Page numbers of the run, in document order.
+        true_pages (list): Pages with ground truth (absolute page numbers).
+        n_sample (int): Number of sampled pages.
+        seed (int): Random seed of the sample.
+
+    Returns:
+        list of page numbers (pages of the run, without repeats).
+    """
+    pages = list(pages)
+    in_run = set(pages)
+    probes = [N for N in dict.fromkeys(true_pages or []) if N in in_run]
+    rng = random.Random(seed)
+    n_sample = min(n_sample, len(pages))
+    for i in range(n_sample):
+        stratum = pages[i * len(pages) // n_sample:
+                        (i + 1) * len(pages) // n_sample]
+        N = rng.choice(stratum)
+        if N not in probes:
+            probes.append(N)
+    return probes
+
+
+def page_keys(df, cols=PAGE_KEY_COLS):
+    """ Values of cols (by default Data Year, Page Number) of each row, as
+        tuples of floats (NaN if missing)."""
+    return list(zip(*[pd.to_numeric(df[col], errors="coerce") for col in cols]))
+
+
+def total_mileage(df):
+    """ Miles of the entries with a known length."""
+    length = pd.to_numeric(df["Pipeline Length"], errors="coerce")
+    return float(length[~length.isin(UNKNOWN_LENGTHS)].sum())
+
+
+# ------------------------------------------------------------------------------
+# -- Define classes ------------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+
+class QualityGate:
+    """
+    Incremental evaluation of a run's probe pages, and the run's verdict.
+
+    Args:
+        true_data (pd.DataFrame): Hand-coded ground truth (see
+            eval.load_true_data).
+        min_accuracy (float): Lowest mean column accuracy of a good run.
+        max_mi_pct_err (float): Highest total mileage error of a good run
+            (None to only check the accuracy).
+        min_entries (int): Hand-coded entries covered before deciding.
+        action (str): "abort" or "deprioritize" (see QUALITY_ACTIONS).
+        true_pages (list): Pages with ground truth (absolute page numbers),
+            processed first; required if true_data has no Page Number.
+        n_sample (int): Pages sampled across the document, processed next.
+        seed (int): Random seed of the sample.
+
+    Raises:
+        ValueError: If true_data has no Data Year, or neither a Page Number
+            column nor true_pages.
+    """
+
+    def __init__(self, true_data, min_accuracy=0.6, max_mi_pct_err=0.5,
+                 min_entries=30, action="abort", true_pages=None, n_sample=10,
+                 seed=0):
+        if action not in QUALITY_ACTIONS:
+            raise ValueError(f"Quality action must be one of {QUALITY_ACTIONS}")
+        if "Data Year" not in true_data.columns:
+            raise ValueError("The ground truth of the quality check has no "
+                             "Data Year column.")
+        self.by_page = "Page Number" in true_data.columns
+        if not self.by_page and not true_pages:
+            raise ValueError(
+                "The ground truth of the quality check has no Page Number "
+                "column: set quality_pages (--quality-pages) to the absolute "
+                "pages it covers.")
+        self.true_data = true_data
+        self.min_accuracy = min_accuracy
+        self.max_mi_pct_err = max_mi_pct_err
+        self.min_entries = min_entries
+        self.action = action
+        self.true_pages = true_pages
+        self.n_sample = n_sample
+        self.seed = seed
+        self.columns = eval_columns(true_data)
+        self.key_cols = PAGE_KEY_COLS if self.by_page else YEAR_KEY_COLS
+        self._true_keys = pd.Series(page_keys(true_data, self.key_cols),
+                                    index=true_data.index, dtype=object)
+        self._known_keys = set(self._true_keys)
+        # without page numbers, pages with ground truth not scored yet
+        self._pending = set() if self.by_page else set(true_pages)
+        self._pred = []  # predicted entries of the scored pages
+        self._lock = threading.Lock()  # pages may be scored by several threads
+        self.pages = 0  # probe pages scored
+        self.metrics = {}
+        self.verdict = None  # "pass" or "fail" once decided
+
+    @classmethod
+    def from_run_config(cls, rc):
+        """ QualityGate of a run (None if rc.quality_true_path is not set)."""
+        if not rc.quality_true_path:
+            return None
+        return cls(load_true_data(rc.quality_true_path),
+                   min_accuracy=rc.quality_min_accuracy,
+                   max_mi_pct_err=rc.quality_max_mi_pct_err,
+                   min_entries=rc.quality_min_entries,
+                   action=rc.quality_action, true_pages=rc.quality_pages,
+                   n_sample=rc.quality_sample)
+
+    def probe_pages(self, pages):
+        """ Probe pages of a run (see probe_pages); without page numbers, the
+            run is judged once its pages with ground truth are scored."""
+        pages = list(pages)
+        if not self.by_page:
+            self._pending = set(self.true_pages) & set(pages)
+        return probe_pages(pages, self.true_pages, self.n_sample, self.seed)
+
+    @property
+    def failed(self):
+        return self.verdict == "fail"
+
+    def add_page(self, df, page=None):
+        """
+        Score a finished probe page with the pages scored so far.
+
+        Args:
+            df (pd.DataFrame): Data of the page (None if none was found).
+            page (int): Absolute page number (needed without page numbers in
+                the ground truth).
+
+        Returns:
+            The verdict: None while fewer than min_entries hand-coded entries
+            are covered (or, without page numbers, while pages with ground
+            truth are left), then "pass" or "fail" (a failed run stays failed).
+        """
+        with self._lock:
+            self.pages += 1
+            if not self.by_page:
+                if page not in self.true_pages:
+                    return self.verdict
+                self._pending.discard(page)
+            if df is not None and not df.empty:
+                pred = df.loc[[key in self._known_keys
+                               for key in page_keys(df, self.key_cols)]]
+                if not pred.empty:
+                    self._pred.append(pred)
+            if self._pred:
+                self._evaluate()
+            return self.verdict
+
+    def _evaluate(self):
+        pred = prepare_pred_data(dedup_entries(pd.concat(self._pred,
+                                                         ignore_index=True)))
+        true = self.true_data.loc[self._true_keys.isin(
+            set(page_keys(pred, self.key_cols)))]
+        alignment = align_entries(pred, true)
+        accuracy = [a for a in column_accuracy(
+            alignment, [col for col in self.columns if col in pred.columns],
+            n_true=len(true)).values() if a is not None]
+        true_mi = total_mileage(true)
+        self.metrics = {
+            "true_entries": len(true),
+            "matched": len(alignment["matched"]),
+            "missed": len(alignment["missed"]),
+            "hallucinated": len(alignment["hallucinated"]),
+            "accuracy_mean": sum(accuracy) / len(accuracy) if accuracy else None,
+            "mi_pct_err": (abs(total_mileage(pred) - true_mi) / true_mi
+                           if true_mi > 0 else None),
+        }
+        if self.failed or len(true) < self.min_entries or self._pending:
+            return
+        failed = (self.metrics["accuracy_mean"] is not None and
+                  self.metrics["accuracy_mean"] < self.min_accuracy) or (
+            self.max_mi_pct_err is not None and
+            self.metrics["mi_pct_err"] is not None and
+            self.metrics["mi_pct_err"] > self.max_mi_pct_err)
+        self.verdict = "fail" if failed else "pass"
+
+    def summary(self):
+        """ One line with the metrics so far, for the log."""
+        if not self.metrics:
+            return f"{self.pages} probe pages, no hand-coded entries covered yet"
+        m = self.metrics
+        accuracy = ("n/a" if m["accuracy_mean"] is None
+                    else f"{m['accuracy_mean']:.2f}")
+        mi_err = "n/a" if m["mi_pct_err"] is None else f"{m['mi_pct_err']:.1%}"
+        return (f"{self.pages} probe pages, {m['true_entries']} hand-coded "
+                f"entries: accuracy {accuracy}, mileage error {mi_err} "
+                f"(verdict: {self.verdict or 'undecided'})")
+
+    def report(self):
+        """ Verdict and metrics, for run_info.json."""
+        return {"verdict": self.verdict, "action": self.action,
+                "probe_pages": self.pages, **self.metrics}
@@ -0,0 +1,372 @@
+# ------------------------------------------------------------------------------
+# Load libraries ---------------------------------------------------------------
+# ------------------------------------------------------------------------------
+import os
+import glob
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+import pandas as pd
+
+from PagesLib import Page
+
+# ------------------------------------------------------------------------------
+# -- Define functions ----------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Results store: one SQLite database (results.sqlite in the output folder) with
+# every run's metadata, the status and raw response of each page and the
+# digitized entries, instead of one pg{N}.csv per page in each run folder.
+#
+#   runs       one row per run: model, prompt name and hash, page schema,
+#              parameters, status and run_info (tokens, time, ...)
+#   pages      one row per page of a run: status ("ok", "no_data", "blank",
+#              "duplicate", or "skipped" for the pages not digitized after
+#              the quality gate aborted the run), number of entries, page
+#              it duplicates
+#   responses  raw response text of each page sent to the API
+#   entries    one row per entry of a page, one column per output field of
+#              the page schemas (named after the field, see ENTRY_COLUMNS)
+#
+# The views run_entries (entries with their run's metadata) and run_summary
+# (pages and entries per status and run) are for ad hoc queries. Entries are
+# indexed by run and page, by year and fuel and by company, so e.g. the
+# natural gas entries of 1947 in the last five runs are one indexed query:
+#     query_entries(db_path, year=1947, fuel="NATURAL GAS", last_runs=5)
+
+# Entry columns: field name -> (output column name, SQL type), for the fields
+# of all the page schemas (in the order of their first appearance)
+ENTRY_COLUMNS = {}
+BOOL_FIELDS = []  # stored as 0/1
+for _schema in Page.PAGE_FIELDS:
+    _entry_fields = Page.entry_model(_schema).model_fields
+    for _column, _field, _is_page_field in Page.page_columns(_schema):
+        if _field in ENTRY_COLUMNS:
+            continue
+        _annotation = (Page.Page.model_fields if _is_page_field
+                       else _entry_fields)[_field].annotation
+        ENTRY_COLUMNS[_field] = (_column, {int: "INTEGER", bool: "INTEGER",
+                                           float: "REAL"}.get(_annotation, "TEXT"))
+        if _annotation is bool:
+            BOOL_FIELDS.append(_field)
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    started_at REAL,
+    finished_at REAL,
+    status TEXT,
+    model_id TEXT,
+    prompt TEXT,
+    prompt_hash TEXT,
+    page_schema TEXT,
+    input_file TEXT,
+    output_file TEXT,
+    parameters TEXT,
+    run_info TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_started ON runs (started_at);
+CREATE TABLE IF NOT EXISTS pages (
+    run_id TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    n_entries INTEGER,
+    duplicate_of INTEGER,
+    written_at REAL,
+    PRIMARY KEY (run_id, page)
+);
+CREATE TABLE IF NOT EXISTS responses (
+    run_id TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    response TEXT,
+    PRIMARY KEY (run_id, page)
+);
+CREATE TABLE IF NOT EXISTS entries (
+    run_id TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    entry INTEGER NOT NULL,
+    model_id TEXT,
+    shard TEXT,
+    {", ".join(f"{field} {sql_type}" for field, (_, sql_type) in ENTRY_COLUMNS.items())}
+);
+CREATE INDEX IF NOT EXISTS entries_run_page ON entries (run_id, page);
+CREATE INDEX IF NOT EXISTS entries_year ON entries (yr, fuel_corrected);
+CREATE INDEX IF NOT EXISTS entries_company ON entries (company COLLATE NOCASE, yr);
+CREATE VIEW IF NOT EXISTS run_entries AS
+    SELECT entries.*, runs.started_at, runs.prompt, runs.prompt_hash,
+           runs.page_schema
+    FROM entries JOIN runs USING (run_id);
+CREATE VIEW IF NOT EXISTS run_summary AS
+    SELECT runs.run_id, runs.started_at, runs.status AS run_status,
+           runs.model_id, runs.prompt, pages.status, COUNT(pages.page) AS n_pages,
+           SUM(pages.n_entries) AS n_entries
+    FROM runs LEFT JOIN pages USING (run_id)
+    GROUP BY runs.run_id, pages.status;
+"""
+
+
+def connect(db_path):
+    """ Connection to the results database (created if needed). WAL mode lets
+        several runs write to it while it is being read."""
+    if os.path.dirname(db_path):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    connection = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.executescript(SCHEMA)
+    # (databases from before API key pools have no shard column)
+    columns = [row[1] for row in connection.execute("PRAGMA table_info(entries)")]
+    if "shard" not in columns:
+        connection.execute("ALTER TABLE entries ADD COLUMN shard TEXT")
+    return connection
+
+
+def _sql_values(col, sql_type=None):
+    """ Column as Python values, with None for missing values (and, in text
+        columns, "TRUE"/"FALSE" for booleans, as read_csv parses them)."""
+    values = col.astype(object).where(col.notna(), None)
+    if sql_type == "TEXT" and col.dtype == bool:
+        values = values.map({True: "TRUE", False: "FALSE"})
+    return values
+
+
+def entries_to_dataframe(rows, columns):
+    """ DataFrame of entries rows, with the output columns (named as by
+        page_to_dataframe, then model_id, absolute_page_n and shard): the
+        fields of the smallest page schema that has all the fields found, in
+        its order (entries of several schemas get all the fields found). """
+    df = pd.DataFrame.from_records(rows, columns=columns)
+    for field in BOOL_FIELDS:
+        df[field] = df[field].map({1: True, 0: False})
+    found = {field for field in ENTRY_COLUMNS if df[field].notna().any()}
+    fields = min((fields for fields in Page.PAGE_FIELDS.values()
+                  if found <= set(fields)), key=len, default=None)
+    if fields is None:
+        fields = [field for field in ENTRY_COLUMNS if field in found]
+    extra = [c for c in df.columns if c not in ENTRY_COLUMNS and
+             c not in ("page", "entry", "model_id", "shard")]
+    # (the shard column only for runs with several API keys)
+    shard = ["shard"] if df["shard"].notna().any() else []
+    df = df[extra + fields + ["model_id", "page"] + shard]
+    return df.rename(columns={"page": "absolute_page_n",
+                              **{field: ENTRY_COLUMNS[field][0]
+                                 for field in fields}})
+
+
+def query_entries(db_path, year=None, fuel=None, company=None, run_ids=None,
+                  last_runs=None, where=None, params=(), with_runs=False):
+    """
+    Entries of the results database, as a DataFrame with the output columns.
+
+    Args:
+        db_path (str): results database
+        year (int): only entries of this data year
+        fuel (str): only entries of this inferred fuel type (e.g. "NATURAL GAS")
+        company (str): only entries of this company (ignoring case)
+        run_ids (list): only entries of these runs
+        last_runs (int): only entries of the last runs started
+        where (str): additional SQL condition on the run_entries view
+        params (tuple): parameters of where
+        with_runs (bool): if True, the columns start with the run id and
+            metadata (started_at, prompt, prompt_hash, page_schema)
+
+    Returns:
+        pd.DataFrame, in order of run, page and entry.
+    """
+    conditions, values = [], []
+    if year is not None:
+        conditions.append("yr = ?")
+        values.append(year)
+    if fuel is not None:
+        conditions.append("fuel_corrected = ?")
+        values.append(fuel)
+    if company is not None:
+        conditions.append("company = ? COLLATE NOCASE")
+        values.append(company)
+    if run_ids is not None:
+        conditions.append(f"run_id IN ({', '.join('?' * len(run_ids))})")
+        values.extend(run_ids)
+    if last_runs is not None:
+        conditions.append("run_id IN (SELECT run_id FROM runs "
+                          "ORDER BY started_at DESC LIMIT ?)")
+        values.append(last_runs)
+    if where:
+        conditions.append(f"({where})")
+        values.extend(params)
+    table = "run_entries" if with_runs or where else "entries"
+    sql = (f"SELECT * FROM {table}"
+           + (" WHERE " + " AND ".join(conditions) if conditions else "")
+           + " ORDER BY run_id, page, entry")
+    connection = connect(db_path)
+    try:
+        cursor = connection.execute(sql, values)
+        columns = [d[0] for d in cursor.description]
+        df = entries_to_dataframe(cursor.fetchall(), columns)
+    finally:
+        connection.close()
+    if not with_runs:
+        df = df.drop(columns=["run_id", "started_at", "prompt", "prompt_hash",
+                              "page_schema"], errors="ignore")
+    return df
+
+
+def export_dataframe(df, out_path):
+    """ Save a DataFrame as .csv, .xlsx or .parquet (from the extension). """
+    extension = os.path.splitext(out_path)[1].lower()
+    if extension == ".csv":
+        df.to_csv(out_path, index=False)
+    elif extension == ".xlsx":
+        df.to_excel(out_path, index=False)
+    elif extension == ".parquet":
+        df.to_parquet(out_path, index=False)
+    else:
+        raise ValueError(f"Cannot export to {out_path}: use .csv, .xlsx or .parquet")
+
+
+def import_run_folder(db_path, folder):
+    """
+    Add a run folder of pg{N}.csv files (from before the results store) to
+    the results database, with its run_info.json if there is one.
+
+    Args:
+        db_path (str): results database
+        folder (str): intermediate folder of the run (named after its run id)
+
+    Returns:
+        Number of entries imported (int).
+    """
+    run_id = os.path.basename(os.path.normpath(folder))
+    info_path = os.path.join(folder, "run_info.json")
+    run_info = {}
+    if os.path.exists(info_path):
+        with open(info_path, encoding="utf-8") as file:
+            run_info = json.load(file)
+    store = ResultsStore(db_path, run_id)
+    try:
+        store.start_run(model_id=run_info.get("model_id"),
+                        prompt=run_info.get("prompt"),
+                        page_schema=run_info.get("page_schema"),
+                        started_at=os.path.getmtime(folder))
+        n_entries = 0
+        pages = {}
+        for path in glob.glob(os.path.join(folder, "pg*.csv")):
+            page = os.path.basename(path)[2:-len(".csv")]
+            if page.isdigit():
+                pages[int(page)] = path
+        for page in sorted(pages):
+            df = pd.read_csv(pages[page])
+            store.write_page(page, df)
+            n_entries += len(df)
+        store.finish_run(run_info, status="imported")
+    finally:
+        store.close()
+    return n_entries
+
+
+# ------------------------------------------------------------------------------
+# -- Define classes ------------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+
+class ResultsStore:
+    """
+    Writer of one run's results to the results database.
+
+    Parameters:
+        db_path (str): results database (created if needed)
+        run_id (str): id of the run (RunConfig.run_id)
+    """
+
+    def __init__(self, db_path, run_id):
+        self.db_path = db_path
+        self.run_id = run_id
+        self._connection = connect(db_path)
+        self._lock = threading.Lock()
+
+    def start_run(self, model_id=None, prompt=None, prompt_text=None,
+                  page_schema=None, input_file=None, output_file=None,
+                  parameters=None, started_at=None):
+        """ Record the run's metadata (status "running"); a rerun with the
+            same run id replaces the earlier one's results. """
+        prompt_hash = (hashlib.sha256(prompt_text.encode("utf-8")).hexdigest()[:12]
+                       if prompt_text is not None else None)
+        with self._lock, self._connection:
+            for table in ("entries", "pages", "responses", "runs"):
+                self._connection.execute(
+                    f"DELETE FROM {table} WHERE run_id = ?", (self.run_id,))
+            self._connection.execute(
+                "INSERT INTO runs (run_id, started_at, status, model_id, prompt,"
+                " prompt_hash, page_schema, input_file, output_file, parameters)"
+                " VALUES (?, ?, 'running', ?, ?, ?, ?, ?, ?, ?)",
+                (self.run_id, started_at or time.time(), model_id, prompt,
+                 prompt_hash, page_schema, input_file, output_file,
+                 json.dumps(parameters, default=str) if parameters else None))
+
+    def write_page(self, page, df=None, status="ok", response=None,
+                   duplicate_of=None):
+        """
+        Record a page of the run (replacing an earlier write of it).
+
+        Parameters:
+            page (int): absolute page number
+            df (pd.DataFrame): data of the page (page_to_dataframe output,
+                with model_id), or None if the page has no entries
+            status (str): "ok", "no_data", "blank", "duplicate" or "skipped"
+                (aborted by the quality gate)
+            response (str): raw response text
+            duplicate_of (int): page whose data a duplicate page reuses
+        """
+        rows = []
+        if df is not None and len(df):
+            by_column = {column: field
+                         for field, (column, _) in ENTRY_COLUMNS.items()}
+            fields = [by_column[c] for c in df.columns if c in by_column]
+            values = [_sql_values(df[c], ENTRY_COLUMNS[by_column[c]][1])
+                      for c in df.columns if c in by_column]
+            sources = [_sql_values(df[c]) if c in df.columns else [None] * len(df)
+                       for c in ("model_id", "shard")]
+            rows = [(self.run_id, page, i, model_id, shard, *entry)
+                    for i, (model_id, shard, *entry)
+                    in enumerate(zip(*sources, *values))]
+        with self._lock, self._connection:
+            self._connection.execute(
+                "DELETE FROM entries WHERE run_id = ? AND page = ?",
+                (self.run_id, page))
+            if rows:
+                self._connection.executemany(
+                    f"INSERT INTO entries (run_id, page, entry, model_id, shard, "
+                    f"{', '.join(fields)}) VALUES "
+                    f"({', '.join('?' * (5 + len(fields)))})", rows)
+            self._connection.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?)",
+                (self.run_id, page, status, len(rows), duplicate_of, time.time()))
+            if response is not None:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?)",
+                    (self.run_id, page, response))
+
+    def page_data(self, page):
+        """ Data of a page of the run as written (None if it has no entries). """
+        with self._lock:
+            cursor = self._connection.execute(
+                "SELECT * FROM entries WHERE run_id = ? AND page = ? "
+                "ORDER BY entry", (self.run_id, page))
+            rows = cursor.fetchall()
+        if not rows:
+            return None
+        df = entries_to_dataframe(rows, [d[0] for d in cursor.description])
+        return df.drop(columns=["run_id"])
+
+    def finish_run(self, run_info=None, status="done"):
+        """ Record the end of the run, with its run_info. """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE runs SET finished_at = ?, status = ?, "
+                "run_info = COALESCE(?, run_info) WHERE run_id = ?",
+                (time.time(), status,
+                 json.dumps(run_info, default=str) if run_info else None,
+                 self.run_id))
+
+    def close(self):
+        self._connection.close()
@@ -0,0 +1,207 @@
+import os
+import dataclasses
+from dataclasses import dataclass, field
+from datetime import datetime
+
+import run_log
+
+# ------------------------------------------------------------------------------
+# -- Define classes ------------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+
+def _timestamp():
+    return datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
+
+
+@dataclass(frozen=True)
+class RunConfig:
+    """
+    Immutable parameters of one digitization run.
+
+    config.py builds the default run from its module parameters
+    (config.get_run_config(**changes)); other runs can be created directly, with
+    RunConfig.for_pipelines, or with replace(), and passed to main.main,
+    main.run_many and eval.eval_performance.
+
+    Attributes:
+        input_file_path (str): Path to the pdf to digitize.
+        page_schema (type): Page schema (a PagesLib.Page model).
+        prompt_text_path (str): Path to the prompt text file.
+        gemini_model_id (str): Gemini model ID.
+        output_file_base_name (str): Base name of the output files (no extension);
+            defaults to the input file name.
+        output_dir (str): Folder for results, logs and evaluations.
+        page_window (int): Number of pages fed into Gemini when digitizing a page.
+        page_placement (str): Placement of the target page within the window.
+        upload_pages_once (bool): With page_window > 1, upload each page once.
+        all_pages (bool): If True, digitize all pages of the document.
+        start_page (int): First page to digitize (if not all_pages).
+        n_pages (int): Number of pages to digitize (if not all_pages).
+        png (bool): Upload pages as .png instead of .pdf.
+        prescan (bool): Skip blank pages and reuse duplicate pages' results.
+        hedge_requests (bool): Resend requests slower than hedge_percentile of
+            the model's latency (see PagesLib/hedging.py).
+        hedge_percentile (float): Latency percentile (0-100) after which to hedge.
+        hedge_max_fraction (float): Maximum fraction of requests hedged.
+        stream_responses (bool): Stream responses and parse entries as they
+            arrive (see PagesLib/streaming.py).
+        max_concurrency (int): Maximum pages processed at the same time (the
+            requests in flight adapt to 503/429 errors, see
+            PagesLib/concurrency.py).
+        low_memory (bool): Write each page's data as soon as it is done
+            instead of keeping the whole document in memory.
+        merge_duplicate_entries (bool): Merge entries extracted more than once
+            in the final output (see dedup.py).
+        compact_schema (bool): Responses use short keys and codes (see
+            PagesLib/compact.py).
+        fast_decode (bool): Decode responses straight to columns (see
+            PagesLib/decode.py).
+        store_results (bool): Write the run's results to the results database
+            (results_db) instead of pg{N}.csv files (see results_db.py).
+        api_key_pool (str): File of API keys to spread the pages across
+            (see PagesLib/shards.py); None for the single key.
+        quality_true_path (str): Ground truth to score the probe pages
+            against before the other pages (see quality.py); None to
+            process the pages in order.
+        quality_pages (list): Absolute pages with ground truth (probed first).
+        quality_sample (int): Pages sampled across the document to probe.
+        quality_min_accuracy (float): Lowest mean column accuracy of a good run.
+        quality_max_mi_pct_err (float): Highest total mileage error of a good run.
+        quality_min_entries (int): Hand-coded entries covered before deciding.
+        quality_action (str): "abort" or "deprioritize" a run that fails.
+        profile_stages (bool): Time the stages of the run (see profiling.py).
+        profile_memory (bool): Also measure the memory peak of each stage.
+        upload_quota_gb (float): File API storage quota of the project; uploads
+            wait for space near it (see PagesLib/uploads.py).
+        orphan_upload_hours (float): Age after which uploads left by other
+            runs are deleted by cli.py clean-uploads.
+        log_level (str): Minimum level written to the log file.
+        console_level (str): Minimum level printed to the console.
+        identifier (str): Suffix of the run's output files (defaults to a timestamp).
+    """
+    input_file_path: str
+    page_schema: type
+    prompt_text_path: str
+    gemini_model_id: str = "gemini-3.0-pro-preview"
+    output_file_base_name: str = None
+    output_dir: str = "outputs"
+    page_window: int = 1
+    page_placement: str = "top"
+    upload_pages_once: bool = True
+    all_pages: bool = True
+    start_page: int = 1
+    n_pages: int = 1
+    png: bool = False
+    prescan: bool = False
+    hedge_requests: bool = False
+    hedge_percentile: float = 95
+    hedge_max_fraction: float = 0.1
+    stream_responses: bool = False
+    max_concurrency: int = 8
+    low_memory: bool = False
+    merge_duplicate_entries: bool = True
+    compact_schema: bool = False
+    fast_decode: bool = True
+    store_results: bool = True
+    api_key_pool: str = None
+    quality_true_path: str = None
+    quality_pages: list = None
+    quality_sample: int = 10
+    quality_min_accuracy: float = 0.6
+    quality_max_mi_pct_err: float = 0.5
+    quality_min_entries: int = 30
+    quality_action: str = "abort"
+    profile_stages: bool = False
+    profile_memory: bool = False
+    upload_quota_gb: float = 20
+    orphan_upload_hours: float = 6
+    log_level: str = "DEBUG"
+    console_level: str = "INFO"
+    identifier: str = field(default_factory=_timestamp)
+
+    def __post_init__(self):
+        if self.output_file_base_name is None:
+            object.__setattr__(self, "output_file_base_name", os.path.splitext(
+                os.path.basename(self.input_file_path))[0])
+        if self.page_window > 1 and self.png and not self.upload_pages_once:
+            raise ValueError(
+                f"Page window is {self.page_window} but .png files must be a single page!"
+            )
+
+    @classmethod
+    def for_pipelines(cls, input_file_path, gov=False, extended_variables=True,
+                      prompt_dir="source/prompts", **kwargs):
+        """ RunConfig for a pipeline directory, with the page schema, prompt
+            and output name chosen as in config.py."""
+        from PagesLib.Page import (PagePrivateCore, PageGovCore,
+                                   PagePrivateExtended, PageGovExtended)
+        if extended_variables:
+            page_schema = PageGovExtended if gov else PagePrivateExtended
+        else:
+            page_schema = PageGovCore if gov else PagePrivateCore
+        prompt_text_name = f"pipeline_{'extended' if extended_variables else 'core'}_prompt_{'gov' if gov else 'priv'}.txt"
+        kwargs.setdefault("output_file_base_name", os.path.splitext(
+            os.path.basename(input_file_path))[0] + (
+                "_extended_vars" if extended_variables else "_core_vars"))
+        return cls(input_file_path=input_file_path, page_schema=page_schema,
+                   prompt_text_path=os.path.join(prompt_dir, prompt_text_name),
+                   **kwargs)
+
+    def replace(self, **changes):
+        """ Copy of this config with some parameters changed."""
+        return dataclasses.replace(self, **changes)
+
+    # Derived paths ------------------------------------------------------------
+
+    @property
+    def run_id(self):
+        return self.output_file_base_name + "_" + self.identifier
+
+    @property
+    def prompt_text_name(self):
+        return os.path.basename(self.prompt_text_path)
+
+    @property
+    def results_dir(self):
+        return os.path.join(self.output_dir, "gemini_output")
+
+    @property
+    def log_dir(self):
+        return os.path.join(self.output_dir, "logs")
+
+    @property
+    def eval_log_dir(self):
+        return os.path.join(self.output_dir, "performance_evals")
+
+    @property
+    def results_db(self):
+        return os.path.join(self.output_dir, "results.sqlite")
+
+    @property
+    def output_file_name(self):
+        return self.run_id + ".csv"
+
+    @property
+    def intermediate_dir(self):
+        return os.path.join(self.results_dir, self.run_id)
+
+    # Logging ------------------------------------------------------------------
+
+    def get_logger(self, log_dir=None):
+        """ Run-scoped logger writing log_{run_id}.jsonl to log_dir (defaults
+            to the log folder)."""
+        return run_log.get_logger(log_dir or self.log_dir, self.run_id,
+                                  level=self.log_level,
+                                  console_level=self.console_level)
+
+    def write_log(self, message, log_dir=None):
+        self.get_logger(log_dir).info(message, stage="log", console=False)
+
+    def log_config(self, log_dir=None):
+        run_log.log_run_config(self.get_logger(log_dir), self.prompt_text_path,
+                               start_page=self.start_page,
+                               end_page=self.start_page + self.n_pages - 1,
+                               page_window=self.page_window,
+                               gemini_model=self.gemini_model_id,
+                               output_file_base_name=self.output_file_base_name)
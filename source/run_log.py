@@ -0,0 +1,247 @@
+# ------------------------------------------------------------------------------
+# Load libraries ---------------------------------------------------------------
+# ------------------------------------------------------------------------------
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import hashlib
+import threading
+import contextvars
+from datetime import datetime
+
+# ------------------------------------------------------------------------------
+# -- Define functions ----------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+
+# Loggers by (log_dir, run_id), and the logger used by the pipeline functions:
+# set per thread/context (so concurrent runs log separately), with a process
+# default for threads that have not set one
+_LOGGERS = {}
+_LOGGERS_LOCK = threading.Lock()
+_CURRENT = contextvars.ContextVar("run_logger", default=None)
+_DEFAULT = None
+
+
+class RunLogger:
+    """
+    Run-scoped structured event logger.
+
+    Events are put on a queue and written by a background thread as JSON lines
+    (with run id, level, stage and page fields) to log_{run_id}.jsonl in
+    log_dir, so logging never waits on disk I/O. The console shows events at or
+    above console_level and a one-line progress view.
+
+    Args:
+        log_dir (str): Folder for the events file (None for console only).
+        run_id (str): Identifier of the run, added to every event.
+        level (str): Minimum level written to the events file.
+        console_level (str): Minimum level printed to the console.
+        flush_interval (float): Seconds between flushes of the events file.
+    """
+
+    def __init__(self, log_dir, run_id, level="DEBUG", console_level="INFO",
+                 flush_interval=1.0):
+        self.log_dir = log_dir
+        self.run_id = run_id
+        self.level = LEVELS[level]
+        self.console_level = LEVELS[console_level]
+        self.flush_interval = flush_interval
+        self.path = (os.path.join(log_dir, f"log_{run_id}.jsonl")
+                     if log_dir else None)
+        self._queue = queue.SimpleQueue()
+        self._progress_shown = False
+        self._closed = False
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def log(self, message, level="INFO", stage=None, page=None, console=True,
+            **fields):
+        """ Queue an event (never blocks on I/O). If console is False, the
+            event is only written to the events file."""
+        if self._closed:
+            return
+        levelno = LEVELS[level]
+        if levelno < self.level and (not console or levelno < self.console_level):
+            return
+        self._queue.put({
+            "_console": console,
+            "time": time.time(),
+            "run_id": self.run_id,
+            "level": level,
+            "stage": stage,
+            "page": page,
+            "message": str(message),
+            **fields,
+        })
+
+    def debug(self, message, **kwargs):
+        self.log(message, "DEBUG", **kwargs)
+
+    def info(self, message, **kwargs):
+        self.log(message, "INFO", **kwargs)
+
+    def warning(self, message, **kwargs):
+        self.log(message, "WARNING", **kwargs)
+
+    def error(self, message, **kwargs):
+        self.log(message, "ERROR", **kwargs)
+
+    def progress(self, done, total, stage="pages"):
+        """ Update the console progress line (not written to the events file)."""
+        if not self._closed:
+            self._queue.put({"progress": (done, total, stage)})
+
+    def flush(self):
+        """ Wait until all queued events are written (returns at once if the
+            logger is closed, as close writes them)."""
+        if self._closed:
+            return
+        done = threading.Event()
+        self._queue.put({"flush": done})
+        # (the writer thread may stop before the flush if closed meanwhile)
+        while not done.wait(self.flush_interval):
+            if not self._thread.is_alive():
+                return
+
+    def close(self):
+        """ Write the remaining events and stop the writer thread."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    # --------------------------------------------------------------------------
+
+    def _console(self, event):
+        if self._progress_shown:
+            sys.stdout.write("\n")
+            self._progress_shown = False
+        timestamp = datetime.fromtimestamp(event["time"]).strftime("%H:%M:%S")
+        where = " ".join(
+            filter(None, [event["stage"],
+                          f"p{event['page']}" if event["page"] is not None else None]))
+        prefix = f"[{timestamp}]" + (f" {event['level']}" if event["level"] != "INFO" else "")
+        sys.stdout.write(f"{prefix} {where + ': ' if where else ''}{event['message']}\n")
+
+    def _write_loop(self):
+        file = None
+        if self.path:
+            os.makedirs(self.log_dir, exist_ok=True)
+            file = open(self.path, "a", encoding="utf-8")
+        running = True
+        while running:
+            try:
+                items = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                items = []
+            # drain everything queued so far and write it in one batch
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines = []
+            flushed = []
+            for item in items:
+                if item is None:
+                    running = False
+                elif "flush" in item:
+                    flushed.append(item["flush"])
+                elif "progress" in item:
+                    done, total, stage = item["progress"]
+                    sys.stdout.write(f"\r  {stage}: {done}/{total}")
+                    self._progress_shown = True
+                else:
+                    console = item.pop("_console")
+                    levelno = LEVELS[item["level"]]
+                    if levelno >= self.level:
+                        lines.append(json.dumps(item, default=str))
+                    if console and levelno >= self.console_level:
+                        self._console(item)
+            if file and lines:
+                file.write("\n".join(lines) + "\n")
+            if file:
+                file.flush()
+            sys.stdout.flush()
+            for done in flushed:
+                done.set()
+
+        if self._progress_shown:
+            sys.stdout.write("\n")
+        if file:
+            file.close()
+
+
+def get_logger(log_dir, run_id, **kwargs):
+    """ Get the logger for (log_dir, run_id), creating it if needed."""
+    key = (log_dir, run_id)
+    with _LOGGERS_LOCK:
+        if key not in _LOGGERS or _LOGGERS[key]._closed:
+            _LOGGERS[key] = RunLogger(log_dir, run_id, **kwargs)
+        return _LOGGERS[key]
+
+
+def set_current(logger):
+    """ Set the logger used by the pipeline functions in this thread (see
+        current); it is also the default of threads that have not set one.
+
+    Returns:
+        A token for reset_current.
+    """
+    global _DEFAULT
+    _DEFAULT = logger
+    return _CURRENT.set(logger)
+
+
+def reset_current(token):
+    _CURRENT.reset(token)
+
+
+def current():
+    """ Logger used by the pipeline functions; console only if none was set
+        (or if it was closed)."""
+    global _DEFAULT
+    logger = _CURRENT.get()
+    if logger is not None and not logger._closed:
+        return logger
+    if _DEFAULT is None or _DEFAULT._closed:
+        _DEFAULT = RunLogger(None, "console")
+    return _DEFAULT
+
+
+def log_run_config(logger, prompt_text_path, **params):
+    """
+    Log the run parameters, and save the prompt text once per distinct prompt.
+
+    The prompt is saved as prompts/{name}_{hash}.txt in the logger's folder
+    (if not already there) and the event records its hash.
+
+    Args:
+        logger (RunLogger): Logger of the run.
+        prompt_text_path (str): Path to the prompt text file.
+        **params: Parameters to record in the config event.
+    """
+    with open(prompt_text_path, "rb") as file:
+        prompt_bytes = file.read()
+    prompt_hash = hashlib.sha256(prompt_bytes).hexdigest()[:12]
+
+    if logger.log_dir:
+        prompt_dir = os.path.join(logger.log_dir, "prompts")
+        name = os.path.splitext(os.path.basename(prompt_text_path))[0]
+        prompt_copy = os.path.join(prompt_dir, f"{name}_{prompt_hash}.txt")
+        if not os.path.exists(prompt_copy):
+            os.makedirs(prompt_dir, exist_ok=True)
+            with open(prompt_copy, "wb") as file:
+                file.write(prompt_bytes)
+
+    logger.info("CONFIG PARAMETERS", stage="config",
+                prompt_text_file=os.path.basename(prompt_text_path),
+                prompt_hash=prompt_hash, **params)
@@ -1,9 +1,61 @@
 import os
-from datetime import datetime
+import re
+import hashlib
 import pandas as pd
+import run_log
 
 # ------------------------------------------------------------------------------
 
+# Gemini API prices in USD per 1M (input, output) tokens, for cost estimates.
+# Update when pricing changes; unknown models get no cost estimate.
+GEMINI_PRICES = {
+    "gemini-2.0-flash": (0.10, 0.40),
+    "gemini-2.5-flash": (0.30, 2.50),
+    "gemini-2.5-pro": (1.25, 10.00),
+    "gemini-3.0-pro-preview": (2.00, 12.00),
+}
+
+
+def estimate_cost(model_id, input_tokens, output_tokens):
+    """ Estimated cost (USD) of a number of tokens, or None if the model price
+        is unknown."""
+    if model_id not in GEMINI_PRICES:
+        return None
+    input_price, output_price = GEMINI_PRICES[model_id]
+    return (input_tokens * input_price + output_tokens * output_price) / 1e6
+
+
+def load_api_key(key_path="secret/GEMINI_API_KEY.txt"):
+    """ Read the Gemini API key from key_path."""
+    with open(key_path, "r", encoding="utf-8") as file:
+        api_key = file.read().strip()
+    print("Successfully loaded API key")
+    return api_key
+
+
+def load_api_keys(key_path):
+    """
+    Read a pool of Gemini API keys: one key per line, optionally preceded by
+    a name ("name key"); blank lines and lines starting with # are skipped.
+
+    Returns:
+        dict: Key name (key1, key2, ... if not named) -> API key.
+    """
+    keys = {}
+    with open(key_path, "r", encoding="utf-8") as file:
+        for line in file:
+            parts = line.split()
+            if not parts or parts[0].startswith("#"):
+                continue
+            name = parts[0] if len(parts) > 1 else f"key{len(keys) + 1}"
+            if name in keys:
+                raise ValueError(f"API key name {name} is used twice in {key_path}")
+            keys[name] = parts[-1]
+    if not keys:
+        raise ValueError(f"No API key in {key_path}")
+    print(f"Successfully loaded {len(keys)} API keys")
+    return keys
+
 
 def export_clean_handcoded(handcoded_path, output_path):
     """ Wrapper for clean_handcoded to save cleaned data to output_path."""
@@ -11,31 +63,71 @@ def export_clean_handcoded(handcoded_path, output_path):
     df_clean.to_csv(output_path, index=False)
 
 
-def clean_handcoded(handcoded_path):
+# Folder for cleaned handcoded data, keyed by the source file's hash and mtime
+HANDCODED_CACHE_DIR = os.path.join("outputs", "cache", "handcoded")
+
+# Version of the cleaning in clean_handcoded, part of the cache key: increase
+# it when the cleaning changes, so that older cleaned data is not reused
+CLEANING_VERSION = 2
+
+# Normalizations of handcoded columns (applied after stripping whitespace and
+# question marks), compiled once
+_INTER_INTRA = re.compile(r"^(INTER|INTRA)(?!STATE)")
+_FUNCTIONS = re.compile(r"^(TRANSMISSION|DISTRIBUTION|GATHERING|FIELDING).*")
+
+
+def _strip_strings(col):
+    """ Strip whitespace and question marks from the string values of col,
+        leaving other values (missing values, numbers) untouched."""
+    if col.dtype != object and not pd.api.types.is_string_dtype(col):
+        return col
+    return col.map(lambda x: x.strip().replace("?", "")
+                   if isinstance(x, str) else x)
+
+
+def _file_key(path):
+    """ Hash of a file's contents combined with its modification time."""
+    with open(path, "rb") as file:
+        digest = hashlib.sha256(file.read()).hexdigest()[:16]
+    return f"{digest}_{int(os.path.getmtime(path))}"
+
+
+def clean_handcoded(handcoded_path, cache_dir=HANDCODED_CACHE_DIR):
     """ Clean and standardize handcoded data for consistent formatting with LLM 
         outputs.
 
+    The cleaned data is saved as .parquet in cache_dir, keyed by the hash and
+    modification time of handcoded_path and by CLEANING_VERSION, and reused
+    while the file and the cleaning are unchanged.
+
     Args:
         handcoded_path (str): path to handcoded data file
+        cache_dir (str): folder for cached cleaned data (None to disable)
 
     Returns: 
         Dataframe containing cleaned handcoded data.
     """
-    if handcoded_path.endswith(".csv"):
-        df_handcoded = pd.read_csv(handcoded_path)
-    elif handcoded_path.endswith((".xls", ".xlsx")):
-        df_handcoded = pd.read_excel(handcoded_path)
-    else:
+    if not handcoded_path.endswith((".csv", ".xls", ".xlsx")):
         raise ValueError(
             "Unsupported file format. Please use .csv or .xls/.xlsx")
 
-    # Strip all whitespace
-    df_handcoded = df_handcoded.map(lambda x: x.strip()
-                                    if isinstance(x, str) else x)
+    cache_path = None
+    if cache_dir is not None:
+        stem = os.path.splitext(os.path.basename(handcoded_path))[0]
+        cache_path = os.path.join(
+            cache_dir,
+            f"{stem}_{_file_key(handcoded_path)}_v{CLEANING_VERSION}.parquet")
+        if os.path.exists(cache_path):
+            return pd.read_parquet(cache_path)
 
-    # Remove trailing question marks for all entries that are strings
-    df_handcoded = df_handcoded.map(
-        lambda x: x.replace("?", "") if isinstance(x, str) else x)
+    if handcoded_path.endswith(".csv"):
+        df_handcoded = pd.read_csv(handcoded_path)
+    else:
+        df_handcoded = pd.read_excel(handcoded_path)
+
+    # Strip all whitespace and remove question marks for all entries that are
+    # strings
+    df_handcoded = df_handcoded.apply(_strip_strings)
 
     # Create new cleaned dataframe
     df_clean = pd.DataFrame(columns=["Data Year", "Pipeline Company",
@@ -44,114 +136,73 @@ def clean_handcoded(handcoded_path):
                                      "Origin State", "Terminus State",
                                      "Interstate or Intrastate"])
 
-    df_clean["Data Year"] = df_handcoded["Data year"].copy().astype(int)
-    df_clean["Pipeline Company"] = df_handcoded["Company"].copy()
-    df_clean["Origin State"] = df_handcoded["Origin State"].copy()
-    df_clean["Terminus State"] = df_handcoded["Terminus State"].copy()
+    df_clean["Data Year"] = df_handcoded["Data year"].astype(int)
+    df_clean["Pipeline Company"] = df_handcoded["Company"]
+    df_clean["Origin State"] = df_handcoded["Origin State"]
+    df_clean["Terminus State"] = df_handcoded["Terminus State"]
 
     # Standardize fuel types
-    df_clean["Fuel Type"] = df_handcoded["Fuel Type"].copy().str.upper()
-    df_clean["Fuel Type"] = df_clean["Fuel Type"].str.replace(
-        "PRODUCTS", "PRODUCT")
+    df_clean["Fuel Type"] = df_handcoded["Fuel Type"].str.upper().str.replace(
+        "PRODUCTS", "PRODUCT", regex=False)
+
+    # Extract bool for new construction (include both new construction and
+    # extension), copying over instances where the value is "UNK" or "NA"
+    construction = df_handcoded["Type of Construction Work"]
+    df_clean["New Construction"] = construction.str.lower().isin(
+        ["new", "extension"]).map({True: "TRUE", False: "FALSE"})
+    df_clean["New Construction"] = df_clean["New Construction"].mask(
+        construction.isin(["UNK", "NA"]), construction)
 
     # Extract bool for complete construction
-    new_construction = df_handcoded[
-        "Type of Construction Work"].str.lower() == "new"
-    extension_construction = df_handcoded[
-        "Type of Construction Work"].str.lower() == "extension"
-    df_clean["New Construction"] = new_construction | extension_construction
-    df_clean["New Construction"] = df_clean["New Construction"].astype(
-        str).str.upper()
-    # copy over instances where the value is "UNK" or "NA"
-    df_clean.loc[
-        df_handcoded["Type of Construction Work"] == "UNK", "New Construction"] = "UNK"
-    df_clean.loc[
-        df_handcoded["Type of Construction Work"] == "NA", "New Construction"] = "NA"
-
-    # Extract bool for new construction (include both new construction and extension)
-    df_clean["Construction Complete"] = df_handcoded[
-        "Construction Completion Status"].str.lower().str.startswith("complete")
-    df_clean["Construction Complete"] = df_clean["Construction Complete"].astype(
-        str).str.upper()
-    df_clean.loc[
-        df_handcoded["Construction Completion Status"] == "UNK", "Construction Complete"] = "UNK"
-    df_clean.loc[
-        df_handcoded["Construction Completion Status"] == "NA", "Construction Complete"] = "NA"
+    completion = df_handcoded["Construction Completion Status"]
+    df_clean["Construction Complete"] = completion.str.lower(
+    ).str.startswith("complete").astype(str).str.upper()
+    df_clean["Construction Complete"] = df_clean["Construction Complete"].mask(
+        completion.isin(["UNK", "NA"]), completion)
 
     # Standardize interstate/intrastate
-    df_clean["Interstate or Intrastate"] = df_handcoded["Inter/Intra-State?"].str.upper()
-    df_clean["Interstate or Intrastate"] = df_clean["Interstate or Intrastate"].str.replace(
-        "INTER", "INTERSTATE")
-    df_clean["Interstate or Intrastate"] = df_clean["Interstate or Intrastate"].str.replace(
-        "INTRA", "INTRASTATE")
+    df_clean["Interstate or Intrastate"] = df_handcoded[
+        "Inter/Intra-State?"].str.upper().str.replace(
+            _INTER_INTRA, r"\1STATE", regex=True)
 
     # Standardize pipeline length
     # TODO: need to handle cases with multiple mileage separated by semicolon
-    df_clean["Total Pipeline Length"] = df_handcoded["Length (mi)"].copy()
-    df_clean["Total Pipeline Length"] = df_clean["Total Pipeline Length"].replace(
-        {"UNK": -1, "NA": -2})
-    df_clean["Total Pipeline Length"] = df_clean["Total Pipeline Length"].astype(
-        float)
+    df_clean["Total Pipeline Length"] = df_handcoded["Length (mi)"].replace(
+        {"UNK": -1, "NA": -2}).astype(float)
 
     # Standardize parallel/loop boolean
-    df_clean["Parallel or Loop"] = df_handcoded["Parallel/Loop?"].astype(
-        str).str.upper()
     # convert yes/no to true/false
-    df_clean["Parallel or Loop"] = df_clean["Parallel or Loop"].replace(
-        {"YES": "TRUE", "NO": "FALSE"})
+    df_clean["Parallel or Loop"] = df_handcoded["Parallel/Loop?"].astype(
+        str).str.upper().replace({"YES": "TRUE", "NO": "FALSE"})
 
     # Standardize connection boolean
-    df_clean["Connection"] = df_handcoded["Connection to existing line?"].astype(
-        str).str.upper()
     # convert yes/no to true/false
-    df_clean["Connection"] = df_clean["Connection"].replace(
-        {"YES": "TRUE", "NO": "FALSE", "MAYBE": "UNK"})
+    df_clean["Connection"] = df_handcoded[
+        "Connection to existing line?"].astype(str).str.upper().replace(
+            {"YES": "TRUE", "NO": "FALSE", "MAYBE": "UNK"})
 
     # Standardize function of pipeline
-    df_clean["Function"] = df_handcoded["Pipeline Function"].astype(
-        str).str.upper()
     # if it starts with the key word, convert to standard term (to eliminate other descriptors added by coder)
-    df_clean["Function"] = df_clean["Function"].replace({
-        r"^TRANSMISSION.*": "TRANSMISSION",
-        r"^DISTRIBUTION.*": "DISTRIBUTION",
-        r"^GATHERING.*": "GATHERING",
-        r"^FIELDING.*": "FIELDING",
-    }, regex=True)
+    df_clean["Function"] = df_handcoded["Pipeline Function"].astype(
+        str).str.upper().str.replace(_FUNCTIONS, r"\1", regex=True)
+
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        df_clean.to_parquet(cache_path, index=False)
 
     return df_clean
 
 
 def write_log(message, log_dir, config):
     # TODO: remove config and replace with file_path arg
-    if not os.path.exists(log_dir):
-        os.makedirs(log_dir)
-    file_path = os.path.join(log_dir, f"log_{config.identifier}.txt")
-    with open(file_path, "a", encoding="utf-8") as file:
-        timestamp = datetime.now().strftime("%H%M:%S")
-        file.write(f"[{timestamp}] {message}\n\n")
+    run_log.get_logger(log_dir, config.identifier).info(message, stage="log",
+                                                         console=False)
 
 
 def log_config(log_dir, config):
-    if not os.path.exists(log_dir):
-        os.makedirs(log_dir)
-
-    # Save text of gemini prompt--------
-    with open(config.prompt_text_path, "r") as file:
-        prompt_text = file.read()
-    with open(os.path.join(log_dir, "prompt_text.txt"), "a",
-              encoding="utf-8") as file:
-        file.write(prompt_text)
-
-    # Save parameter values ----------
-    file_path = os.path.join(log_dir, f"log_{config.identifier}.txt")
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-    with open(file_path, "a", encoding="utf-8") as file:
-        file.write(f"[{timestamp}] \n\n")
-        file.write(f"CONFIG PARAMETERS\n\n")
-        # file.write(f"Directory file year: {input_file_year}\n")
-        file.write(f"Start page: {config.start_page}\n")
-        file.write(f"End page: {config.start_page + config.n_pages - 1}\n")
-        file.write(f"Page window: {config.page_window}\n")
-        file.write(f"Prompt text file: {config.prompt_text_name}\n")
-        file.write(f"Gemini model: {config.gemini_model_id}\n\n")
+    run_log.log_run_config(run_log.get_logger(log_dir, config.identifier),
+                           config.prompt_text_path,
+                           start_page=config.start_page,
+                           end_page=config.start_page + config.n_pages - 1,
+                           page_window=config.page_window,
+                           gemini_model=config.gemini_model_id)